@@ -1,57 +1,134 @@
 import pandas as pd
 import pyarrow.parquet as pq
 import pyarrow as pa
+import pyarrow.compute as pc
 import ast
 import os
 import io
 import sys
 import json
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 import numpy as np
 
 
 
-def load_files_to_dataframe(main_folder_path):
+def _list_files(main_folder_path):
+    # (key, file_path, file_name) of every file to read: files of a subfolder share the subfolder name as key,
+    # files of the main folder use their name without extension
+    files = []
+    for sub_folder in os.listdir(main_folder_path):
+        sub_folder_path = os.path.join(main_folder_path, sub_folder)
+        if os.path.isdir(sub_folder_path):
+            for file in os.listdir(sub_folder_path):
+                files.append((sub_folder, os.path.join(sub_folder_path, file), file))
+        elif sub_folder.endswith(('.json', '.csv', '.xlsx')):
+            files.append((sub_folder.split('.')[0], sub_folder_path, sub_folder))
+    return files
+
+
+def _read_file_timed(file_path, file_name, as_arrow=False):
+    # Reads a file (in a worker process when loading in parallel), as an Arrow table if requested and possible
+    start = time.perf_counter()
+    data = read_file(file_path, file_name)
+    if as_arrow and data is not None:
+        try:
+            data = pa.Table.from_pandas(data, preserve_index=False)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+            # Kept as a DataFrame, its folder is concatenated with pandas
+            pass
+    return data, time.perf_counter() - start
+
+
+def _concat_parts(parts):
+    # Arrow tables are concatenated without copies and converted to pandas once; mixed or incompatible parts use pd.concat
+    if all(isinstance(part, pa.Table) for part in parts):
+        try:
+            table = pa.concat_tables(parts, promote_options='default')
+            return table.to_pandas(split_blocks=True, self_destruct=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            pass
+    frames = [part.to_pandas() if isinstance(part, pa.Table) else part for part in parts]
+    return pd.concat(frames, axis=0, ignore_index=True)
+
+
+def _read_files_parallel(files, workers, memory_budget):
+    # Submits files while the size on disk of the files being read fits in the memory budget (at least one file at a time)
+    results = [None] * len(files)
+    sizes = [os.path.getsize(file_path) for key, file_path, file_name in files]
+    pending = {}
+    next_file = 0
+    in_flight = 0
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while next_file < len(files) or pending:
+            while next_file < len(files) and (not pending or memory_budget is None
+                                              or in_flight + sizes[next_file] <= memory_budget):
+                key, file_path, file_name = files[next_file]
+                pending[pool.submit(_read_file_timed, file_path, file_name, True)] = next_file
+                in_flight += sizes[next_file]
+                next_file += 1
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                position = pending.pop(future)
+                in_flight -= sizes[position]
+                results[position] = future.result()
+
+    return results
+
+
+def load_files_to_dataframe(main_folder_path, workers=1, memory_budget=None, return_timings=False):
     '''
     Function to read JSON, CSV, and XLSX files from a directory, process them,
     and return a dictionary of Pandas DataFrames.
 
     Parameters:
     - main_folder_path (str): The path to the main folder containing subfolders with files.
+    - workers (int, optional): Number of processes reading files in parallel. Defaults to 1 (files are read one
+      at a time in this process). With several workers, each file is sent back as an Arrow table and the files of
+      a folder are concatenated as Arrow tables, converted to pandas once (list columns come back as arrays).
+    - memory_budget (int, optional): Maximum total size in bytes (on disk) of the files being read at the same
+      time in parallel mode. A file larger than the budget is read alone. Defaults to no limit.
+    - return_timings (bool, optional): Also return the time spent reading every file. Defaults to False.
 
     Returns:
     - dicc (dict): A dictionary where keys are folder or file names and values are Pandas DataFrames.
+    - timings (pd.DataFrame): Only if return_timings is True. Columns Key, File, Bytes, Rows and Seconds,
+      slowest files first.
     '''
-    dicc = {}
+    files = _list_files(main_folder_path)
 
-    for sub_folder in os.listdir(main_folder_path):
-        sub_folder_path = os.path.join(main_folder_path, sub_folder)
-
-        # Process files in subfolders
-        if os.path.isdir(sub_folder_path):
-            folder_name = sub_folder
-            dataframe_list = []
-
-            for file in os.listdir(sub_folder_path):
-                file_path = os.path.join(sub_folder_path, file)
-                dataframe_aux = read_file(file_path, file)
-                if dataframe_aux is not None:
-                    dataframe_list.append(dataframe_aux)
-
-            if dataframe_list:
-                dataframe_object = pd.concat(dataframe_list, axis=0, ignore_index=True)
-                dicc[folder_name] = dataframe_object
-                print(f'Data from {folder_name} successfully loaded.')
-
-        # Process files in main folder
-        elif sub_folder.endswith(('.json', '.csv', '.xlsx')):
-            file_path = sub_folder_path
-            file_name = sub_folder.split('.')[0]
+    if workers > 1 and len(files) > 1:
+        results = _read_files_parallel(files, workers, memory_budget)
+    else:
+        results = [_read_file_timed(file_path, file_name) for key, file_path, file_name in files]
 
-            dataframe_aux = read_file(file_path, sub_folder)
-            if dataframe_aux is not None:
-                dicc[file_name] = dataframe_aux
-                print(f'File {file_name} successfully loaded.')
+    # Group the files of every key, keeping the order in which they were listed
+    parts = {}
+    timings = []
+    for (key, file_path, file_name), (data, seconds) in zip(files, results):
+        timings.append((key, file_name, os.path.getsize(file_path), None if data is None else len(data), round(seconds, 3)))
+        if data is not None:
+            parts.setdefault(key, []).append(data)
 
+    dicc = {}
+    for key, key_parts in parts.items():
+        if os.path.isdir(os.path.join(main_folder_path, key)):
+            dicc[key] = _concat_parts(key_parts)
+            print(f'Data from {key} successfully loaded.')
+        else:
+            data = key_parts[-1]
+            dicc[key] = data.to_pandas() if isinstance(data, pa.Table) else data
+            print(f'File {key} successfully loaded.')
+
+    timings = pd.DataFrame(timings, columns=['Key', 'File', 'Bytes', 'Rows', 'Seconds']).astype({'Rows': 'Int64'})
+    timings = timings.sort_values('Seconds', ascending=False, kind='mergesort').reset_index(drop=True)
+    print(f"{len(files)} files read in {timings['Seconds'].sum():.2f} s of reading time. Slowest files:")
+    print(timings.head(5).to_string(index=False))
+
+    if return_timings:
+        return dicc, timings
     return dicc
 
 
@@ -87,46 +164,233 @@ def read_file(file_path, file_name):
         return None
 
 
-def read_generic_json(file_path):
+# Number of records parsed at once by the streaming JSON readers
+JSON_BATCH_SIZE = 10000
+
+
+def sniff_json_format(file_path):
     '''
-    Function to read JSON files and handle different formats:
-    1. Full JSON reading.
-    2. Line by line reading using ast.literal_eval.
-    3. Line by line normalizing JSON objects.
+    Detects the format of a JSON file from its first line, without reading the whole file.
 
     Parameters:
     - file_path (str): The path to the JSON file.
 
     Returns:
-    - df (pd.DataFrame): A Pandas DataFrame containing the data from the JSON file.
+    - format (str): 'json_lines' for one JSON object per line, 'python_lines' for one Python literal per line
+      (single-quoted dumps, read with ast.literal_eval) or 'json' for a single JSON document.
     '''
-    # Try 1: Read as JSON 
+    with open(file_path, 'r', encoding='utf-8-sig') as f:
+        # An array is a single document: it is not read line by line, even if it fits in one line
+        first_char = f.read(1)
+        while first_char.isspace():
+            first_char = f.read(1)
+        if first_char == '[':
+            return 'json'
+
+        # The first complete non-empty line, however long its record is
+        f.seek(0)
+        first_line = ''
+        for line in f:
+            first_line = line.strip()
+            if first_line:
+                break
+
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        return pd.DataFrame(data)
-    
+        json.loads(first_line)
+        return 'json_lines'
     except json.JSONDecodeError:
-        print(f'Failed to load full JSON from {file_path}. Trying line-by-line methods.')
+        pass
+    try:
+        ast.literal_eval(first_line)
+        return 'python_lines'
+    except (ValueError, SyntaxError):
+        # A document spanning several lines (e.g. a pretty-printed object)
+        return 'json'
+
 
-    # Try 2: Read line by line using ast.literal_eval
-    rows = []
+def _parse_python_line(line):
+    # Lines of Python dumps may still use JSON literals (true, false, null)
     try:
-        with open(file_path, encoding='utf-8') as f:
-            for line in f.readlines():
-                rows.append(ast.literal_eval(line))
-        return pd.DataFrame(rows)
-    
+        return ast.literal_eval(line)
     except (ValueError, SyntaxError):
-        print(f'Failed to parse JSON with ast.literal_eval for {file_path}. Trying normalization.')
+        return json.loads(line)
+
 
-    # Try  3: Read line by line normalizing JSON
+def _parse_json_line(line):
+    # Files whose first line is JSON may still hold Python literals (single quotes) further down
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        json_obj = [json.loads(line) for line in content.split('\n') if line.strip()]
-        return pd.json_normalize(json_obj)
-    
+        return json.loads(line)
+    except json.JSONDecodeError:
+        return ast.literal_eval(line)
+
+
+def iter_json_records(file_path, batch_size=JSON_BATCH_SIZE, json_format=None):
+    '''
+    Reads the records of a JSON file in lists of at most batch_size records, in a single pass.
+    Line-delimited files are streamed, so memory is bounded by one batch; a single JSON document is loaded once.
+
+    Parameters:
+    - file_path (str): The path to the JSON file.
+    - batch_size (int, optional): Maximum number of records per list. Defaults to 10000.
+    - json_format (str, optional): Format of the file (see sniff_json_format). Detected if None.
+
+    Returns:
+    - generator: Lists of records (dicts).
+    '''
+    json_format = json_format or sniff_json_format(file_path)
+
+    if json_format == 'json':
+        with open(file_path, 'r', encoding='utf-8-sig') as f:
+            data = json.load(f)
+        records = data if isinstance(data, list) else [data]
+        for start in range(0, len(records), batch_size):
+            yield records[start:start + batch_size]
+        return
+
+    parse = _parse_json_line if json_format == 'json_lines' else _parse_python_line
+    batch = []
+    with open(file_path, 'r', encoding='utf-8-sig') as f:
+        for line in f:
+            if line.strip():
+                batch.append(parse(line))
+                if len(batch) == batch_size:
+                    yield batch
+                    batch = []
+    if batch:
+        yield batch
+
+
+def infer_json_schema(file_path, batch_size=JSON_BATCH_SIZE, json_format=None):
+    '''
+    Infers the Arrow schema of a JSON file from all its records, in a pass that only keeps one batch in memory.
+    The schemas of the batches are merged: a field that is null in a whole batch takes the type of the batches
+    where it has values, integers are widened to floats when both appear and fields that first appear in a
+    later batch are added at the end.
+
+    Parameters:
+    - file_path (str): The path to the JSON file.
+    - batch_size (int, optional): Maximum number of records typed at once. Defaults to 10000.
+    - json_format (str, optional): Format of the file (see sniff_json_format). Detected if None.
+
+    Returns:
+    - schema (pa.Schema): Schema of the records, empty if the file has none.
+
+    Raises:
+    - ValueError: If a field holds values of incompatible types (e.g. numbers and strings) in different batches.
+    '''
+    schema = pa.schema([])
+    for number, records in enumerate(iter_json_records(file_path, batch_size, json_format)):
+        # Fields of every record of the batch, not only of the first one
+        batch_schema = pa.schema(list(pa.array(records).type))
+        try:
+            schema = pa.unify_schemas([schema, batch_schema], promote_options='permissive')
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            raise ValueError(f'Batch {number} of {file_path} does not match the types of the previous batches: '
+                             f'{e}. Pass an explicit schema to iter_json_batches.') from e
+    return schema
+
+
+def iter_json_batches(file_path, batch_size=JSON_BATCH_SIZE, schema=None):
+    '''
+    Reads a JSON file as Arrow record batches, without building the full list of records.
+    If no schema is given it is inferred from all the records first (see infer_json_schema), so the file is read
+    twice. Every batch is converted with the schema: missing fields become null and fields that are not in a
+    given schema are dropped (with a warning).
+
+    Parameters:
+    - file_path (str): The path to the JSON file.
+    - batch_size (int, optional): Maximum number of rows per batch. Defaults to 10000.
+    - schema (pa.Schema, optional): Schema of the batches. Inferred from the whole file if None.
+
+    Returns:
+    - generator: pa.RecordBatch objects sharing one schema.
+    '''
+    json_format = sniff_json_format(file_path)
+    if schema is None:
+        schema = infer_json_schema(file_path, batch_size, json_format)
+
+    warned = set()
+    for number, records in enumerate(iter_json_records(file_path, batch_size, json_format)):
+        extra = {key for record in records for key in record} - set(schema.names) - warned
+        if extra:
+            print(f'Fields {sorted(extra)} of {file_path} are not in the schema and are dropped.')
+            warned |= extra
+
+        try:
+            yield pa.RecordBatch.from_pylist(records, schema=schema)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, TypeError) as e:
+            raise ValueError(f'Batch {number} of {file_path} does not match the schema {schema}: {e}. '
+                             'Pass an explicit schema to iter_json_batches.') from e
+
+
+def json_to_parquet(file_path, parquet_path, batch_size=JSON_BATCH_SIZE, schema=None):
+    '''
+    Converts a JSON file to a Parquet file streaming record batches, so memory is bounded by one batch
+    for line-delimited files. The file is written to a temporary file that is renamed once it is complete,
+    so a failed conversion leaves no partial file behind.
+
+    Parameters:
+    - file_path (str): The path to the JSON file.
+    - parquet_path (str): The path of the Parquet file to write.
+    - batch_size (int, optional): Maximum number of rows per batch. Defaults to 10000.
+    - schema (pa.Schema, optional): Schema of the file. Inferred from the whole file if None.
+
+    Returns:
+    - rows (int): Number of rows written.
+    '''
+    temp_path = f'{parquet_path}.tmp'
+    rows = 0
+    writer = None
+    try:
+        for batch in iter_json_batches(file_path, batch_size, schema):
+            if writer is None:
+                writer = pq.ParquetWriter(temp_path, batch.schema)
+            writer.write_batch(batch)
+            rows += batch.num_rows
+        if writer is not None:
+            writer.close()
+            os.replace(temp_path, parquet_path)
+    except BaseException:
+        if writer is not None:
+            writer.close()
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    print(f'{rows} rows of {file_path} saved at {parquet_path}')
+    return rows
+
+
+def read_generic_json(file_path, normalize=None):
+    '''
+    Function to read JSON files and handle different formats, detected once from the first line of the file:
+    1. A single JSON document.
+    2. One Python literal per line, read with ast.literal_eval.
+    3. One JSON object per line.
+    Line-delimited files are parsed in chunks in a single pass. A line that is not in the detected format is
+    parsed as the other line format.
+
+    Parameters:
+    - file_path (str): The path to the JSON file.
+    - normalize (bool, optional): Flatten the nested objects of line-delimited files into 'parent.child'
+      columns with pd.json_normalize. Defaults to None: JSON lines are flattened and Python lines keep
+      nested objects in a single column.
+
+    Returns:
+    - df (pd.DataFrame): A Pandas DataFrame containing the data from the JSON file.
+    '''
+    try:
+        json_format = sniff_json_format(file_path)
+        if json_format == 'json':
+            with open(file_path, 'r', encoding='utf-8-sig') as f:
+                return pd.DataFrame(json.load(f))
+
+        if normalize is None:
+            normalize = json_format == 'json_lines'
+        to_frame = pd.json_normalize if normalize else pd.DataFrame
+        chunks = [to_frame(records) for records in iter_json_records(file_path, json_format=json_format)]
+        return pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame()
+
     except Exception as e:
         print(f'All parsing methods failed for {file_path}. Error: {e}')
         return None
@@ -146,57 +410,172 @@ def convert_column_to_string(dataframe, col):
     dataframe[col] = dataframe[col].astype(str)
     return dataframe[col]
 
-def try_save_parquet(dataframe_aux, file_path):
+# Defaults of the Parquet writers: codec and maximum number of rows converted and written at once
+PARQUET_COMPRESSION = 'snappy'
+PARQUET_ROW_GROUP_SIZE = 100000
+
+# Number of non-null values used to pick the Arrow type of a scalar object column
+SCHEMA_SAMPLE_SIZE = 1000
+
+
+# Arrow type of the object columns whose values are all of one kind (pandas infer_dtype result)
+_INFERRED_TYPES = {
+    'empty': pa.null(),
+    'string': pa.string(),
+    'bytes': pa.binary(),
+    'boolean': pa.bool_(),
+    'integer': pa.int64(),
+    'floating': pa.float64(),
+    'mixed-integer-float': pa.float64(),
+}
+
+
+def _value_kind(value_type):
+    if issubclass(value_type, (list, tuple, set, np.ndarray)):
+        return 'list'
+    if issubclass(value_type, dict):
+        return 'dict'
+    return 'scalar'
+
+
+def _to_json(value):
+    # Nested values are kept readable as JSON instead of their Python repr
+    return json.dumps(value.tolist() if isinstance(value, np.ndarray) else value, default=str, ensure_ascii=False)
+
+
+def infer_column_type(series, sample_size=SCHEMA_SAMPLE_SIZE):
     '''
-    Tries to save the DataFrame as a Parquet file. If it fails, only converts problematic columns to string type.
-    
+    Infers the Arrow type of an object column looking at its values once. A full type check of the non-null
+    values (pandas infer_dtype) decides the kind of column; a sample of the values gives the Arrow type of
+    other scalar columns (e.g. dates), and list/dict columns get the list/struct type inferred by Arrow from
+    all their values. Columns mixing kinds of values (e.g. numbers and text) are stored as text, with nested
+    values as JSON.
+
+    Parameters:
+    - series (pd.Series): An object column.
+    - sample_size (int, optional): Number of non-null values used to type scalar columns. Defaults to 1000.
+
+    Returns:
+    - tuple: (arrow_type, array) where array is the converted column (pa.Array) when it had to be converted
+      while inferring (nested or mixed columns), or None when the column converts with arrow_type as it is.
+    '''
+    inferred = pd.api.types.infer_dtype(series, skipna=True)
+    if inferred in _INFERRED_TYPES:
+        return _INFERRED_TYPES[inferred], None
+
+    present = series.notna().to_numpy()
+    values = series[present]
+    value_types = values.map(type)
+    types = set(value_types.unique())
+    if not inferred.startswith('mixed') and len(types) == 1:
+        # Scalars of a single type (dates, decimals...) typed from a sample
+        try:
+            return pa.array(values.iloc[:sample_size], from_pandas=True).type, None
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError, TypeError, ValueError):
+            pass
+
+    kinds = {_value_kind(value_type) for value_type in types}
+    if kinds in ({'list'}, {'dict'}):
+        try:
+            array = pa.array(series, from_pandas=True)
+            return array.type, array
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError, TypeError, ValueError):
+            pass
+
+    nested = value_types.isin([value_type for value_type in types if _value_kind(value_type) != 'scalar'])
+    text = values.astype(str)
+    text[nested] = values[nested].map(_to_json)
+    column = np.full(len(series), None, dtype=object)
+    column[present] = text.to_numpy(dtype=object)
+    return pa.string(), pa.array(column, type=pa.string(), from_pandas=True)
+
+
+def parquet_schema(dataframe, sample_size=SCHEMA_SAMPLE_SIZE):
+    '''
+    Builds the Arrow schema of a DataFrame, typing its object columns with infer_column_type.
+
+    Parameters:
+    - dataframe (pd.DataFrame): The DataFrame to be saved.
+    - sample_size (int, optional): Number of non-null values used to type scalar object columns.
+
+    Returns:
+    - tuple: (schema, arrays, preserve_index) with the pa.Schema (pandas metadata included), a dict
+      column -> pa.Array with the columns already converted while inferring, and whether the index is stored.
+    '''
+    index = dataframe.index
+    # A default 0..n-1 index is rebuilt on read, any other index is stored as a column
+    preserve_index = not (isinstance(index, pd.RangeIndex) and index.start == 0 and index.step == 1
+                          and index.name is None)
+
+    schema = pa.Schema.from_pandas(dataframe.iloc[:0], preserve_index=preserve_index)
+    arrays = {}
+    for position, col in enumerate(dataframe.columns):
+        if dataframe[col].dtype != object:
+            continue
+        arrow_type, array = infer_column_type(dataframe[col], sample_size)
+        schema = schema.set(position, pa.field(schema.field(position).name, arrow_type))
+        if array is not None:
+            arrays[col] = array
+    return schema, arrays, preserve_index
+
+
+def try_save_parquet(dataframe_aux, file_path, compression=PARQUET_COMPRESSION, row_group_size=PARQUET_ROW_GROUP_SIZE,
+                     sample_size=SCHEMA_SAMPLE_SIZE):
+    '''
+    Saves the DataFrame as a Parquet file. The schema is inferred first (see parquet_schema), so object columns
+    are converted once: list/dict columns keep Arrow list/struct types and only columns mixing kinds of values
+    are stored as text. The file is written one row group at a time to a temporary file that is then renamed.
+    The DataFrame is not modified.
+
     Parameters:
     - dataframe_aux (pd.DataFrame): The DataFrame to be saved.
     - file_path (str): The file path where the Parquet file will be saved.
-    
+    - compression (str, optional): Parquet codec ('snappy', 'zstd', 'gzip', 'brotli', 'lz4' or 'none'). Defaults to 'snappy'.
+    - row_group_size (int, optional): Maximum number of rows per row group. Defaults to 100000.
+    - sample_size (int, optional): Number of non-null values used to type scalar object columns. Defaults to 1000.
+
     Returns:
     - None
     '''
+    temp_path = f'{file_path}.tmp'
     try:
-        # Try to convert full  DataFrame to Parquet
-        table = pa.Table.from_pandas(dataframe_aux)
-        pq.write_table(table, file_path)
+        schema, arrays, preserve_index = parquet_schema(dataframe_aux, sample_size)
+        for col, array in arrays.items():
+            if pa.types.is_string(array.type):
+                print(f"Column '{col}' converted to string.")
+
+        # Columns converted while inferring are sliced, the rest is converted one row group at a time
+        rest = dataframe_aux.drop(columns=list(arrays))
+        rest_schema = pa.schema([field for position, field in enumerate(schema)
+                                 if position >= len(dataframe_aux.columns)
+                                 or dataframe_aux.columns[position] not in arrays])
+        positions = {col: dataframe_aux.columns.get_loc(col) for col in arrays}
+
+        with pq.ParquetWriter(temp_path, schema, compression=compression) as writer:
+            for start in range(0, max(len(dataframe_aux), 1), row_group_size):
+                table = pa.Table.from_pandas(rest.iloc[start:start + row_group_size], schema=rest_schema,
+                                             preserve_index=preserve_index)
+                for col in sorted(arrays, key=positions.get):
+                    table = table.add_column(positions[col], schema.field(positions[col]),
+                                             arrays[col].slice(start, row_group_size))
+                writer.write_table(table.replace_schema_metadata(schema.metadata))
+        os.replace(temp_path, file_path)
         print(f'Dataframe saved successfully at {file_path}')
     except Exception as e:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
         print(f"Error saving DataFrame at {file_path}: {e}")
-        print("Converting problematic columns to string and retrying...")
-        
-        # Ir it fails, identify problematic columns
-        problematic_columns = []
-        for col in dataframe_aux.columns:
-            try:
-                # Try to convert column by column to parquet
-                pa.array(dataframe_aux[col])
-            except Exception:
-                # when a column fails, mark as problematic column
-                problematic_columns.append(col)
-        
-        # Converto the problematic columns to string
-        for col in problematic_columns:
-            dataframe_aux[col] = convert_column_to_string(dataframe_aux, col)
-            print(f"Column '{col}' converted to string.")
-
-        # Try to save the dataframe again
-        try:
-            table = pa.Table.from_pandas(dataframe_aux)
-            pq.write_table(table, file_path)
-            print(f'Dataframe saved successfully after converting problematic columns to string at {file_path}')
-        except Exception as final_error:
-            print(f"Final error saving DataFrame at {file_path}: {final_error}")
 
-def dataframe_to_parquet(dicc, subfolder_name):
+def dataframe_to_parquet(dicc, subfolder_name, compression=PARQUET_COMPRESSION, row_group_size=PARQUET_ROW_GROUP_SIZE):
     '''
-    Function to save Pandas DataFrames as Parquet files. If the conversion fails, it will convert problematic
-    columns to string and retry saving.
+    Function to save Pandas DataFrames as Parquet files with try_save_parquet, which infers the types of the
+    object columns and only stores as string the columns mixing kinds of values.
     
     Parameters:
     - dicc (dict): A dictionary where keys are folder names and values are Pandas DataFrames.
     - subfolder_name (str): The desired subfolder name to be used in the file path.
+    - compression (str, optional): Parquet codec. Defaults to 'snappy'.
+    - row_group_size (int, optional): Maximum number of rows per row group. Defaults to 100000.
     
     Returns:
     - None
@@ -206,7 +585,7 @@ def dataframe_to_parquet(dicc, subfolder_name):
         file_path = f'/lakehouse/default/Files/{subfolder_name}/{key}.parquet'
         
         # Save dataframee
-        try_save_parquet(dataframe_aux, file_path)
+        try_save_parquet(dataframe_aux, file_path, compression, row_group_size)
 
 
 def save_to_pq(dfs, names):
@@ -223,48 +602,260 @@ def save_to_pq(dfs, names):
         print(f"DataFrame '{name}' save as '{archivo}'")
 
 
-def data_summ_f(df, title=None):
+# Number of rows read at once when a Parquet file has to be scanned to profile it
+PROFILE_BATCH_SIZE = 65536
+
+
+def _types_array(types):
+    # Same form as Series.unique(): a 1-D object array of Python types
+    result = np.empty(len(types), dtype=object)
+    result[:] = list(types)
+    return result
+
+
+def column_types(series, null_mask=None, sample_rows=None, random_state=0):
+    '''
+    Returns the distinct Python types of the values of a column (the result of series.apply(type).unique())
+    without a Python call per value. Columns with a numpy or extension dtype box every value to the same type,
+    so one non-null and one null value are enough; object columns are scanned once in C (or sampled).
+
+    Parameters:
+    - series (pd.Series): The column.
+    - null_mask (np.ndarray, optional): series.isna() as a boolean array, if already computed.
+    - sample_rows (int, optional): Maximum number of values of an object column that are scanned. All if None.
+    - random_state (int, optional): Seed of the sample. Defaults to 0.
+
+    Returns:
+    - np.ndarray: The distinct types, in order of first appearance (non-null first for text columns).
+    '''
+    null_mask = series.isna().to_numpy() if null_mask is None else null_mask
+
+    if series.dtype != object:
+        positions = []
+        if not null_mask.all():
+            positions.append(int(np.argmin(null_mask)))
+        if null_mask.any():
+            positions.append(int(np.argmax(null_mask)))
+        return series.iloc[sorted(positions)].apply(type).unique()
+
+    values = series.to_numpy()
+    if sample_rows is not None and len(values) > sample_rows:
+        rows = np.sort(np.random.default_rng(random_state).choice(len(values), sample_rows, replace=False))
+        values, null_mask = values[rows], null_mask[rows]
+
+    if pd.api.types.infer_dtype(values, skipna=True) == 'string':
+        # Only the null values have to be looked at
+        null_types = list(dict.fromkeys(map(type, values[null_mask])))
+        if len(null_mask) and null_mask[0]:
+            return _types_array(null_types + [str])
+        return _types_array(([str] if not null_mask.all() else []) + null_types)
+    return _types_array(dict.fromkeys(map(type, values)))
+
+
+def profile_dataframe(df, sample_rows=None, random_state=0):
+    '''
+    Profiles a DataFrame: type set, non-missing and missing quantities of every column, plus row-level null
+    stats. Null masks are computed once per column with vectorized operations and the type sets with
+    column_types, so no Python call is made per cell.
+
+    Parameters:
+    - df (pd.DataFrame): The DataFrame to profile.
+    - sample_rows (int, optional): Maximum number of values per object column scanned for types.
+      Null counts and row stats are always exact. All values are scanned if None.
+    - random_state (int, optional): Seed of the sample. Defaults to 0.
+
+    Returns:
+    - tuple: (df_info, stats) with the per-column DataFrame of data_summ and a dict with 'rows',
+      'full_null_rows', 'rows_with_nulls' and 'sampled' (whether type sets come from a sample).
+    '''
+    rows = len(df)
+    info_dict = {"Column": [], "Data_type": [], "No_miss_Qty": [], "%Missing": [], "Missing_Qty": []}
+    all_null = np.ones(rows, dtype=bool)
+    any_null = np.zeros(rows, dtype=bool)
+
+    for position, column in enumerate(df.columns):
+        series = df.iloc[:, position]
+        null_mask = series.isna().to_numpy()
+        missing = int(null_mask.sum())
+        all_null &= null_mask
+        any_null |= null_mask
+
+        info_dict["Column"].append(column)
+        info_dict["Data_type"].append(column_types(series, null_mask, sample_rows, random_state))
+        info_dict["No_miss_Qty"].append(rows - missing)
+        info_dict["%Missing"].append(round(missing * 100 / rows, 2) if rows else 0.0)
+        info_dict["Missing_Qty"].append(missing)
+
+    stats = {'rows': rows, 'full_null_rows': int(all_null.sum()), 'rows_with_nulls': int(any_null.sum()),
+             'sampled': sample_rows is not None and rows > sample_rows}
+    return pd.DataFrame(info_dict), stats
+
+
+def _sample_row_groups(metadata, sample_rows):
+    # All the row groups, or evenly spaced ones holding about sample_rows rows
+    groups = list(range(metadata.num_row_groups))
+    if sample_rows is None or metadata.num_rows <= sample_rows or not groups:
+        return groups
+    needed = int(np.ceil(sample_rows * len(groups) / metadata.num_rows))
+    return sorted(set(np.linspace(0, len(groups) - 1, max(needed, 1)).round().astype(int).tolist()))
+
+
+def _statistics_null_counts(metadata, fields):
+    # Null count of every flat column whose row groups all store it in their statistics
+    leaves = {metadata.schema.column(j).path: j for j in range(metadata.num_columns)}
+    counts = {}
+    for field in fields:
+        leaf = leaves.get(field.name)
+        if leaf is None or pa.types.is_nested(field.type):
+            continue
+        total = 0
+        for group in range(metadata.num_row_groups):
+            statistics = metadata.row_group(group).column(leaf).statistics
+            if statistics is None or not statistics.has_null_count:
+                total = None
+                break
+            total += statistics.null_count
+        if total is not None:
+            counts[field.name] = total
+    return counts
+
+
+def profile_parquet(file_path, sample_rows=None, batch_size=PROFILE_BATCH_SIZE):
+    '''
+    Profiles a Parquet file like profile_dataframe without loading it into pandas. Row counts and null counts
+    come from the file metadata (row group statistics); only the columns without statistics are read, and the
+    whole file is only scanned (in Arrow batches) when every column has nulls, to count the full null rows.
+    Type sets are those pandas would give, taken from one non-null and one null value of every column.
+    Nulls are the nulls stored in the file (NaN values written as floats are not counted).
+
+    Parameters:
+    - file_path (str): The path to the Parquet file.
+    - sample_rows (int, optional): Maximum number of rows read when the file has to be scanned (evenly spaced
+      row groups); counts read from the data are then extrapolated to the whole file. All rows if None.
+    - batch_size (int, optional): Number of rows read at once. Defaults to 65536.
+
+    Returns:
+    - tuple: (df_info, stats) as in profile_dataframe. stats also has 'read_rows', the number of rows read,
+      and 'sampled' is True when some counts were extrapolated; 'rows_with_nulls' is None unless the file was scanned.
+    '''
+    parquet_file = pq.ParquetFile(file_path)
+    metadata = parquet_file.metadata
+    schema = parquet_file.schema_arrow
+    index_columns = {name for name in (schema.pandas_metadata or {}).get('index_columns', []) if isinstance(name, str)}
+    fields = [field for field in schema if field.name not in index_columns]
+    rows = metadata.num_rows
+
+    null_counts = _statistics_null_counts(metadata, fields)
+    # A column without nulls means there is no full null row
+    scan_rows = bool(fields) and not any(count == 0 for count in null_counts.values())
+    read_columns = [field.name for field in fields if scan_rows or field.name not in null_counts]
+
+    read_counts = dict.fromkeys(read_columns, 0)
+    samples = {}
+    full_null_rows = 0
+    any_null_rows = 0
+    read_rows = 0
+    if read_columns:
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=read_columns,
+                                               row_groups=_sample_row_groups(metadata, sample_rows)):
+            all_null = any_null = None
+            for name in read_columns:
+                array = batch.column(name)
+                read_counts[name] += array.null_count
+                if name not in samples and array.null_count < len(array):
+                    samples[name] = array.drop_null().slice(0, 1)
+                if scan_rows:
+                    mask = pc.is_null(array)
+                    all_null = mask if all_null is None else pc.and_(all_null, mask)
+                    any_null = mask if any_null is None else pc.or_(any_null, mask)
+            if scan_rows:
+                full_null_rows += pc.sum(all_null).as_py() or 0
+                any_null_rows += pc.sum(any_null).as_py() or 0
+            read_rows += batch.num_rows
+            if sample_rows is not None and read_rows >= sample_rows:
+                break
+
+    sampled = 0 < read_rows < rows
+    scale = rows / read_rows if read_rows else 1.0
+    for name, count in read_counts.items():
+        if name not in null_counts:
+            null_counts[name] = min(int(round(count * scale)), rows)
+
+    # One non-null value of the columns not sampled yet, read until found
+    for field in fields + [field for field in schema if field.name in index_columns]:
+        if field.name in samples or null_counts.get(field.name, 0) >= rows:
+            continue
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=[field.name]):
+            if batch.column(0).null_count < batch.num_rows:
+                samples[field.name] = batch.column(0).drop_null().slice(0, 1)
+                break
+
+    # Two-row table with the schema of the file: pandas gives it the types of the full conversion
+    arrays = []
+    for field in schema:
+        sample = samples.get(field.name, pa.nulls(0, field.type))
+        if null_counts.get(field.name, 0) > 0 or not len(sample):
+            arrays.append(pa.concat_arrays([sample, pa.nulls(2 - len(sample), field.type)]))
+        else:
+            arrays.append(pa.concat_arrays([sample, sample]))
+    typed = pa.Table.from_arrays(arrays, schema=schema).to_pandas()
+
+    info_dict = {"Column": [], "Data_type": [], "No_miss_Qty": [], "%Missing": [], "Missing_Qty": []}
+    for position, field in enumerate(fields):
+        missing = null_counts[field.name]
+        info_dict["Column"].append(typed.columns[position])
+        info_dict["Data_type"].append(typed.iloc[:, position].apply(type).unique())
+        info_dict["No_miss_Qty"].append(rows - missing)
+        info_dict["%Missing"].append(round(missing * 100 / rows, 2) if rows else 0.0)
+        info_dict["Missing_Qty"].append(missing)
+
+    stats = {'rows': rows,
+             'full_null_rows': min(int(round(full_null_rows * scale)), rows) if scan_rows else (rows if not fields else 0),
+             'rows_with_nulls': min(int(round(any_null_rows * scale)), rows) if scan_rows else None,
+             'sampled': sampled, 'read_rows': read_rows}
+    return pd.DataFrame(info_dict), stats
+
+
+def _print_summary_header(title, stats):
+    estimated = ' (estimated from a sample)' if stats.get('sampled') and stats.get('read_rows') is not None else ''
+    print(f"{title} Summary")
+    print("\nTotal rows: ", stats['rows'])
+    print(f"\nTotal full null rows{estimated}: ", stats['full_null_rows'])
+
+
+def data_summ_f(df, title=None, sample_rows=None):
     '''
     Function to provide detailed information about the dtype, null values,
-    and outliers for each column in a DataFrame.
+    and outliers for each column in a DataFrame. See profile_dataframe.
 
     Parameters:
     - df (pd.DataFrame): The DataFrame for which information is to be generated.
     - title (str, optional): Title to be used in the summary. If None, the title will be omitted.
+    - sample_rows (int, optional): Maximum number of values per object column scanned for types. All if None.
 
     Returns:
     - df_info (pd.DataFrame): A DataFrame containing information about each column,
                               including data type, non-missing quantity, percentage of
                               missing values, missing quantity, and information about outliers.
     '''
-    info_dict = {"Column": [], "Data_type": [], "No_miss_Qty": [], "%Missing": [], "Missing_Qty": []}
-
-    for column in df.columns:
-        info_dict["Column"].append(column)
-        info_dict["Data_type"].append(df[column].apply(type).unique())
-        info_dict["No_miss_Qty"].append(df[column].count())
-        info_dict["%Missing"].append(round(df[column].isnull().sum() * 100 / len(df), 2))
-        info_dict['Missing_Qty'].append(df[column].isnull().sum())
-
-  
-    df_info = pd.DataFrame(info_dict)
+    df_info, stats = profile_dataframe(df, sample_rows)
 
     if title:
-        print(f"{title} Summary")
-        print("\nTotal rows: ", len(df))
-        print("\nTotal full null rows: ", df.isna().all(axis=1).sum())
+        _print_summary_header(title, stats)
 
     print(df_info.to_string(index=False))
     print("=====================================")
 
     return df_info
 
-def data_summ_on_parquet(folder_path):
+def data_summ_on_parquet(folder_path, sample_rows=None):
     '''
-    Function to apply data_summ function to each Parquet file in a folder.
+    Function to profile each Parquet file in a folder, one file at a time and without loading the files
+    into pandas (see profile_parquet), printing the same summary as data_summ_f.
 
     Parameters:
     - folder_path (str): The path to the folder containing Parquet files.
+    - sample_rows (int, optional): Maximum number of rows read per file when a file has to be scanned. All if None.
 
     Returns:
     - summaries (list): A list of DataFrames containing the summary information for each Parquet file.
@@ -277,14 +868,12 @@ def data_summ_on_parquet(folder_path):
 
         # Check if the file is a Parquet file
         if file_name.endswith('.parquet'):
-            # Read the Parquet file into a DataFrame
-            df = pq.read_table(file_path).to_pandas()
+            summary, stats = profile_parquet(file_path, sample_rows)
 
-            # Get the title for the DataFrame based on the file name
-            title = file_name.replace('.parquet', '')
-
-            # Apply data_summ function to the DataFrame
-            summary = data_summ_f(df, title=title)
+            # Get the title for the summary based on the file name
+            _print_summary_header(file_name.replace('.parquet', ''), stats)
+            print(summary.to_string(index=False))
+            print("=====================================")
 
             # Append the summary DataFrame to the list
             summaries.append(summary)
@@ -292,38 +881,26 @@ def data_summ_on_parquet(folder_path):
     return summaries
 
 
-def data_summ(df, title=None):
+def data_summ(df, title=None, sample_rows=None):
     '''
     Function to provide detailed information about the dtype, null values,
-    and outliers for each column in a DataFrame.
+    and outliers for each column in a DataFrame. See profile_dataframe.
 
     Parameters:
     - df (pd.DataFrame): The DataFrame for which information is to be generated.
     - title (str, optional): Title to be used in the summary. If None, the title will be omitted.
+    - sample_rows (int, optional): Maximum number of values per object column scanned for types. All if None.
 
     Returns:
     - df_info (pd.DataFrame): A DataFrame containing information about each column,
                               including data type, non-missing quantity, percentage of
                               missing values, missing quantity, and information about outliers.
     '''
-    info_dict = {"Column": [], "Data_type": [], "No_miss_Qty": [], "%Missing": [], "Missing_Qty": []}
-
-    for column in df.columns:
-        info_dict["Column"].append(column)
-        info_dict["Data_type"].append(df[column].apply(type).unique())
-        info_dict["No_miss_Qty"].append(df[column].count())
-        info_dict["%Missing"].append(round(df[column].isnull().sum() * 100 / len(df), 2))
-        info_dict['Missing_Qty'].append(df[column].isnull().sum())
-
-  
-    df_info = pd.DataFrame(info_dict)
+    df_info, stats = profile_dataframe(df, sample_rows)
 
     if title:
-        print(f"{title} Summary")
-        print("\nTotal rows: ", len(df))
-        print("\nTotal full null rows: ", df.isna().all(axis=1).sum())
+        _print_summary_header(title, stats)
 
-    
     return df_info
 
 
@@ -354,63 +931,196 @@ def duplicates(df, column):
     return duplicated_rows_sorted
 
 
-def drop_duplicates(df, column):
-    '''
-    This function counts the null values in each row to organize the dataframe in order of null values, 
-    in order to eliminate duplicate records that have the same value 
-    without affecting the row that has the most valid records.
-    '''
+# Number of rows read at once by drop_duplicates_parquet
+DEDUP_BATCH_SIZE = 65536
 
-     # temporary column 
-    df['temp_index'] = range(len(df))
 
-    # Count null values in each row
-    df['num_null'] = df.isnull().sum(axis=1)
+def _keep_fewest_nulls(keys, null_counts):
+    # Position of the row with the fewest nulls of every key (the first one on ties), found grouping by hash
+    codes = keys.groupby(list(keys.columns), sort=False, dropna=False).ngroup().to_numpy()
+    best = pd.Series(null_counts).groupby(codes, sort=False).idxmin().to_numpy()
+    keep = np.zeros(len(null_counts), dtype=bool)
+    keep[best] = True
+    return keep
 
-    # Sort by the specified column and the number of nulls
-    df = df.sort_values(by=[column, 'num_null'])
 
-    # Drop duplicates, keep the first occurrence
-    df = df.drop_duplicates(subset=column, keep='first')
+def drop_duplicates(df, column):
+    '''
+    Drops the rows that repeat the value of the key column(s), keeping for every key the row with the
+    fewest null values (the first one in case of a tie), so the row with the most valid records survives.
+    Rows are grouped by hash in a single pass, the original order is kept and df is not modified.
 
-    # Sort again by the temporary column
-    df = df.sort_values(by='temp_index')
+    Parameters:
+    - df (pd.DataFrame): The DataFrame to deduplicate.
+    - column (str or list): Key column, or list of key columns.
 
-    # Remove temporary columns
-    df.drop(['temp_index', 'num_null'], axis=1, inplace=True)
+    Returns:
+    - pd.DataFrame: The deduplicated rows in their original order, with a new 0..n-1 index.
+    '''
+    keys = [column] if isinstance(column, str) else list(column)
+    null_counts = df.isna().sum(axis=1).to_numpy()
+    keep = _keep_fewest_nulls(df[keys].reset_index(drop=True), null_counts)
+    return df[keep].reset_index(drop=True)
 
-    # Reset index
-    df.reset_index(drop=True, inplace=True)
 
-    return df
+def drop_duplicates_parquet(file_path, output_path, column, batch_size=DEDUP_BATCH_SIZE):
+    '''
+    Out-of-core version of drop_duplicates for Parquet files larger than memory. A first pass over the file
+    keeps only the key columns and the null count of every row, a second pass writes the kept rows batch
+    by batch, so only one batch of full rows is in memory at a time. The index stored in the file (if any)
+    is kept as is.
 
+    Parameters:
+    - file_path (str): The path to the Parquet file to deduplicate.
+    - output_path (str): The path of the deduplicated Parquet file (written to a temporary file and renamed).
+    - column (str or list): Key column, or list of key columns.
+    - batch_size (int, optional): Number of rows read at once. Defaults to 65536.
 
-def replace_all_nulls(df):
+    Returns:
+    - rows (int): Number of rows written.
     '''
-    Recieves a df as parameter and fills all the null values per column depending on their dtype
+    keys = [column] if isinstance(column, str) else list(column)
+    parquet_file = pq.ParquetFile(file_path)
+    schema = parquet_file.schema_arrow
+    index_columns = {name for name in (schema.pandas_metadata or {}).get('index_columns', []) if isinstance(name, str)}
+    value_columns = [name for name in schema.names if name not in index_columns]
+
+    # First pass: keys and null counts (NaN counted as null, as isna does)
+    key_parts, null_parts = [], []
+    for batch in parquet_file.iter_batches(batch_size=batch_size):
+        null_counts = np.zeros(batch.num_rows, dtype=np.int64)
+        for name in value_columns:
+            null_counts += pc.is_null(batch.column(name), nan_is_null=True).to_numpy(zero_copy_only=False)
+        null_parts.append(null_counts)
+        key_parts.append(pa.Table.from_batches([batch.select(keys)]).to_pandas(ignore_metadata=True))
+    if not key_parts:
+        keep = np.zeros(0, dtype=bool)
+    else:
+        keep = _keep_fewest_nulls(pd.concat(key_parts, ignore_index=True), np.concatenate(null_parts))
+
+    # Second pass: write the kept rows in their original order
+    temp_path = f'{output_path}.tmp'
+    start = 0
+    with pq.ParquetWriter(temp_path, schema) as writer:
+        for batch in parquet_file.iter_batches(batch_size=batch_size):
+            writer.write_batch(batch.filter(pa.array(keep[start:start + batch.num_rows])))
+            start += batch.num_rows
+    os.replace(temp_path, output_path)
+
+    rows = int(keep.sum())
+    print(f'{len(keep) - rows} duplicated rows dropped, {rows} rows saved at {output_path}')
+    return rows
+
+
+# Fill applied to the nulls of every kind of column (see column_kind) when no policy is given for the column.
+# 'mean' and 'median' are computed per column, any other value is used as is; kinds not listed are not filled.
+NULL_FILL_DEFAULTS = {'float': 'mean', 'string': 'No data', 'list': 'No data'}
+
+# Fill statistics computed with one reduction over all the columns that use them
+FILL_STATISTICS = ('mean', 'median')
+
+# Number of non-null values of a mixed object column inspected to tell list columns apart
+KIND_SAMPLE_SIZE = 100
+
+# Kind of an object column from pandas infer_dtype
+_OBJECT_KINDS = {
+    'string': 'string',
+    'empty': 'empty',
+    'floating': 'float',
+    'mixed-integer-float': 'float',
+    'integer': 'integer',
+    'boolean': 'bool',
+    'datetime': 'datetime',
+    'datetime64': 'datetime',
+    'date': 'datetime',
+}
+
+
+def column_kind(series, sample_size=KIND_SAMPLE_SIZE):
     '''
+    Returns the kind of values of a column from its pandas (or Arrow) dtype. Only object columns are
+    looked at: pandas infer_dtype checks their values in C, and columns that mix types are told apart
+    from list columns with a sample of their values.
 
-    for column in df.columns:
-        # Crear una máscara para los valores no nulos
-        mask = df[column].notnull()
-        dtype = df[column][mask].apply(type).unique()
-
-        if dtype[0] == str: 
-            # Usar .loc para asegurar que la operación se aplique correctamente
-            df.loc[:, column] = df.loc[:, column].fillna('No data')
-        elif dtype[0] == float:
-            mean = df[column].mean()
-            # Usar .loc para asignar el valor de la media en los NaN
-            df.loc[:, column] = df.loc[:, column].fillna(mean)
-        elif dtype[0] == list:
-            # Usar .loc para asignar 'No data' a las columnas de listas
-            df.loc[:, column] = df.loc[:, column].fillna('No data')
-
-    return df
-
+    Parameters:
+    - series (pd.Series): The column.
+    - sample_size (int, optional): Number of non-null values of a mixed column inspected. Defaults to 100.
 
+    Returns:
+    - kind (str): 'float', 'integer', 'bool', 'datetime', 'string', 'list', 'category', 'mixed', 'empty' or 'other'.
+    '''
+    dtype = series.dtype
+    if dtype == object:
+        kind = _OBJECT_KINDS.get(pd.api.types.infer_dtype(series, skipna=True))
+        if kind is not None:
+            return kind
+        sample = series.dropna().iloc[:sample_size]
+        return 'list' if len(sample) and all(isinstance(value, list) for value in sample) else 'mixed'
+
+    if isinstance(dtype, pd.ArrowDtype):
+        arrow_type = dtype.pyarrow_dtype
+        if pa.types.is_list(arrow_type) or pa.types.is_large_list(arrow_type):
+            return 'list'
+    if isinstance(dtype, pd.CategoricalDtype):
+        return 'category'
+    if pd.api.types.is_bool_dtype(dtype):
+        return 'bool'
+    if pd.api.types.is_float_dtype(dtype):
+        return 'float'
+    if pd.api.types.is_integer_dtype(dtype):
+        return 'integer'
+    if pd.api.types.is_datetime64_any_dtype(dtype) or pd.api.types.is_timedelta64_dtype(dtype):
+        return 'datetime'
+    if pd.api.types.is_string_dtype(dtype):
+        return 'string'
+    return 'other'
+
+
+def null_fills(df, policy=None, defaults=NULL_FILL_DEFAULTS):
+    '''
+    Computes the value that replace_all_nulls writes in the nulls of every column with nulls.
 
-    
+    Parameters:
+    - df (pd.DataFrame): The DataFrame to fill.
+    - policy (dict, optional): Column -> fill ('mean', 'median', a value, or None to leave the column as is).
+      Takes precedence over the defaults.
+    - defaults (dict, optional): Column kind -> fill, for the columns without policy. Defaults to NULL_FILL_DEFAULTS.
 
+    Returns:
+    - fills (dict): Column -> value, ready for DataFrame.fillna.
+    '''
+    policy = policy or {}
+    missing = df.isna().any()
+    chosen = {}
+    for column in df.columns[missing.to_numpy()]:
+        fill = policy[column] if column in policy else defaults.get(column_kind(df[column]))
+        if fill is not None:
+            chosen[column] = fill
+
+    fills = {column: fill for column, fill in chosen.items() if not (isinstance(fill, str) and fill in FILL_STATISTICS)}
+    for statistic in FILL_STATISTICS:
+        columns = [column for column, fill in chosen.items() if isinstance(fill, str) and fill == statistic]
+        if columns:
+            fills.update(getattr(df[columns], statistic)().to_dict())
+    return fills
+
+
+def replace_all_nulls(df, policy=None, defaults=NULL_FILL_DEFAULTS):
+    '''
+    Recieves a df as parameter and fills all the null values per column depending on their kind (see
+    column_kind and NULL_FILL_DEFAULTS: text and list columns get 'No data', float columns their mean), or
+    as given by policy. The statistics are computed with one reduction and all the fills applied with a
+    single fillna, in place.
 
+    Parameters:
+    - df (pd.DataFrame): The DataFrame to fill. It is modified.
+    - policy (dict, optional): Column -> fill ('mean', 'median', a value, or None to leave the column as is).
+    - defaults (dict, optional): Column kind -> fill, for the columns without policy. Defaults to NULL_FILL_DEFAULTS.
 
+    Returns:
+    - df (pd.DataFrame): The same DataFrame, filled.
+    '''
+    fills = null_fills(df, policy, defaults)
+    if fills:
+        df.fillna(fills, inplace=True)
+    return df
@@ -0,0 +1,283 @@
+import argparse
+import os
+import time
+import numpy as np
+import pandas as pd
+from neighbors import genre_matrix, item_scoring_matrices, map_blocks, row_blocks, top_k_blocks, top_k_rows, user_vectors
+from utility_matrix import UTILITY_MATRIX_FILE, load_utility_matrix
+
+
+# Similarity backends of the neighbor tables (see make_backend):
+# - 'exact': every pair is scored, in blocks of rows (top_k_blocks).
+# - 'lsh': random-hyperplane LSH. Only the entities that share a hash bucket with a row, in any of the
+#   tables, are scored (exactly), so the work grows with n x bucket_size x n_tables instead of n^2.
+ANN_BACKENDS = ('exact', 'lsh')
+
+# Default trade-off of the LSH backend: more tables, larger buckets and multi-probe (also scoring the
+# buckets one bit away) raise recall and cost
+LSH_TABLES = 8
+LSH_BUCKET_SIZE = 256
+LSH_MULTIPROBE = True
+LSH_SEED = 0
+
+# Largest dense score block (rows x candidates) scored at once, 256 MB of float64. Games with the same
+# genres share every bucket, so a bucket can hold a large part of the catalog.
+MAX_BLOCK_CELLS = 2 ** 25
+
+# Rows sampled by recall_report
+RECALL_SAMPLE = 1000
+
+
+class ExactBackend:
+    '''
+    Scores every pair of entities. Used as the baseline of recall_report.
+    '''
+
+    name = 'exact'
+
+    def params(self):
+        return {}
+
+    def top_k(self, left, right, rows, k, block_size=512, workers=1):
+        '''
+        Computes the k highest scores of some rows of left @ right. See neighbors.top_k_blocks.
+        '''
+        return top_k_blocks(left, right, rows, k, block_size=block_size, workers=workers)
+
+
+class LSHBackend:
+    '''
+    Approximate top-k with random-hyperplane LSH (SimHash): each table hashes the entities with the signs of
+    n_bits random projections, and a row is scored only against the entities of its bucket. Neighbors found
+    in the tables are merged, so recall grows with n_tables. Scores are exact, only candidates can be missed.
+
+    Rows are hashed by their left vector and candidates by their right column, so both item modes and the
+    user vectors work: scores are cosine-like (right columns are L2-normalized) and rank like the angle.
+    '''
+
+    name = 'lsh'
+
+    def __init__(self, n_tables=LSH_TABLES, bucket_size=LSH_BUCKET_SIZE, multiprobe=LSH_MULTIPROBE, seed=LSH_SEED):
+        '''
+        Parameters:
+        - n_tables (int, optional): Number of hash tables. Defaults to 8.
+        - bucket_size (int, optional): Target number of entities per bucket, sets the number of hash bits
+          to log2(n / bucket_size). Defaults to 256.
+        - multiprobe (bool, optional): Also score the buckets whose code differs in one bit, about
+          n_bits + 1 times more candidates per table. Defaults to True.
+        - seed (int, optional): Seed of the random projections. Defaults to 0.
+        '''
+        if n_tables < 1 or bucket_size < 1:
+            raise ValueError('n_tables and bucket_size must be positive')
+        self.n_tables = n_tables
+        self.bucket_size = bucket_size
+        self.multiprobe = bool(multiprobe)
+        self.seed = seed
+
+    def params(self):
+        return {'n_tables': self.n_tables, 'bucket_size': self.bucket_size, 'multiprobe': self.multiprobe, 'seed': self.seed}
+
+    def n_bits(self, n_entities):
+        # At most 62 bits, so codes fit in int64
+        return int(min(62, max(1, np.ceil(np.log2(max(n_entities, 1) / self.bucket_size)))))
+
+    def top_k(self, left, right, rows, k, block_size=512, workers=1):
+        '''
+        Computes approximately the k highest scores of some rows of left @ right. Row i of left and column i
+        of right are the same entity, which is never its own neighbor.
+
+        Parameters:
+        - left (scipy.sparse.csr_matrix): (n_entities, n_features) matrix.
+        - right (scipy.sparse.csc_matrix): (n_features, n_entities) matrix.
+        - rows (np.ndarray): Rows to score.
+        - k (int): Number of neighbors to keep per row.
+        - block_size (int, optional): Rows of a bucket scored at once.
+        - workers (int, optional): Number of processes hashing and scoring tables in parallel. Defaults to 1.
+
+        Returns:
+        - tuple: (neighbors, scores) arrays of shape (len(rows), k), padded with -1 and nan.
+        '''
+        rows = np.asarray(rows, dtype=np.int64)
+        n_bits = self.n_bits(right.shape[1])
+        seeds = [self.seed + table for table in range(self.n_tables)]
+
+        neighbors = np.full((len(rows), k), -1, dtype=np.int32)
+        scores = np.full((len(rows), k), np.nan, dtype=np.float32)
+        for table_neighbors, table_scores in map_blocks(_lsh_table, left, right, seeds, workers, rows, k, n_bits,
+                                                         self.multiprobe, block_size):
+            neighbors, scores = merge_top_k(neighbors, scores, table_neighbors, table_scores, k)
+        return neighbors, scores
+
+
+def _hash_codes(vectors, projections):
+    # Sign bits of the projections packed in one integer per vector
+    signs = np.asarray(vectors @ projections) > 0
+    return signs.astype(np.int64) @ (np.int64(1) << np.arange(projections.shape[1], dtype=np.int64))
+
+
+def _lsh_table(left, right, seed, rows, k, n_bits, multiprobe, block_size):
+    # Top-k of the rows within their bucket (and the buckets one bit away with multiprobe) of one hash table
+    projections = np.random.default_rng(seed).standard_normal((left.shape[1], n_bits))
+    entity_codes = _hash_codes(right.T, projections)
+    row_codes = _hash_codes(left[rows], projections)
+
+    entity_order = np.argsort(entity_codes, kind='stable')
+    sorted_codes = entity_codes[entity_order]
+    row_order = np.argsort(row_codes, kind='stable')
+    bucket_starts = np.flatnonzero(np.r_[True, row_codes[row_order][1:] != row_codes[row_order][:-1]])
+
+    flips = np.r_[0, np.int64(1) << np.arange(n_bits, dtype=np.int64)] if multiprobe else np.zeros(1, dtype=np.int64)
+
+    neighbors = np.full((len(rows), k), -1, dtype=np.int32)
+    scores = np.full((len(rows), k), np.nan, dtype=np.float32)
+    for start, stop in zip(bucket_starts, np.r_[bucket_starts[1:], len(rows)]):
+        probes = row_codes[row_order[start]] ^ flips
+        candidates = np.concatenate([entity_order[first:last] for first, last in zip(
+            np.searchsorted(sorted_codes, probes), np.searchsorted(sorted_codes, probes, side='right'))])
+        if not len(candidates):
+            continue
+        candidate_right = right[:, candidates]
+        rows_per_block = max(1, min(block_size, MAX_BLOCK_CELLS // len(candidates)))
+        for positions in row_blocks(row_order[start:stop], rows_per_block):
+            block = (left[rows[positions]] @ candidate_right).toarray()
+            # The entity itself is never its own neighbor
+            self_rows, self_cols = np.nonzero(rows[positions][:, None] == candidates[None, :])
+            block[self_rows, self_cols] = -np.inf
+            block_cols, block_scores = top_k_rows(block, k)
+            valid = block_cols >= 0
+            neighbors[positions] = np.where(valid, candidates[np.maximum(block_cols, 0)], -1)
+            scores[positions] = block_scores
+    return neighbors, scores
+
+
+def merge_top_k(neighbors_a, scores_a, neighbors_b, scores_b, k):
+    '''
+    Merges two top-k tables of the same rows, keeping each neighbor once.
+
+    Parameters:
+    - neighbors_a / neighbors_b (np.ndarray): (n_rows, k) neighbor arrays, -1 for missing neighbors.
+    - scores_a / scores_b (np.ndarray): (n_rows, k) score arrays, nan for missing neighbors.
+    - k (int): Number of neighbors to keep per row.
+
+    Returns:
+    - tuple: (neighbors, scores) arrays of shape (n_rows, k), sorted by descending score and ascending
+      neighbor for ties, as top_k_rows.
+    '''
+    neighbors = np.concatenate([neighbors_a, neighbors_b], axis=1).astype(np.int64)
+    scores = np.concatenate([scores_a, scores_b], axis=1).astype(np.float64)
+    n_rows, width = neighbors.shape
+    row_ids = np.repeat(np.arange(n_rows), width)
+
+    # Duplicates (and padding) go last: found by sorting every row by neighbor
+    flat_neighbors, flat_scores = neighbors.ravel(), scores.ravel()
+    order = np.lexsort((flat_neighbors, row_ids))
+    repeated = np.r_[False, (flat_neighbors[order][1:] == flat_neighbors[order][:-1]) & (row_ids[order][1:] == row_ids[order][:-1])]
+    flat_scores[order[repeated]] = np.nan
+    flat_scores[flat_neighbors < 0] = np.nan
+
+    ranked = np.where(np.isnan(flat_scores), np.inf, -flat_scores)
+    order = np.lexsort((flat_neighbors, ranked, row_ids)).reshape(n_rows, width)[:, :k]
+    top_scores = flat_scores[order]
+    top_neighbors = np.where(np.isnan(top_scores), -1, flat_neighbors[order])
+    return top_neighbors.astype(np.int32), top_scores.astype(np.float32)
+
+
+def make_backend(name='exact', **params):
+    '''
+    Creates a similarity backend for the neighbor tables.
+
+    Parameters:
+    - name (str, optional): 'exact' (default) or 'lsh'. See ANN_BACKENDS.
+    - params: Options of the backend (n_tables, bucket_size, multiprobe and seed for 'lsh'). None values are ignored.
+
+    Returns:
+    - ExactBackend or LSHBackend: Object with a top_k(left, right, rows, k, block_size, workers) method.
+    '''
+    params = {key: value for key, value in params.items() if value is not None}
+    if name == 'exact':
+        return ExactBackend()
+    if name == 'lsh':
+        return LSHBackend(**params)
+    raise ValueError(f'Unknown backend {name!r}. Available: {ANN_BACKENDS}')
+
+
+def recall_report(left, right, backends, k=20, n_values=(5, 10), sample=RECALL_SAMPLE, seed=0, block_size=512, workers=1):
+    '''
+    Measures the recall and the time of approximate backends against the exact scores on a sample of rows.
+    A neighbor counts as found when its score reaches the k-th (n-th) exact score, so ties are not misses.
+
+    Parameters:
+    - left / right (scipy.sparse matrix): Scoring matrices (see neighbors.item_scoring_matrices / user_vectors).
+    - backends (list): Backends to measure.
+    - k (int, optional): Neighbors per row. Defaults to 20.
+    - n_values (tuple, optional): Cut-offs of the recall columns besides k. Defaults to (5, 10).
+    - sample (int, optional): Number of sampled rows. Defaults to 1000.
+    - seed (int, optional): Seed of the sample. Defaults to 0.
+    - block_size / workers (int, optional): Passed to the backends.
+
+    Returns:
+    - pd.DataFrame: One row per backend: parameters, recall@n, milliseconds per row and speedup over exact.
+    '''
+    n_entities = left.shape[0]
+    block_size = max(1, min(block_size, MAX_BLOCK_CELLS // n_entities))
+    rows = np.sort(np.random.default_rng(seed).choice(n_entities, size=min(sample, n_entities), replace=False))
+    cutoffs = sorted({n for n in n_values if n < k} | {k})
+
+    start = time.perf_counter()
+    _, exact_scores = top_k_blocks(left, right, rows, k, block_size=block_size, workers=workers)
+    exact_ms = (time.perf_counter() - start) * 1000 / len(rows)
+
+    report = []
+    for backend in [ExactBackend()] + list(backends):
+        start = time.perf_counter()
+        _, scores = backend.top_k(left, right, rows, k, block_size=block_size, workers=workers)
+        ms = (time.perf_counter() - start) * 1000 / len(rows)
+
+        result = {'backend': backend.name, **backend.params()}
+        for n in cutoffs:
+            # n-th exact score of every row; rows with fewer than n neighbors count the ones they have
+            expected = np.sum(~np.isnan(exact_scores[:, :n]), axis=1)
+            threshold = np.nan_to_num(exact_scores[:, n - 1], nan=-np.inf) - 1e-6
+            found = np.minimum(np.sum(np.nan_to_num(scores[:, :n], nan=-np.inf) >= threshold[:, None], axis=1), expected)
+            result[f'recall@{n}'] = round(found.sum() / max(expected.sum(), 1), 4)
+        result['ms_per_row'] = round(ms, 4)
+        result['speedup'] = round(exact_ms / ms, 2) if ms > 0 else None
+        report.append(result)
+    return pd.DataFrame(report)
+
+
+def _scoring_matrices(kind, data_dir, mode):
+    # Vectors of the neighbor tables of a data folder: genre vectors of df_mod_game or user rating vectors
+    if kind == 'items':
+        df_mod_game = pd.read_parquet(os.path.join(data_dir, 'df_mod_game.parquet'), columns=['Item_name', 'Genres'])
+        _, matrix = genre_matrix(df_mod_game)
+        return item_scoring_matrices(matrix, mode)
+
+    utility_path = os.path.join(data_dir, UTILITY_MATRIX_FILE)
+    if os.path.exists(utility_path):
+        vectors = user_vectors(load_utility_matrix(utility_path).matrix)
+    else:
+        from neighbors import user_matrix
+        _, vectors = user_matrix(pd.read_parquet(os.path.join(data_dir, 'umatrix_norm.parquet')))
+    return vectors, vectors.T.tocsc()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recall and speed of the LSH backend against the exact neighbor tables.')
+    parser.add_argument('kind', choices=['items', 'users'], help='items: genre vectors of df_mod_game, users: rating vectors of umatrix_norm')
+    parser.add_argument('--data-dir', default=os.environ.get('GAMES_DATA_DIR', 'Data'))
+    parser.add_argument('--mode', choices=['cosine', 'second_order'], default='second_order', help='Scoring mode of the items')
+    parser.add_argument('--tables', type=int, nargs='+', default=[LSH_TABLES], help='Numbers of hash tables to try')
+    parser.add_argument('--bucket-size', type=int, nargs='+', default=[LSH_BUCKET_SIZE], help='Bucket sizes to try')
+    parser.add_argument('--multiprobe', type=int, nargs='+', choices=[0, 1], default=[int(LSH_MULTIPROBE)], help='1 to probe the buckets one bit away')
+    parser.add_argument('--k', type=int, default=20)
+    parser.add_argument('--sample', type=int, default=RECALL_SAMPLE)
+    parser.add_argument('--seed', type=int, default=LSH_SEED)
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args()
+
+    left, right = _scoring_matrices(args.kind, args.data_dir, args.mode)
+    backends = [LSHBackend(n_tables, bucket_size, multiprobe, args.seed)
+                for n_tables in args.tables for bucket_size in args.bucket_size for multiprobe in args.multiprobe]
+    print(f'{args.kind}: {left.shape[0]} entities, {left.shape[1]} features')
+    print(recall_report(left, right, backends, k=args.k, sample=args.sample, seed=args.seed, workers=args.workers).to_string(index=False))
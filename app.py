@@ -1,9 +1,4 @@
 import pandas as pd
-import operator
-from wordcloud import WordCloud
-import matplotlib.pyplot as plt
-import io
-import streamlit as st
 
 import streamlit as st
 from functions import (
@@ -11,8 +6,10 @@ from functions import (
     top_5_games_by_playtime,
     bottom_3_games_by_playtime,
     similar_user_recs,
-    get_recommendations_by_name
+    get_recommendations_by_name,
+    suggest_game_names
 )
+from instrumentation import format_trace, last_trace, prometheus_text, set_allocations, start_profiler, stop_profiler, get_profiler
 
 
 # Definición de la función para mostrar el dashboard
@@ -22,6 +19,19 @@ def dashboard():
     '''
     st.markdown(enlace_embebido, unsafe_allow_html=True)
 
+# Muestra las recomendaciones por nombre de juego y su wordcloud
+def mostrar_recomendaciones_juego(game_name):
+    result = get_recommendations_by_name(game_name)
+    if isinstance(result, str):
+        st.write(result)
+        return None
+
+    recommendations_df, wordcloud_png = result
+    if wordcloud_png is not None:
+        st.image(wordcloud_png, caption=f'Wordcloud for {game_name}')
+    st.write(recommendations_df)
+    return recommendations_df
+
 # Título de la aplicación
 st.title('Games Market Analysis')
 
@@ -61,9 +71,14 @@ elif option == 'Bottom 3 Games by Playtime':
 
 elif option == 'Game Recommendations by Name':
     game_name = st.sidebar.text_input('Introduce el nombre del juego:')
+
+    # Autocompletado: sugerencias a partir del índice de nombres, sin recorrer la tabla
+    suggestions = suggest_game_names(game_name)
+    if suggestions:
+        game_name = st.sidebar.selectbox('Sugerencias:', suggestions)
+
     if st.sidebar.button('Obtener recomendaciones'):
-        result = get_recommendations_by_name(game_name)
-        st.write(result)
+        mostrar_recomendaciones_juego(game_name)
 
 
 elif option == 'Similar User Recommendations':
@@ -81,22 +96,22 @@ elif option == 'Similar User Recommendations':
         selected_item = st.selectbox('Selecciona un ítem para obtener recomendaciones adicionales:', st.session_state.similar_recs['Item_name'].tolist(), key='item_select') 
         if st.button('Obtener recomendaciones por nombre del juego'):
             # Obtener recomendaciones basadas en el ítem seleccionado
-            game_recommendations = get_recommendations_by_name(selected_item)
-            st.write(game_recommendations)
+            game_recommendations = mostrar_recomendaciones_juego(selected_item)
 
             # Guardar las nuevas recomendaciones en session_state
-            st.session_state.current_recommendations = game_recommendations
+            if game_recommendations is not None:
+                st.session_state.current_recommendations = game_recommendations
 
     # Mostrar un selectbox para las recomendaciones actuales si existen
     if 'current_recommendations' in st.session_state:
         selected_game = st.selectbox('Selecciona un ítem de las recomendaciones:', st.session_state.current_recommendations['Item_name'].tolist(), key='game_select')
         if st.button('Obtener más recomendaciones'):
             # Obtener más recomendaciones basadas en el ítem seleccionado
-            more_recommendations = get_recommendations_by_name(selected_game)
-            st.write(more_recommendations)
+            more_recommendations = mostrar_recomendaciones_juego(selected_game)
 
             # Actualizar las recomendaciones actuales
-            st.session_state.current_recommendations = more_recommendations
+            if more_recommendations is not None:
+                st.session_state.current_recommendations = more_recommendations
 
 
 
@@ -104,6 +119,32 @@ elif option == 'Similar User Recommendations':
 elif option == 'Ver Dashboard':
     dashboard()
 
+# Panel de rendimiento: traza de la última consulta, métricas y profiler opcional
+if st.sidebar.checkbox('Mostrar métricas de rendimiento'):
+    # El contador y el profiler son del proceso (compartidos por todas las sesiones): solo se cambian
+    # cuando esta sesión cambia su casilla, no en cada recarga de la página
+    contar = st.sidebar.checkbox('Contar asignaciones de memoria por etapa (más lento)')
+    if contar != st.session_state.get('contar_previo', False):
+        set_allocations('stage' if contar else 'off')
+        st.session_state.contar_previo = contar
+    perfilando = get_profiler() is not None and get_profiler().running
+    perfilar = st.sidebar.checkbox('Activar profiler de muestreo', value=perfilando)
+    if perfilar != st.session_state.get('perfilar_previo', perfilando):
+        if perfilar:
+            start_profiler()
+        else:
+            stop_profiler()
+        st.session_state.perfilar_previo = perfilar
+
+    with st.expander('Traza de la última consulta', expanded=True):
+        trace = last_trace()
+        st.code(format_trace(trace) if trace is not None else 'Todavía no hay consultas.')
+    with st.expander('Métricas (formato Prometheus)'):
+        st.code(prometheus_text())
+    if get_profiler() is not None:
+        with st.expander('Funciones más muestreadas por el profiler'):
+            st.dataframe(pd.DataFrame(get_profiler().top_functions(), columns=['Función', 'Muestras']))
+
 # Para ejecutar el despliegue en Streamlit
 # Utiliza el siguiente comando en la terminal:
 # streamlit run app.py
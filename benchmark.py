@@ -0,0 +1,417 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from scipy import sparse
+from data_loader import DATA_DIR, DATASETS
+from neighbors import ITEM_MODES, USER_NEIGHBORS_FILE, decode_labels, make_neighbor_index, save_neighbors
+from utility_matrix import UTILITY_MATRIX_FILE, from_sparse, save_utility_matrix
+
+
+# Folder with the synthetic data folders (one per scale) and the default results
+BENCHMARK_DIR = os.environ.get('GAMES_BENCHMARK_DIR', 'benchmarks')
+
+# Public functions of functions.py that are measured, with the kind of argument of each call
+FUNCTIONS = {
+    'top_genres_by_playtime': 'genres_year',
+    'top_5_games_by_playtime': 'games_year',
+    'bottom_3_games_by_playtime': 'games_year',
+    'similar_user_recs': 'user',
+    'get_recommendations_by_name': 'item_name',
+}
+
+# Metrics compared with the baseline, with the increase below which a change is treated as noise
+COMPARED_METRICS = {'cold_start_s': 0.05, 'p50_ms': 0.5, 'p95_ms': 0.5, 'p99_ms': 1.0, 'peak_rss_mb': 10.0}
+
+# Shape of the synthetic datasets: reviews per game in models and neighbors per game and per user
+SYNTHETIC_REVIEWS_PER_ITEM = 3
+SYNTHETIC_K = 20
+SYNTHETIC_FILE = 'synthetic.json'
+
+_RATINGS = ['Overwhelmingly Positive', 'Very Positive', 'Mostly Positive', 'Mixed', 'Mostly Negative']
+_WORDS = ('game fun great story graphics boring buggy classic multiplayer puzzle hard easy music '
+          'worth price friends hours recommend level boss world open combat').split()
+
+
+def _copies(labels, scale):
+    # The labels followed by scale - 1 renamed copies ('name #1', 'name #2', ...)
+    labels = pd.Series(labels, dtype=object).reset_index(drop=True)
+    return pd.concat([labels] + [labels + f' #{copy}' for copy in range(1, scale)], ignore_index=True)
+
+
+def _random_neighbors(labels, k, rng):
+    # Neighbor table with the shape of a real one; the benchmark only depends on its size
+    n = len(labels)
+    neighbors = rng.integers(0, n, size=(n, min(k, n)), dtype=np.int64)
+    scores = -np.sort(-rng.random((n, min(k, n)), dtype=np.float32), axis=1)
+    return make_neighbor_index(labels, neighbors, scores)
+
+
+def make_synthetic_data(output_dir, scale, source_dir=None, seed=0):
+    '''
+    Writes a synthetic data folder with scale times the games and users of a real one, with the datasets read
+    by functions.py plus the precomputed artifacts of the recommenders (compact utility matrix and top-k neighbor
+    tables), so the engine serves it without building anything.
+
+    Games are renamed copies of the real ones (same genres and years, jittered playtime), users rate as many
+    games as a random real user, and models has a few synthetic reviews per game. Neighbor tables are random:
+    query costs depend on their size, not on their content.
+
+    Parameters:
+    - output_dir (str): Folder to write.
+    - scale (int): Multiplier of the number of games and users.
+    - source_dir (str, optional): Real data folder the shapes are taken from. Defaults to DATA_DIR.
+    - seed (int, optional): Seed of the random data. Defaults to 0.
+
+    Returns:
+    - dict: Description of the folder (scale, seed, number of games, users and ratings), also saved as synthetic.json.
+    '''
+    source_dir = source_dir or DATA_DIR
+    rng = np.random.default_rng(seed)
+    os.makedirs(output_dir, exist_ok=True)
+
+    def source(name):
+        return pd.read_parquet(os.path.join(source_dir, DATASETS[name]))
+
+    def write(dataframe, name):
+        dataframe.to_parquet(os.path.join(output_dir, DATASETS[name]), index=False)
+
+    # Playtime datasets: the genre totals grow with the number of games
+    genres_playtime = source('genres_playtime')
+    genres_playtime['Playtime_Millon_Hours'] = genres_playtime['Playtime_Millon_Hours'] * scale
+    write(genres_playtime, 'genres_playtime')
+
+    games_playtime = source('games_playtime')
+    games = pd.concat([games_playtime] * scale, ignore_index=True)
+    games['Item_name'] = _copies(games_playtime['Item_name'], scale)
+    games['Item_id'] = pd.array(np.arange(len(games)), dtype='Int64')
+    games['Playtime'] = np.round(games['Playtime'].to_numpy() * rng.lognormal(0, 0.5, len(games)))
+    write(games, 'games_playtime')
+
+    mod_game = source('df_mod_game')
+    df_mod_game = pd.concat([mod_game] * scale, ignore_index=True)
+    df_mod_game['Item_name'] = _copies(mod_game['Item_name'], scale)
+    write(df_mod_game, 'df_mod_game')
+
+    # models: a few reviews per game by random users, with the genres of df_mod_game
+    umatrix = source('umatrix_norm')
+    ratings_per_user = (umatrix.to_numpy() != 0).sum(axis=0)
+    users = _copies(umatrix.columns, scale).to_numpy(dtype=object)
+    del umatrix
+
+    item_genres = df_mod_game.groupby('Item_name', sort=True)['Genres'].agg(', '.join)
+    items = item_genres.index.to_numpy(dtype=object)
+    reviews = np.array([' '.join(rng.choice(_WORDS, 12)) for _ in range(1000)], dtype=object)
+    rows = np.repeat(np.arange(len(items)), SYNTHETIC_REVIEWS_PER_ITEM)
+    write(pd.DataFrame({
+        'Item_name': items[rows],
+        'Item_id': rows,
+        'User_id': users[rng.integers(0, len(users), len(rows))],
+        'Review': reviews[rng.integers(0, len(reviews), len(rows))],
+        'Genres': item_genres.to_numpy(dtype=object)[rows],
+        'Rating': np.array(_RATINGS, dtype=object)[rows % len(_RATINGS)],
+        'Ranking': np.round(rng.uniform(0, 3, len(items)), 2)[rows],
+    }), 'models')
+
+    # Compact item x user utility matrix: every user rates as many games as a random real user
+    counts = np.minimum(rng.choice(ratings_per_user, len(users)), len(items))
+    indptr = np.concatenate([[0], np.cumsum(counts)])
+    matrix = sparse.csc_matrix((rng.uniform(0.01, 1, indptr[-1]), rng.integers(0, len(items), indptr[-1]), indptr),
+                               shape=(len(items), len(users)))
+    matrix.sum_duplicates()
+    matrix.data = np.minimum(matrix.data, 1)
+    save_utility_matrix(from_sparse(matrix, items, users), os.path.join(output_dir, UTILITY_MATRIX_FILE))
+
+    save_neighbors(_random_neighbors(users, SYNTHETIC_K, rng), os.path.join(output_dir, USER_NEIGHBORS_FILE))
+    item_neighbors = _random_neighbors(items, SYNTHETIC_K, rng)
+    for mode in ITEM_MODES:
+        save_neighbors(item_neighbors, os.path.join(output_dir, f'item_neighbors_{mode}.npz'))
+
+    description = {'scale': scale, 'seed': seed, 'source': os.path.abspath(source_dir),
+                   'items': len(items), 'users': len(users), 'ratings': int(matrix.nnz)}
+    with open(os.path.join(output_dir, SYNTHETIC_FILE), 'w', encoding='utf-8') as f:
+        json.dump(description, f, indent=2)
+    print(f'Synthetic data x{scale} ({len(items)} games, {len(users)} users, {matrix.nnz} ratings) written to {output_dir}')
+    return description
+
+
+def dataset_dir(name, benchmark_dir=None, source_dir=None, seed=0):
+    '''
+    Returns the data folder of a benchmark dataset: 'data' is the real data folder, 'x<N>' the synthetic folder
+    scaled N times (generated on first use).
+
+    Parameters:
+    - name (str): 'data' or 'x<N>' (e.g. 'x10').
+    - benchmark_dir (str, optional): Folder of the synthetic folders. Defaults to BENCHMARK_DIR.
+    - source_dir (str, optional): Real data folder. Defaults to DATA_DIR.
+    - seed (int, optional): Seed of the synthetic data. Defaults to 0.
+
+    Returns:
+    - str: Path of the data folder.
+    '''
+    source_dir = source_dir or DATA_DIR
+    if name == 'data':
+        return source_dir
+    if not (name.startswith('x') and name[1:].isdigit() and int(name[1:]) > 0):
+        raise ValueError(f"Unknown dataset {name!r}, expected 'data' or 'x<scale>' (e.g. 'x10')")
+
+    folder = os.path.join(benchmark_dir or BENCHMARK_DIR, f'data_{name}')
+    description_path = os.path.join(folder, SYNTHETIC_FILE)
+    if os.path.exists(description_path):
+        with open(description_path, encoding='utf-8') as f:
+            description = json.load(f)
+        if description['scale'] == int(name[1:]) and description['seed'] == seed:
+            return folder
+    make_synthetic_data(folder, int(name[1:]), source_dir=source_dir, seed=seed)
+    return folder
+
+
+def _query_pools(data_dir):
+    # Arguments of every kind of call, read from the data folder (None when the data is missing)
+    def column(name, column_name):
+        file_path = os.path.join(data_dir, DATASETS[name])
+        if not os.path.exists(file_path):
+            return None
+        values = pq.read_table(file_path, columns=[column_name]).column(0).drop_null().unique()
+        return values.to_pylist()
+
+    users = None
+    utility_path = os.path.join(data_dir, UTILITY_MATRIX_FILE)
+    umatrix_path = os.path.join(data_dir, DATASETS['umatrix_norm'])
+    if os.path.exists(utility_path):
+        with np.load(utility_path) as data:
+            users = decode_labels(data['users'])
+    elif os.path.exists(umatrix_path):
+        schema = pq.read_schema(umatrix_path)
+        index_columns = (schema.pandas_metadata or {}).get('index_columns', [])
+        users = [name for name in schema.names if name not in index_columns]
+
+    item_names = column('models', 'Item_name')
+    has_item_neighbors = (os.path.exists(os.path.join(data_dir, DATASETS['df_mod_game']))
+                          or any(os.path.exists(os.path.join(data_dir, f'item_neighbors_{mode}.npz')) for mode in ITEM_MODES))
+    return {
+        'genres_year': column('genres_playtime', 'Release'),
+        'games_year': column('games_playtime', 'Release'),
+        # Both recommenders read the game metadata of models
+        'user': users if item_names is not None else None,
+        'item_name': item_names if has_item_neighbors else None,
+    }
+
+
+def _percentile_ms(latencies, q):
+    return round(float(np.percentile(latencies, q)) * 1000, 3)
+
+
+def _peak_rss_mb():
+    # VmHWM belongs to the address space of the process, so unlike ru_maxrss it does not keep the
+    # peak of the parent process that was forked before exec
+    try:
+        with open('/proc/self/status', encoding='ascii') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return round(peak_rss / 2 ** 20, 1)
+
+
+def run_worker(function_name, queries):
+    '''
+    Measures one function in the current process, which must be fresh (see benchmark_function): the first call
+    includes the import of functions.py and the lazy loading of the data, the other calls are timed one by one.
+
+    Parameters:
+    - function_name (str): Name of the function of functions.py.
+    - queries (list): Argument of every call, the first one being the cold call.
+
+    Returns:
+    - dict: cold_start_s, calls, p50_ms, p95_ms, p99_ms, throughput_rps (sequential calls per second) and peak_rss_mb.
+    '''
+    start = time.perf_counter()
+    import functions
+    function = getattr(functions, function_name)
+    function(queries[0])
+    cold_start = time.perf_counter() - start
+
+    latencies = []
+    for query in queries[1:]:
+        call_start = time.perf_counter()
+        function(query)
+        latencies.append(time.perf_counter() - call_start)
+    latencies = np.array(latencies or [cold_start])
+
+    peak_rss_mb = _peak_rss_mb()
+
+    return {
+        'cold_start_s': round(cold_start, 4),
+        'calls': len(queries) - 1,
+        'p50_ms': _percentile_ms(latencies, 50),
+        'p95_ms': _percentile_ms(latencies, 95),
+        'p99_ms': _percentile_ms(latencies, 99),
+        'throughput_rps': round(len(latencies) / latencies.sum(), 1),
+        'peak_rss_mb': peak_rss_mb,
+    }
+
+
+def benchmark_function(data_dir, function_name, queries):
+    '''
+    Measures a function of functions.py on a data folder in a new Python process, so cold start and peak
+    memory are those of a fresh server process. Rendered wordclouds go to a temporary folder, so every run
+    starts with an empty wordcloud cache, and the result cache is off, so repeated queries are computed.
+
+    Parameters:
+    - data_dir (str): Data folder served by the engine.
+    - function_name (str): Name of the function of functions.py.
+    - queries (list): Argument of every call, the first one being the cold call.
+
+    Returns:
+    - dict: The metrics of run_worker.
+    '''
+    with tempfile.TemporaryDirectory() as temp_dir:
+        spec_path = os.path.join(temp_dir, 'spec.json')
+        result_path = os.path.join(temp_dir, 'result.json')
+        with open(spec_path, 'w', encoding='utf-8') as f:
+            json.dump({'function': function_name, 'queries': queries, 'output': result_path}, f)
+
+        env = dict(os.environ, GAMES_DATA_DIR=os.path.abspath(data_dir),
+                   GAMES_WORDCLOUD_DIR=os.path.join(temp_dir, 'wordclouds'), GAMES_RESULT_CACHE_SIZE='0')
+        subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', spec_path], env=env, check=True,
+                       cwd=os.path.dirname(os.path.abspath(__file__)))
+        with open(result_path, encoding='utf-8') as f:
+            return json.load(f)
+
+
+def run_benchmarks(datasets=('data', 'x10', 'x100'), functions=None, calls=200, seed=0, benchmark_dir=None, source_dir=None):
+    '''
+    Runs every function on every dataset, each one in a fresh process, with calls random arguments taken from
+    the dataset (the same ones for a given seed).
+
+    Parameters:
+    - datasets (list, optional): Dataset names, see dataset_dir. Defaults to the real data plus x10 and x100.
+    - functions (list, optional): Names of the functions to measure. Defaults to FUNCTIONS.
+    - calls (int, optional): Timed calls per function, after the cold call. Defaults to 200.
+    - seed (int, optional): Seed of the arguments and of the synthetic data. Defaults to 0.
+    - benchmark_dir (str, optional): Folder of the synthetic folders. Defaults to BENCHMARK_DIR.
+    - source_dir (str, optional): Real data folder. Defaults to DATA_DIR.
+
+    Returns:
+    - dict: Results with the environment and, per dataset and function, the metrics or the reason it was skipped.
+    '''
+    functions = list(functions or FUNCTIONS)
+    results = {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'calls': calls,
+        'seed': seed,
+        'datasets': {},
+    }
+
+    for name in datasets:
+        data_dir = dataset_dir(name, benchmark_dir, source_dir, seed)
+        pools = _query_pools(data_dir)
+        dataset_results = results['datasets'][name] = {}
+        for function_name in functions:
+            pool = pools[FUNCTIONS[function_name]]
+            if not pool:
+                dataset_results[function_name] = {'skipped': f'no data for {FUNCTIONS[function_name]} queries in {data_dir}'}
+                print(f'{name} {function_name}: skipped, {dataset_results[function_name]["skipped"]}')
+                continue
+
+            rng = np.random.default_rng(seed)
+            queries = [pool[i] for i in rng.integers(0, len(pool), calls + 1)]
+            metrics = dataset_results[function_name] = benchmark_function(data_dir, function_name, queries)
+            print(f"{name} {function_name}: cold {metrics['cold_start_s']} s, p50 {metrics['p50_ms']} ms, "
+                  f"p95 {metrics['p95_ms']} ms, p99 {metrics['p99_ms']} ms, {metrics['throughput_rps']} calls/s, "
+                  f"peak RSS {metrics['peak_rss_mb']} MB")
+    return results
+
+
+def compare_with_baseline(results, baseline, tolerance=0.25):
+    '''
+    Finds the regressions of a benchmark run against a saved baseline: metrics of COMPARED_METRICS that grew
+    more than tolerance (relative) and more than the noise floor of the metric (absolute).
+
+    Parameters:
+    - results (dict): Output of run_benchmarks.
+    - baseline (dict): A previous output of run_benchmarks.
+    - tolerance (float, optional): Allowed relative increase. Defaults to 0.25 (25%).
+
+    Returns:
+    - list: One dict per regression (dataset, function, metric, baseline, current, change).
+    '''
+    regressions = []
+    for dataset, functions in results['datasets'].items():
+        for function_name, metrics in functions.items():
+            previous = baseline.get('datasets', {}).get(dataset, {}).get(function_name, {})
+            for metric, noise in COMPARED_METRICS.items():
+                old, new = previous.get(metric), metrics.get(metric)
+                if old is None or new is None:
+                    continue
+                if new > old * (1 + tolerance) and new - old > noise:
+                    regressions.append({'dataset': dataset, 'function': function_name, 'metric': metric,
+                                        'baseline': old, 'current': new, 'change': round(new / old - 1, 3) if old else None})
+    return regressions
+
+
+def _save_json(data, file_path):
+    if os.path.dirname(file_path):
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(f'{file_path}.tmp', 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    os.replace(f'{file_path}.tmp', file_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the public functions of functions.py on the real and synthetic data.')
+    parser.add_argument('--datasets', nargs='+', default=['data', 'x10', 'x100'],
+                        help="'data' (the real data folder) and/or synthetic scales 'x<N>' (default: data x10 x100)")
+    parser.add_argument('--functions', nargs='+', choices=list(FUNCTIONS), default=None)
+    parser.add_argument('--calls', type=int, default=200, help='Timed calls per function after the cold call')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', default=None, help='Real data folder, defaults to Data/ (or GAMES_DATA_DIR)')
+    parser.add_argument('--benchmark-dir', default=None, help='Folder of the synthetic data, defaults to benchmarks/ (or GAMES_BENCHMARK_DIR)')
+    parser.add_argument('--output', default=None, help='Results file, defaults to results.json in the benchmark folder')
+    parser.add_argument('--save-baseline', metavar='PATH', default=None, help='Also save the results as the baseline')
+    parser.add_argument('--baseline', metavar='PATH', default=None, help='Compare with a baseline, exit with 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative increase of a metric (default 0.25)')
+    parser.add_argument('--worker', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        with open(args.worker, encoding='utf-8') as f:
+            spec = json.load(f)
+        _save_json(run_worker(spec['function'], spec['queries']), spec['output'])
+        raise SystemExit(0)
+
+    benchmark_results = run_benchmarks(args.datasets, args.functions, args.calls, args.seed, args.benchmark_dir, args.data_dir)
+    output = args.output or os.path.join(args.benchmark_dir or BENCHMARK_DIR, 'results.json')
+    _save_json(benchmark_results, output)
+    print(f'Results saved as {output}')
+    if args.save_baseline:
+        _save_json(benchmark_results, args.save_baseline)
+        print(f'Baseline saved as {args.save_baseline}')
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            found = compare_with_baseline(benchmark_results, json.load(f), args.tolerance)
+        for regression in found:
+            print(f"Regression {regression['dataset']} {regression['function']} {regression['metric']}: "
+                  f"{regression['baseline']} -> {regression['current']}")
+        print('No regressions.' if not found else f'{len(found)} regressions.')
+        raise SystemExit(1 if found else 0)
@@ -0,0 +1,359 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from sklearn.preprocessing import MinMaxScaler
+from ann import ANN_BACKENDS, make_backend
+from data_loader import DATA_DIR, DATASETS, SORTED_DATASETS, DataRegistry
+from neighbors import (
+    ITEM_MODES,
+    USER_NEIGHBORS_FILE,
+    genre_matrix,
+    item_scoring_matrices,
+    make_neighbor_index,
+    save_neighbors,
+    similarity_blocks,
+    user_matrix,
+)
+from utility_matrix import UTILITY_DTYPES, UTILITY_MATRIX_FILE, from_dataframe, save_utility_matrix
+
+
+# Folder with one sub-folder per build and the 'current' link to the latest one
+BUILD_DIR = os.environ.get('GAMES_BUILD_DIR', 'builds')
+
+MANIFEST_FILE = 'manifest.json'
+
+# Sampling of notebook 32: reviewers kept per game in models, and users kept in umatrix_norm
+USERS_PER_ITEM = 150
+USERS_PER_ITEM_SEED = 1
+USER_SAMPLE = 4000
+USER_SAMPLE_SEED = 42
+
+# Datasets of the data folder that are not produced by the model build (copied into every build)
+COPIED_DATASETS = ('genres_playtime', 'games_playtime')
+
+
+def build_models_table(df_model, users_per_item=USERS_PER_ITEM, random_state=USERS_PER_ITEM_SEED):
+    '''
+    Builds the models dataset of notebook 32: every review with the genres, rating and mean ranking of its game,
+    keeping at most users_per_item reviewers per game.
+
+    Parameters:
+    - df_model (pd.DataFrame): ML_model dataset (one row per review and genre).
+    - users_per_item (int, optional): Maximum number of reviewers per game. Defaults to 150.
+    - random_state (int, optional): Seed of the reviewer sample. Defaults to 1.
+
+    Returns:
+    - pd.DataFrame: The models dataset.
+    '''
+    df_items = (
+        df_model.groupby('Item_name')
+        .agg({
+            'Genres': lambda x: ', '.join(x.unique()),
+            'Rating': 'first',
+            'Ranking': 'mean',
+        })
+        .reset_index()
+    )
+    df_sampled = pd.merge(df_model[['Item_name', 'Item_id', 'User_id', 'Review']], df_items, on='Item_name', how='left')
+
+    def select_users(users):
+        unique_users = users.drop_duplicates()
+        if len(unique_users) <= users_per_item:
+            return unique_users
+        return unique_users.sample(n=users_per_item, random_state=random_state)
+
+    sampled_users = df_sampled.groupby('Item_name')['User_id'].apply(select_users).reset_index()[['Item_name', 'User_id']]
+    return df_sampled.merge(sampled_users, on=['Item_name', 'User_id'], how='inner')
+
+
+def build_umatrix_norm(df_model, n_users=USER_SAMPLE, random_state=USER_SAMPLE_SEED):
+    '''
+    Builds umatrix_norm of notebook 32: mean ranking of a sample of users for every game, MinMax-scaled per game,
+    missing ratings as 0, games as rows and the users with at least one non-zero rating as columns.
+
+    Only the sampled users are pivoted, so the full users x games matrix is never built.
+
+    Parameters:
+    - df_model (pd.DataFrame): ML_model dataset.
+    - n_users (int, optional): Number of sampled users. Defaults to 4000 (all the users if there are fewer).
+    - random_state (int, optional): Seed of the user sample. Defaults to 42.
+
+    Returns:
+    - pd.DataFrame: umatrix_norm.
+    '''
+    df_mod_user = df_model[['User_id', 'Item_name', 'Ranking']].drop_duplicates().dropna(subset=['Ranking'])
+
+    # Same users as u_matrix.sample(n=4000, random_state=42) over the sorted users of the pivot table
+    users = pd.Series(np.sort(df_mod_user['User_id'].unique()))
+    sampled_users = users.sample(n=min(n_users, len(users)), random_state=random_state)
+
+    u_matrix_sample = (
+        df_mod_user[df_mod_user['User_id'].isin(sampled_users)]
+        .pivot_table(index='User_id', columns='Item_name', values='Ranking')
+        .reindex(index=sampled_users, columns=np.sort(df_mod_user['Item_name'].unique()))
+    )
+    u_matrix_sample.index.name = 'User_id'
+    u_matrix_sample.columns.name = 'Item_name'
+
+    umatrix_norm = pd.DataFrame(MinMaxScaler().fit_transform(u_matrix_sample),
+                                columns=u_matrix_sample.columns, index=u_matrix_sample.index)
+    umatrix_norm = umatrix_norm.fillna(0).T
+    return umatrix_norm.loc[:, (umatrix_norm != 0).any(axis=0)]
+
+
+def build_df_mod_game(df_model):
+    '''
+    Builds df_mod_game of notebook 32: the distinct (Item_name, Genres) pairs.
+
+    Parameters:
+    - df_model (pd.DataFrame): ML_model dataset.
+
+    Returns:
+    - pd.DataFrame: df_mod_game.
+    '''
+    return df_model[['Item_name', 'Genres']].drop_duplicates()
+
+
+def file_checksum(file_path):
+    '''
+    Computes the sha256 digest of a file, reading it in chunks.
+
+    Parameters:
+    - file_path (str): Path of the file.
+
+    Returns:
+    - str: Hexadecimal digest.
+    '''
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _file_shape(file_path):
+    # Shape of a parquet table (rows, columns) or of every array of a .npz file
+    if file_path.endswith('.parquet'):
+        metadata = pq.read_metadata(file_path)
+        return [metadata.num_rows, metadata.num_columns]
+    with np.load(file_path) as data:
+        return {name: list(data[name].shape) for name in data.files}
+
+
+def write_manifest(version_dir, metadata):
+    '''
+    Writes the manifest of a build: the size, shape and sha256 of every artifact plus the build metadata.
+
+    Parameters:
+    - version_dir (str): Folder of the build.
+    - metadata (dict): Build metadata (source, parameters, timings).
+
+    Returns:
+    - dict: The manifest.
+    '''
+    files = {}
+    for file_name in sorted(os.listdir(version_dir)):
+        file_path = os.path.join(version_dir, file_name)
+        if file_name == MANIFEST_FILE or not os.path.isfile(file_path):
+            continue
+        files[file_name] = {
+            'bytes': os.path.getsize(file_path),
+            'sha256': file_checksum(file_path),
+            'shape': _file_shape(file_path),
+        }
+
+    manifest = dict(metadata, files=files)
+    with open(os.path.join(version_dir, f'{MANIFEST_FILE}.tmp'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, ensure_ascii=False)
+    os.replace(os.path.join(version_dir, f'{MANIFEST_FILE}.tmp'), os.path.join(version_dir, MANIFEST_FILE))
+    return manifest
+
+
+def verify_build(version_dir):
+    '''
+    Checks the artifacts of a build against its manifest.
+
+    Parameters:
+    - version_dir (str): Folder of the build.
+
+    Returns:
+    - list: Names of the files that are missing or whose checksum does not match (empty if the build is intact).
+    '''
+    with open(os.path.join(version_dir, MANIFEST_FILE), encoding='utf-8') as f:
+        manifest = json.load(f)
+
+    problems = []
+    for file_name, entry in manifest['files'].items():
+        file_path = os.path.join(version_dir, file_name)
+        if not os.path.exists(file_path) or file_checksum(file_path) != entry['sha256']:
+            problems.append(file_name)
+    return problems
+
+
+def _publish_current(build_dir, version):
+    # The 'current' link is replaced in a single step, so readers see the previous or the new build
+    link_path = os.path.join(build_dir, 'current')
+    temp_path = f'{link_path}.tmp'
+    if os.path.lexists(temp_path):
+        os.remove(temp_path)
+    os.symlink(version, temp_path)
+    os.replace(temp_path, link_path)
+
+
+def build(model_path, build_dir=None, version=None, workers=None, k=20, block_size=512,
+          dense=False, utility_dtype='float32', base_dir=None, backend=None):
+    '''
+    Builds every artifact of the recommendation models from an ML_model parquet file into a new versioned
+    folder, with a manifest, and points the 'current' link of the build folder to it.
+
+    Parameters:
+    - model_path (str): ML_model parquet file (output of notebook 22).
+    - build_dir (str, optional): Folder of the builds. Defaults to BUILD_DIR.
+    - version (str, optional): Name of the build. Defaults to the UTC timestamp.
+    - workers (int, optional): Processes computing the similarity blocks. Defaults to the number of CPUs.
+    - k (int, optional): Neighbors kept per game and per user. Defaults to 20.
+    - block_size (int, optional): Rows scored at once by each worker.
+    - dense (bool, optional): Also write the dense user_sim and game_sim matrices of the notebook. Defaults to False,
+      the engine only reads the top-k neighbor tables.
+    - utility_dtype (str, optional): Stored type of the compact utility matrix, 'float32' (default) or 'uint8'
+      (lossy, see utility_matrix.from_sparse).
+    - base_dir (str, optional): Data folder with the playtime datasets copied into the build. Defaults to DATA_DIR.
+    - backend (optional): Similarity backend of the neighbor tables (see ann.make_backend). Defaults to exact scores.
+
+    Returns:
+    - str: Folder of the build. Point GAMES_DATA_DIR to it (or to the 'current' link) to serve it.
+    '''
+    build_dir = build_dir or BUILD_DIR
+    version = version or datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    workers = workers or os.cpu_count() or 1
+    backend = backend or make_backend('exact')
+    version_dir = os.path.join(build_dir, version)
+    if os.path.exists(version_dir):
+        raise FileExistsError(f'Build {version_dir} already exists')
+
+    # Everything is written to a temporary folder first, renamed once the build is complete
+    temp_dir = os.path.join(build_dir, f'.{version}.tmp')
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+
+    timings = {}
+
+    def timed(name, function, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        timings[name] = round(time.perf_counter() - start, 3)
+        print(f'{name}: {timings[name]} s')
+        return result
+
+    def path(file_name):
+        return os.path.join(temp_dir, file_name)
+
+    df_model = timed('read', pd.read_parquet, model_path)
+
+    models = timed('models', build_models_table, df_model)
+    models.to_parquet(path(DATASETS['models']))
+
+    df_mod_game = timed('df_mod_game', build_df_mod_game, df_model)
+    df_mod_game.to_parquet(path(DATASETS['df_mod_game']))
+
+    umatrix_norm = timed('umatrix_norm', build_umatrix_norm, df_model)
+    umatrix_norm.to_parquet(path(DATASETS['umatrix_norm']))
+    save_utility_matrix(from_dataframe(umatrix_norm, dtype=utility_dtype), path(UTILITY_MATRIX_FILE))
+
+    # Similarity tables, scored in parallel blocks
+    item_labels, item_matrix = genre_matrix(df_mod_game)
+    for mode in ITEM_MODES:
+        left, right = item_scoring_matrices(item_matrix, mode)
+        neighbors, scores = timed(f'item_neighbors_{mode}', backend.top_k, left, right, np.arange(len(item_labels)), k,
+                                  block_size=block_size, workers=workers)
+        save_neighbors(make_neighbor_index(item_labels, neighbors, scores), path(f'item_neighbors_{mode}.npz'))
+
+    user_labels, user_vectors = user_matrix(umatrix_norm)
+    user_right = user_vectors.T.tocsc()
+    neighbors, scores = timed('user_neighbors', backend.top_k, user_vectors, user_right, np.arange(len(user_labels)), k,
+                              block_size=block_size, workers=workers)
+    save_neighbors(make_neighbor_index(user_labels, neighbors, scores), path(USER_NEIGHBORS_FILE))
+
+    if dense:
+        game_sim = timed('game_sim', similarity_blocks, item_matrix, item_matrix.T.tocsc(), block_size=block_size, workers=workers)
+        pd.DataFrame(game_sim, index=pd.Index(item_labels, name='Item_name'),
+                     columns=pd.Index(item_labels, name='Item_name')).to_parquet(path(DATASETS['game_sim']))
+        del game_sim
+        user_sim = timed('user_sim', similarity_blocks, user_vectors, user_right, block_size=block_size, workers=workers)
+        pd.DataFrame(user_sim, index=umatrix_norm.columns, columns=umatrix_norm.columns).to_parquet(path(DATASETS['user_sim']))
+        del user_sim
+
+    base_dir = base_dir or DATA_DIR
+    for name in COPIED_DATASETS:
+        source = os.path.join(base_dir, DATASETS[name])
+        if os.path.exists(source):
+            shutil.copy2(source, path(DATASETS[name]))
+        else:
+            print(f'{source} not found, the build has no {name} dataset.')
+
+    # Sorted copies read with filters: the reviews by game, the playtime datasets by year
+    registry = DataRegistry(temp_dir)
+    for name, (source_name, _, _) in SORTED_DATASETS.items():
+        if os.path.exists(registry.dataset_path(source_name)):
+            timed(f'sorted_{name}', registry.sort_dataset, name)
+
+    metadata = {
+        'version': version,
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'source': {'path': os.path.abspath(model_path), 'sha256': file_checksum(model_path), 'rows': len(df_model)},
+        'parameters': {
+            'k': k,
+            'users_per_item': USERS_PER_ITEM,
+            'users_per_item_seed': USERS_PER_ITEM_SEED,
+            'user_sample': USER_SAMPLE,
+            'user_sample_seed': USER_SAMPLE_SEED,
+            'utility_dtype': utility_dtype,
+            'dense': dense,
+            'neighbor_backend': {'name': backend.name, **backend.params()},
+        },
+        'workers': workers,
+        'timings': timings,
+    }
+    write_manifest(temp_dir, metadata)
+
+    os.replace(temp_dir, version_dir)
+    _publish_current(build_dir, version)
+    print(f'Build {version} written to {version_dir}')
+    return version_dir
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the recommendation model artifacts of notebook 32 from an ML_model parquet file.')
+    parser.add_argument('model_path', nargs='?', help='ML_model parquet file')
+    parser.add_argument('--build-dir', default=None, help='Defaults to builds/ (or GAMES_BUILD_DIR)')
+    parser.add_argument('--version', default=None, help='Name of the build, defaults to the UTC timestamp')
+    parser.add_argument('--workers', type=int, default=None, help='Defaults to the number of CPUs')
+    parser.add_argument('--k', type=int, default=20)
+    parser.add_argument('--block-size', type=int, default=512)
+    parser.add_argument('--dense', action='store_true', help='Also write the dense user_sim and game_sim matrices')
+    parser.add_argument('--utility-dtype', choices=UTILITY_DTYPES, default='float32',
+                        help='uint8 quantizes ratings to 1/255 steps, close ratings may tie and change the recommendations')
+    parser.add_argument('--base-dir', default=None, help='Folder with the playtime datasets, defaults to Data/ (or GAMES_DATA_DIR)')
+    parser.add_argument('--backend', choices=ANN_BACKENDS, default='exact', help='Similarity backend of the neighbor tables, see ann.py')
+    parser.add_argument('--tables', type=int, default=None, help='Hash tables of the lsh backend')
+    parser.add_argument('--bucket-size', type=int, default=None, help='Target bucket size of the lsh backend')
+    parser.add_argument('--verify', metavar='BUILD', default=None, help='Check the files of a build against its manifest instead of building')
+    args = parser.parse_args()
+
+    if args.verify:
+        mismatches = verify_build(args.verify)
+        print('Build is intact.' if not mismatches else f'Missing or modified files: {mismatches}')
+        raise SystemExit(1 if mismatches else 0)
+    if not args.model_path:
+        parser.error('model_path is required to build')
+
+    build(args.model_path, args.build_dir, args.version, args.workers, k=args.k, block_size=args.block_size,
+          dense=args.dense, utility_dtype=args.utility_dtype, base_dir=args.base_dir,
+          backend=make_backend(args.backend, n_tables=args.tables, bucket_size=args.bucket_size))
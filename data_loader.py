@@ -0,0 +1,528 @@
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from instrumentation import stage
+
+
+# Folder with the parquet artifacts. Can be overridden for deployments that keep
+# the data outside of the repository.
+DATA_DIR = os.environ.get('GAMES_DATA_DIR', 'Data')
+
+# Registry of the datasets consumed by functions.py (name -> parquet file)
+DATASETS = {
+    'genres_playtime': 'funciones1.parquet',
+    'games_playtime': 'funciones2.parquet',
+    'df_mod_game': 'df_mod_game.parquet',
+    'game_sim': 'game_sim.parquet',
+    'models': 'models.parquet',
+    'umatrix_norm': 'umatrix_norm.parquet',
+    'user_sim': 'user_sim.parquet',
+    # Sorted copies written by sort_dataset, see SORTED_DATASETS
+    'genres_playtime_by_year': 'funciones1_by_release.parquet',
+    'games_playtime_by_year': 'funciones2_by_release.parquet',
+    'reviews': 'reviews.parquet',
+}
+
+# Sorted copies written by sort_dataset: name -> (source dataset, columns, sort columns). Each row group of a
+# sorted file covers a narrow range of the sort columns, so read_dataset skips the groups a filter rules out (the
+# other years of funciones2, the reviews of the other games). The sources are left as they are: models keeps
+# its order, which is the order of the recommendations.
+SORTED_DATASETS = {
+    'genres_playtime_by_year': ('genres_playtime', None, ['Release']),
+    'games_playtime_by_year': ('games_playtime', None, ['Release']),
+    'reviews': ('models', ['Item_name', 'Review'], ['Item_name']),
+}
+
+# Rows per row group of the sorted datasets: smaller groups skip more rows per filtered read, but make the
+# footer (parsed by every read) larger
+SORTED_ROW_GROUP_SIZE = 16384
+
+# Seconds between two checks of the files of the data folder by DataRegistry.fingerprint
+FINGERPRINT_CHECK_INTERVAL = 5
+
+# Matrix datasets (labels as index and columns, one float per cell) that can be exported as
+# raw arrays and memory-mapped, so every process of the host shares a single page-cache copy
+MATRIX_DATASETS = ('umatrix_norm', 'user_sim', 'game_sim')
+
+# Matrix values plus their row and column labels. values is a read-only np.memmap when the
+# matrix was exported with export_matrix, otherwise an in-memory array read from parquet.
+LabeledMatrix = namedtuple('LabeledMatrix', ['values', 'index', 'columns'])
+
+# Layout of the parquet file of a dataset: columns the rows are sorted by (as declared by the writer) and, for
+# each of them, the (min, max) statistics of every row group
+ParquetLayout = namedtuple('ParquetLayout', ['sorted_by', 'ranges'])
+
+
+class DataRegistry:
+    '''
+    Lazy, thread-safe cache of the datasets of a data folder and of the objects derived from them (indexes).
+    Each dataset is read the first time it is requested; concurrent callers asking for the same dataset
+    wait for a single read instead of reading the file several times.
+    '''
+
+    def __init__(self, data_dir=None):
+        self.data_dir = data_dir or DATA_DIR
+        # _cache is only changed while holding _registry_lock; the per-key locks serialize the builds of a key
+        self._cache = {}
+        self._locks = {}
+        # Number of clears, so builds started before a clear do not publish into the cleared cache
+        self._generation = 0
+        self._registry_lock = threading.Lock()
+        # Number of objects published or cleared, part of the fingerprint of the loaded data
+        self._version = 0
+        self._files_hash = None
+        self._files_checked = 0.0
+
+    def dataset_path(self, name):
+        '''
+        Returns the path of a registered dataset.
+
+        Parameters:
+        - name (str): Name of the dataset in DATASETS.
+
+        Returns:
+        - str: Path to the parquet file inside the data folder.
+        '''
+        if name not in DATASETS:
+            raise KeyError(f'Unknown dataset {name!r}. Available: {sorted(DATASETS)}')
+        return os.path.join(self.data_dir, DATASETS[name])
+
+    def artifact_path(self, file_name):
+        '''
+        Returns the path of a precomputed artifact (e.g. a neighbor index) stored next to the datasets.
+
+        Parameters:
+        - file_name (str): Name of the artifact file.
+
+        Returns:
+        - str: Path to the file inside the data folder.
+        '''
+        return os.path.join(self.data_dir, file_name)
+
+    def _get_lock(self, key):
+        with self._registry_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _get_or_build(self, key, builder):
+        # Fast path without locking once the object is loaded
+        value = self._cache.get(key)
+        if value is not None:
+            return value
+
+        with self._get_lock(key):
+            # Another thread may have loaded it while we were waiting
+            value = self._cache.get(key)
+            if value is not None:
+                return value
+
+            generation = self._generation
+            # Loads show up in the trace of the request that triggered them
+            with stage(f'load {key[1] if key[0] in ("derived", "matrix") else key[0]}'):
+                value = builder()
+            with self._registry_lock:
+                if generation == self._generation:
+                    self._cache[key] = value
+            return value
+
+    def load_dataset(self, name, columns=None):
+        '''
+        Loads a dataset the first time it is requested and keeps it in memory for later calls.
+
+        Parameters:
+        - name (str): Name of the dataset in DATASETS.
+        - columns (list, optional): Columns to read. If None, the whole file is read.
+          Each distinct column selection is cached on its own, so callers should use a
+          fixed set of columns per use case.
+
+        Returns:
+        - pd.DataFrame: The requested dataset. It is shared between callers and must not be modified.
+        '''
+        key = (name, tuple(columns) if columns is not None else None)
+        return self._get_or_build(key, lambda: pd.read_parquet(
+            self.dataset_path(name), columns=list(columns) if columns is not None else None))
+
+    def read_dataset(self, name, columns=None, filters=None):
+        '''
+        Reads the rows of a dataset matching a filter, without keeping them in memory. The column selection
+        and the filter are pushed down to a pyarrow dataset scan: only the requested columns are decoded and
+        the row groups whose statistics rule out the filter are skipped, so on the files written by
+        sort_dataset a filter on the sort column reads a few row groups instead of the whole file.
+
+        Parameters:
+        - name (str): Name of the dataset in DATASETS.
+        - columns (list, optional): Columns to read. If None, every column is read.
+        - filters (list, optional): Row filter in the form of pandas.read_parquet, e.g. [('Release', '==', 2015)].
+          If None, every row is read.
+
+        Returns:
+        - pd.DataFrame: Matching rows in file order.
+        '''
+        dataset = ds.dataset(self.dataset_path(name), format='parquet')
+        table = dataset.to_table(columns=list(columns) if columns is not None else None,
+                                 filter=pq.filters_to_expression(filters) if filters else None)
+        return table.to_pandas()
+
+    def layout(self, name):
+        '''
+        Returns the layout of the parquet file of a dataset, read from its footer the first time it is requested.
+
+        Parameters:
+        - name (str): Name of the dataset in DATASETS.
+
+        Returns:
+        - ParquetLayout: Columns the rows are sorted by (empty tuple if the writer did not declare an order,
+          e.g. files not written by sort_dataset) and the (min, max) of those columns in every row group.
+        '''
+        def build():
+            metadata = pq.read_metadata(self.dataset_path(name))
+            row_groups = [metadata.row_group(i) for i in range(metadata.num_row_groups)]
+            orders = {row_group.sorting_columns for row_group in row_groups}
+            # Only an order declared by every row group, with statistics for its columns, is used
+            if len(orders) != 1:
+                return ParquetLayout((), {})
+
+            ranges = {}
+            for sorting_column in orders.pop():
+                statistics = [row_group.column(sorting_column.column_index).statistics for row_group in row_groups]
+                if not all(column_statistics is not None and column_statistics.has_min_max for column_statistics in statistics):
+                    return ParquetLayout((), {})
+                column_name = metadata.schema.column(sorting_column.column_index).name
+                ranges[column_name] = tuple((column_statistics.min, column_statistics.max) for column_statistics in statistics)
+            return ParquetLayout(tuple(ranges), ranges)
+
+        return self.load_derived(f'{name} layout', build)
+
+    def sort_dataset(self, name, row_group_size=SORTED_ROW_GROUP_SIZE):
+        '''
+        Writes a sorted copy of SORTED_DATASETS from its source, sorted by its sort columns (rows with equal keys
+        keep their order), in row groups of row_group_size rows with min/max statistics and the order declared
+        in the file metadata (see layout). The source file is not modified.
+
+        Parameters:
+        - name (str): Name of the dataset in SORTED_DATASETS.
+        - row_group_size (int, optional): Rows per row group. Defaults to SORTED_ROW_GROUP_SIZE.
+
+        Returns:
+        - str: Path of the written file.
+        '''
+        if name not in SORTED_DATASETS:
+            raise KeyError(f'Unknown sorted dataset {name!r}. Available: {sorted(SORTED_DATASETS)}')
+
+        source, columns, sort_columns = SORTED_DATASETS[name]
+        ordering = [(column, 'ascending') for column in sort_columns]
+        # sort_by is stable, so rows of the same year (or game) keep the order of the source
+        table = pq.read_table(self.dataset_path(source), columns=columns).sort_by(ordering)
+
+        file_path = self.dataset_path(name)
+        temp_path = f'{file_path}.tmp'
+        pq.write_table(table, temp_path, row_group_size=row_group_size, write_statistics=True,
+                       sorting_columns=pq.SortingColumn.from_ordering(table.schema, ordering))
+        os.replace(temp_path, file_path)
+
+        print(f'Dataset {name} ({table.num_rows} rows) written to {file_path}, sorted by {", ".join(sort_columns)}')
+        return file_path
+
+    def sorted_copy(self, source, column):
+        '''
+        Finds the sorted copy of a dataset written by sort_dataset, to read it with filters on a column.
+
+        Parameters:
+        - source (str): Name of the source dataset in DATASETS.
+        - column (str): Column the copy must be sorted by.
+
+        Returns:
+        - str: Name of the copy in SORTED_DATASETS, or None if it was not written, is older than its source
+          (the source changed after it was sorted) or is not sorted by the column.
+        '''
+        for name, (source_name, _, sort_columns) in SORTED_DATASETS.items():
+            if source_name != source or sort_columns[0] != column:
+                continue
+            try:
+                if os.path.getmtime(self.dataset_path(name)) < os.path.getmtime(self.dataset_path(source)):
+                    continue
+            except OSError:
+                continue
+            if self.layout(name).sorted_by[:1] == (column,):
+                return name
+        return None
+
+    def load_derived(self, name, builder):
+        '''
+        Builds a derived object (e.g. an index over one or more datasets) the first time it is
+        requested and keeps it in memory for later calls, with the same locking as load_dataset.
+
+        Parameters:
+        - name (str): Unique name of the derived object.
+        - builder (callable): Function without arguments that builds the object.
+
+        Returns:
+        - The built object. It is shared between callers and must not be modified.
+        '''
+        return self._get_or_build(('derived', name), builder)
+
+    def publish_derived(self, name, value):
+        '''
+        Replaces a derived object with a new version in a single step: callers get either the old or the
+        new object, never a partial state. Used to swap in incrementally updated indexes.
+
+        Parameters:
+        - name (str): Unique name of the derived object.
+        - value: New version of the object.
+
+        Returns:
+        - None
+        '''
+        key = ('derived', name)
+        with self._get_lock(key), self._registry_lock:
+            self._cache[key] = value
+            self._version += 1
+
+    def fingerprint(self):
+        '''
+        Returns a version identifier of the data served by the registry: a hash of the names, sizes and
+        modification times of the files of the data folder, plus the number of objects published (or
+        caches cleared) since the registry was created. The files are checked again at most every
+        FINGERPRINT_CHECK_INTERVAL seconds.
+
+        Returns:
+        - str: Fingerprint, e.g. '3f1c2a9b0d4e6f70-0'. Processes serving the same files with the same
+          published versions get the same fingerprint.
+        '''
+        now = time.monotonic()
+        if self._files_hash is None or now - self._files_checked > FINGERPRINT_CHECK_INTERVAL:
+            digest = hashlib.sha256()
+            try:
+                entries = sorted(os.scandir(self.data_dir), key=lambda entry: entry.name)
+            except OSError:
+                entries = []
+            for entry in entries:
+                # Temporary files of writes in progress are skipped, they are renamed once complete
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    digest.update(f'{entry.name}\0{stat.st_size}\0{stat.st_mtime_ns}\0'.encode('utf-8'))
+            self._files_hash = digest.hexdigest()[:16]
+            self._files_checked = now
+        return f'{self._files_hash}-{self._version}'
+
+    def matrix_paths(self, name):
+        '''
+        Returns the paths of the raw export of a matrix dataset.
+
+        Parameters:
+        - name (str): Name of the matrix in MATRIX_DATASETS.
+
+        Returns:
+        - tuple: (values_path, labels_path) with the raw little-endian values and the JSON label sidecar.
+        '''
+        return self.artifact_path(f'{name}.bin'), self.artifact_path(f'{name}.labels.json')
+
+    def export_matrix(self, name, dtype='float64'):
+        '''
+        Exports a matrix dataset as a raw little-endian array in column-major order (each column is contiguous,
+        as the recommenders read whole user columns) plus a JSON sidecar with the shape, dtype and labels.
+
+        Parameters:
+        - name (str): Name of the matrix in MATRIX_DATASETS.
+        - dtype (str, optional): Type of the stored values, 'float64' (default) or 'float32'.
+
+        Returns:
+        - tuple: (values_path, labels_path) of the written files.
+        '''
+        if name not in MATRIX_DATASETS:
+            raise KeyError(f'Unknown matrix {name!r}. Available: {MATRIX_DATASETS}')
+
+        dataframe = pd.read_parquet(self.dataset_path(name))
+        stored_dtype = np.dtype(dtype).newbyteorder('<')
+        values_path, labels_path = self.matrix_paths(name)
+
+        # tofile writes in C order, so the transpose is written to get a column-major matrix
+        temp_path = f'{values_path}.tmp'
+        np.ascontiguousarray(dataframe.to_numpy(dtype=stored_dtype).T).tofile(temp_path)
+        os.replace(temp_path, values_path)
+
+        labels = {
+            'dtype': stored_dtype.str,
+            'shape': list(dataframe.shape),
+            'order': 'F',
+            'index_name': dataframe.index.name,
+            'index': dataframe.index.tolist(),
+            'columns_name': dataframe.columns.name,
+            'columns': dataframe.columns.tolist(),
+        }
+        with open(f'{labels_path}.tmp', 'w', encoding='utf-8') as f:
+            json.dump(labels, f, ensure_ascii=False)
+        os.replace(f'{labels_path}.tmp', labels_path)
+
+        print(f'Matrix {name} {dataframe.shape} exported as {values_path}')
+        return values_path, labels_path
+
+    def load_matrix(self, name):
+        '''
+        Loads a matrix dataset. If it was exported with export_matrix, the values are memory-mapped
+        read-only (near instant, shared between processes); otherwise the parquet file is read.
+
+        Parameters:
+        - name (str): Name of the matrix in MATRIX_DATASETS.
+
+        Returns:
+        - LabeledMatrix: Values, row labels (pd.Index) and column labels (pd.Index).
+        '''
+        def build():
+            values_path, labels_path = self.matrix_paths(name)
+            if not (os.path.exists(values_path) and os.path.exists(labels_path)):
+                dataframe = self.load_dataset(name)
+                return LabeledMatrix(dataframe.to_numpy(), dataframe.index, dataframe.columns)
+
+            with open(labels_path, encoding='utf-8') as f:
+                labels = json.load(f)
+            values = np.memmap(values_path, dtype=np.dtype(labels['dtype']), mode='r',
+                               shape=tuple(labels['shape']), order=labels['order'])
+            return LabeledMatrix(values,
+                                 pd.Index(labels['index'], name=labels['index_name']),
+                                 pd.Index(labels['columns'], name=labels['columns_name']))
+
+        return self._get_or_build(('matrix', name), build)
+
+    def is_loaded(self, name):
+        '''
+        Checks whether any column selection of a dataset (or a derived object) is already in memory.
+
+        Parameters:
+        - name (str): Name of the dataset in DATASETS or of the derived object.
+
+        Returns:
+        - bool: True if it has been loaded.
+        '''
+        with self._registry_lock:
+            keys = list(self._cache)
+        return any(name in (key[0], key[1]) for key in keys)
+
+    def evict(self, name):
+        '''
+        Drops every loaded copy of a dataset (any column selection and its matrix form), e.g. once a
+        compact version of it has been built and the original is no longer needed.
+
+        Parameters:
+        - name (str): Name of the dataset in DATASETS.
+
+        Returns:
+        - None
+        '''
+        with self._registry_lock:
+            for key in [key for key in self._cache if key[0] == name or key == ('matrix', name)]:
+                self._cache.pop(key, None)
+
+    def clear(self):
+        '''
+        Drops every loaded dataset and derived object, so the next call reads the files again (e.g. after a data refresh).
+
+        Returns:
+        - None
+        '''
+        with self._registry_lock:
+            self._cache.clear()
+            # Locks held by builds in progress are kept, so a new caller of the same key waits for them
+            self._locks = {key: lock for key, lock in self._locks.items() if lock.locked()}
+            self._generation += 1
+            self._version += 1
+
+
+# Registry of the default data folder, used by the module-level helpers below
+_default_registry = DataRegistry()
+
+
+def dataset_path(name):
+    '''
+    Returns the path of a registered dataset in the default data folder. See DataRegistry.dataset_path.
+    '''
+    return _default_registry.dataset_path(name)
+
+
+def artifact_path(file_name):
+    '''
+    Returns the path of an artifact in the default data folder. See DataRegistry.artifact_path.
+    '''
+    return _default_registry.artifact_path(file_name)
+
+
+def load_dataset(name, columns=None):
+    '''
+    Loads a dataset of the default data folder, once per process. See DataRegistry.load_dataset.
+    '''
+    return _default_registry.load_dataset(name, columns)
+
+
+def read_dataset(name, columns=None, filters=None):
+    '''
+    Reads the rows of a dataset of the default data folder matching a filter. See DataRegistry.read_dataset.
+    '''
+    return _default_registry.read_dataset(name, columns, filters)
+
+
+def load_derived(name, builder):
+    '''
+    Builds a derived object once per process. See DataRegistry.load_derived.
+    '''
+    return _default_registry.load_derived(name, builder)
+
+
+def is_loaded(name):
+    '''
+    Checks whether a dataset of the default data folder is in memory. See DataRegistry.is_loaded.
+    '''
+    return _default_registry.is_loaded(name)
+
+
+def load_matrix(name):
+    '''
+    Loads a matrix dataset of the default data folder, memory-mapped when exported. See DataRegistry.load_matrix.
+    '''
+    return _default_registry.load_matrix(name)
+
+
+def data_fingerprint():
+    '''
+    Returns the version identifier of the data of the default data folder. See DataRegistry.fingerprint.
+    '''
+    return _default_registry.fingerprint()
+
+
+def clear_cache():
+    '''
+    Drops every loaded dataset of the default data folder. See DataRegistry.clear.
+    '''
+    _default_registry.clear()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export matrix datasets as raw arrays that can be memory-mapped, '
+                                                 'and rewrite the datasets read with filters sorted.')
+    # choices is checked by hand: argparse also checks the default of an optional positional list against it
+    parser.add_argument('names', nargs='*', help=f'Matrices to export, among {", ".join(MATRIX_DATASETS)} '
+                                                 '(default: umatrix_norm, none with --sort)')
+    parser.add_argument('--dtype', choices=['float64', 'float32'], default='float64')
+    parser.add_argument('--sort', action='store_true', help='Write the sorted datasets of SORTED_DATASETS whose source exists')
+    parser.add_argument('--data-dir', default=None, help='Defaults to Data/ (or GAMES_DATA_DIR)')
+    args = parser.parse_args()
+
+    unknown = [matrix_name for matrix_name in args.names if matrix_name not in MATRIX_DATASETS]
+    if unknown:
+        parser.error(f'Unknown matrices {unknown}. Available: {MATRIX_DATASETS}')
+
+    registry = DataRegistry(args.data_dir)
+    for matrix_name in args.names or ([] if args.sort else ['umatrix_norm']):
+        registry.export_matrix(matrix_name, dtype=args.dtype)
+    if args.sort:
+        for dataset_name, (source_name, _, _) in SORTED_DATASETS.items():
+            if os.path.exists(registry.dataset_path(source_name)):
+                registry.sort_dataset(dataset_name)
+            else:
+                print(f'{registry.dataset_path(source_name)} not found, {dataset_name} is not written.')
@@ -0,0 +1,681 @@
+import os
+import threading
+from typing import List, NamedTuple, Optional
+import numpy as np
+import pandas as pd
+from data_loader import DataRegistry
+from instrumentation import stage
+from indexes import build_genres_year_index, build_games_year_index, build_name_index, lookup_name, prefix_search, fuzzy_search
+from neighbors import ITEM_MODES, USER_NEIGHBORS_FILE, NeighborIndex, build_item_neighbors, build_user_neighbors, load_neighbors, top_neighbors
+from utility_matrix import UTILITY_DTYPES, UTILITY_MATRIX_FILE, UtilityMatrix, column_max_hits, from_dense, load_utility_matrix
+
+
+GENRES_PLAYTIME_COLUMNS = ['Genres', 'Release', 'Playtime_Millon_Hours']
+GAMES_PLAYTIME_COLUMNS = ['Item_name', 'Playtime', 'Release']
+MODELS_INFO_COLUMNS = ['Item_name', 'Genres', 'Rating', 'Ranking']
+MODELS_REVIEW_COLUMNS = ['Item_name', 'Review']
+
+# Number of similar users whose favourite items are counted by the user-based recommender
+SIMILAR_USERS = 10
+
+# Columns of the recommendation frames of many keys (see similar_items_frame): the game or user the
+# recommendations are for, the position of each row in the result of that key, then the GameInfo columns
+RECOMMENDATION_FRAME_COLUMNS = ['Key', 'Position'] + MODELS_INFO_COLUMNS
+
+
+class InvalidQueryError(ValueError):
+    '''Raised when the arguments of a query are not valid (e.g. a year that is not a number).'''
+
+
+class NoDataError(LookupError):
+    '''Raised when there is no data for the requested year, game or user.'''
+
+
+# Typed results. FRAME_COLUMNS holds the column names used by the DataFrames of functions.py.
+
+class GenrePlaytime(NamedTuple):
+    genre: str
+    playtime_million_hours: float
+
+    FRAME_COLUMNS = ('Genres', 'Playtime_Millon_Hours')
+
+
+class GamePlaytime(NamedTuple):
+    item_name: str
+    playtime: float
+
+    FRAME_COLUMNS = ('Item_name', 'Playtime')
+
+
+class GameInfo(NamedTuple):
+    item_name: str
+    genres: str
+    rating: str
+    ranking: float
+
+    FRAME_COLUMNS = ('Item_name', 'Genres', 'Rating', 'Ranking')
+
+
+class SimilarItems(NamedTuple):
+    item_name: str
+    recommendations: List[GameInfo]
+
+
+# Data of the user-based recommender, swapped as a whole when it is updated
+
+class UserModel(NamedTuple):
+    utility_matrix: UtilityMatrix
+    user_neighbors: NeighborIndex
+
+
+def to_dataframe(results, result_type):
+    '''
+    Converts a list of typed results to a DataFrame with the column names used by functions.py.
+
+    Parameters:
+    - results (list): Results of one of the RecommendationEngine methods.
+    - result_type (type): Type of the results (GenrePlaytime, GamePlaytime or GameInfo).
+
+    Returns:
+    - pd.DataFrame: One row per result.
+    '''
+    with stage('to_dataframe'):
+        return pd.DataFrame(list(results), columns=result_type.FRAME_COLUMNS)
+
+
+def _most_voted_items(neighbor_columns, utility_matrix, n=5):
+    '''
+    Counts, for a batch of users, how many of their similar users rate each item with their own maximum score,
+    and returns the n most voted items of every user.
+
+    Parameters:
+    - neighbor_columns (np.ndarray): (n_users, n_neighbors) array with the umatrix_norm columns of the similar
+      users of every user, -1 where a user has fewer neighbors.
+    - utility_matrix (UtilityMatrix): Compact umatrix_norm.
+    - n (int, optional): Number of items to return per user. Defaults to 5.
+
+    Returns:
+    - list: One array of item rows per user, sorted by votes. Ties keep the order in which the items are
+      first found (neighbor by neighbor, item by item), as the original dictionary count did.
+    '''
+    n_items = utility_matrix.matrix.shape[0]
+    n_users, n_neighbors = neighbor_columns.shape
+
+    # Items rated with the maximum score of each neighbor, all the stored columns in a single pass
+    slots = np.flatnonzero(neighbor_columns.ravel() >= 0)
+    hit_slots, item_rows = column_max_hits(utility_matrix, neighbor_columns.ravel()[slots])
+    user_pos, neighbor_pos = np.divmod(slots[hit_slots], n_neighbors)
+
+    # Votes per (user, item) and first appearance of every item, to break ties. Only the hits are
+    # sorted, so memory grows with the number of hits instead of n_users x n_items.
+    cells = user_pos * n_items + item_rows
+    seen = neighbor_pos.astype(np.int64) * n_items + item_rows
+    order = np.lexsort((seen, cells))
+    cells, seen = cells[order], seen[order]
+    starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]]) if len(cells) else np.array([], dtype=np.int64)
+    votes = np.diff(np.r_[starts, len(cells)])
+    first_seen = seen[starts]
+    cell_users, cell_items = np.divmod(cells[starts], n_items)
+
+    # Most voted items first, then the first found; the n first items of every user
+    order = np.lexsort((first_seen, -votes, cell_users))
+    cell_users, cell_items = cell_users[order], cell_items[order]
+    user_starts = np.searchsorted(cell_users, np.arange(n_users + 1))
+    return [cell_items[start:min(start + n, stop)] for start, stop in zip(user_starts[:-1], user_starts[1:])]
+
+
+class RecommendationEngine:
+    '''
+    Headless query engine behind functions.py and app.py. It owns the datasets of a data folder and the
+    indexes built from them (all loaded lazily and thread-safely on first use), and exposes the playtime
+    queries and both recommenders as pure methods returning typed results.
+
+    Importing this module does not import streamlit, wordcloud or matplotlib.
+    '''
+
+    def __init__(self, data_dir=None, item_similarity_mode='second_order', utility_dtype='float32', neighbor_backend=None):
+        '''
+        Parameters:
+        - data_dir (str, optional): Folder with the parquet artifacts. Defaults to data_loader.DATA_DIR.
+        - item_similarity_mode (str, optional): Ranking of similar_items, 'second_order' keeps the
+          similarity-of-similarities ranking of the dense game_sim matrix, 'cosine' ranks by plain genre
+          cosine similarity. See neighbors.ITEM_MODES.
+        - utility_dtype (str, optional): Type of the compact umatrix_norm built when no precomputed one is
+          found, 'float32' (default) or 'uint8'. See utility_matrix.UTILITY_DTYPES.
+        - neighbor_backend (optional): Similarity backend (see ann.make_backend) of the neighbor tables built
+          when no precomputed one is found. Defaults to exact scores.
+        '''
+        if item_similarity_mode not in ITEM_MODES:
+            raise ValueError(f'Unknown mode {item_similarity_mode!r}. Available: {ITEM_MODES}')
+        if utility_dtype not in UTILITY_DTYPES:
+            raise ValueError(f'Unknown dtype {utility_dtype!r}. Available: {UTILITY_DTYPES}')
+        self.data = DataRegistry(data_dir)
+        self.item_similarity_mode = item_similarity_mode
+        self.utility_dtype = utility_dtype
+        self.neighbor_backend = neighbor_backend
+
+    # Indexes, built once per engine
+
+    def _year_index(self, name, columns, builder, release_year=None):
+        # Index of a dataset of yearly rows. The whole index is built once (by warm_up, or when the data folder has
+        # no copy of the dataset sorted by Release); until then, with the copy written by DataRegistry.sort_dataset
+        # each queried year is built on its own from the row groups holding it, so a query does not decode the
+        # other years.
+        index_name = f'{name}_year_index'
+        sorted_name = self.data.sorted_copy(name, 'Release')
+        if release_year is None or sorted_name is None or self.data.is_loaded(index_name):
+            return self.data.load_derived(index_name, lambda: builder(self.data.load_dataset(name, columns)))
+        layout = self.data.layout(sorted_name)
+
+        try:
+            year = int(release_year)
+        except (OverflowError, ValueError):
+            year = None
+        # Years that are not integers or out of the range of every row group have no rows: they are answered
+        # without reading and not cached, so arbitrary queries cannot grow the cache
+        if year != release_year or not any(low <= year <= high for low, high in layout.ranges['Release']):
+            return builder(pd.DataFrame(columns=columns))
+        return self.data.load_derived(f'{index_name} {year}', lambda: builder(
+            self.data.read_dataset(sorted_name, columns, filters=[('Release', '==', year)])))
+
+    def _genres_year_index(self, release_year=None):
+        # Per-year genre totals from funciones1.parquet
+        return self._year_index('genres_playtime', GENRES_PLAYTIME_COLUMNS, build_genres_year_index, release_year)
+
+    def _games_year_index(self, release_year=None):
+        # Per-year playtime orderings from funciones2.parquet
+        return self._year_index('games_playtime', GAMES_PLAYTIME_COLUMNS, build_games_year_index, release_year)
+
+    def _item_neighbors(self):
+        # Top-k item-item neighbor table: read from the data folder if it was precomputed, otherwise built from df_mod_game
+        def build():
+            file_path = self.data.artifact_path(f'item_neighbors_{self.item_similarity_mode}.npz')
+            if os.path.exists(file_path):
+                return load_neighbors(file_path)
+            df_mod_game = self.data.load_dataset('df_mod_game', ['Item_name', 'Genres'])
+            return build_item_neighbors(df_mod_game, mode=self.item_similarity_mode, backend=self.neighbor_backend)
+
+        return self.data.load_derived('item_neighbors', build)
+
+    def _user_neighbors(self):
+        # Top-k user-user neighbor table: read from the data folder if it was precomputed, otherwise built from umatrix_norm
+        def build():
+            file_path = self.data.artifact_path(USER_NEIGHBORS_FILE)
+            if os.path.exists(file_path):
+                return load_neighbors(file_path)
+            umatrix = self.data.load_matrix('umatrix_norm')
+            return build_user_neighbors(pd.DataFrame(umatrix.values, index=umatrix.index, columns=umatrix.columns, copy=False),
+                                        backend=self.neighbor_backend)
+
+        return self.data.load_derived('user_neighbors', build)
+
+    def _utility_matrix(self):
+        # Compact umatrix_norm (sparse, integer-coded items and users): read from the data folder if it was
+        # precomputed, otherwise converted from the dense matrix, which is then dropped from memory
+        def build():
+            file_path = self.data.artifact_path(UTILITY_MATRIX_FILE)
+            if os.path.exists(file_path):
+                return load_utility_matrix(file_path)
+            umatrix = self.data.load_matrix('umatrix_norm')
+            utility_matrix = from_dense(umatrix.values, umatrix.index, umatrix.columns, dtype=self.utility_dtype)
+            self.data.evict('umatrix_norm')
+            return utility_matrix
+
+        return self.data.load_derived('utility_matrix', build)
+
+    def _user_model(self):
+        # Utility matrix and user neighbor table of the same version. The neighbors are built first: without
+        # a precomputed table they are built from the dense matrix, which the compact one then replaces.
+        def build():
+            user_neighbors = self._user_neighbors()
+            return UserModel(self._utility_matrix(), user_neighbors)
+
+        return self.data.load_derived('user_model', build)
+
+    def publish_user_model(self, utility_matrix, user_neighbors):
+        '''
+        Swaps in a new version of the data of the user-based recommender (e.g. after an incremental update).
+        Queries that already started finish with the old version, later queries use the new one.
+
+        Parameters:
+        - utility_matrix (UtilityMatrix): New compact umatrix_norm.
+        - user_neighbors (NeighborIndex): New user-user table, with the users of utility_matrix.
+
+        Returns:
+        - None
+        '''
+        self.data.publish_derived('utility_matrix', utility_matrix)
+        self.data.publish_derived('user_neighbors', user_neighbors)
+        self.data.publish_derived('user_model', UserModel(utility_matrix, user_neighbors))
+
+    def reload_user_model(self):
+        '''
+        Reads again the precomputed utility matrix and user neighbor table of the data folder (written by
+        incremental.py) and publishes them. See publish_user_model.
+
+        Returns:
+        - None
+        '''
+        utility_matrix = load_utility_matrix(self.data.artifact_path(UTILITY_MATRIX_FILE))
+        user_neighbors = load_neighbors(self.data.artifact_path(USER_NEIGHBORS_FILE))
+        self.publish_user_model(utility_matrix, user_neighbors)
+
+    def _item_info(self):
+        # Metadata of every item without duplicated rows (in models order) and the rows of each item
+        def build():
+            df_mf = self.data.load_dataset('models', MODELS_INFO_COLUMNS)
+            item_info = df_mf[['Item_name', 'Genres', 'Rating', 'Ranking']].drop_duplicates()
+            return item_info, item_info.groupby('Item_name', sort=False).indices
+
+        return self.data.load_derived('item_info', build)
+
+    def _name_index(self):
+        # Case-insensitive index of the game names of models
+        return self.data.load_derived('name_index', lambda: build_name_index(
+            self.data.load_dataset('models', MODELS_INFO_COLUMNS)['Item_name']))
+
+    def _item_info_groups(self):
+        # Rows of item_info of every item as flat arrays (item i owns rows[starts[i]:starts[i + 1]]), to
+        # gather the metadata of many items at once
+        def build():
+            item_info, info_rows = self._item_info()
+            lengths = np.fromiter((len(rows) for rows in info_rows.values()), dtype=np.int64, count=len(info_rows))
+            rows = np.concatenate(list(info_rows.values())) if info_rows else np.array([], dtype=np.int64)
+            return pd.Index(list(info_rows)), np.r_[0, np.cumsum(lengths)], rows
+
+        return self.data.load_derived('item_info_groups', build)
+
+    def _metadata_frame(self, keys, key_ids, items):
+        # Recommendation frame of many keys: key_ids[i] is the position in keys of the key item i is
+        # recommended to. Rows of a key are in models order, as in _items_metadata.
+        item_info, _ = self._item_info()
+        names, starts, info_rows = self._item_info_groups()
+        groups = names.get_indexer(items)
+        key_ids, groups = key_ids[groups >= 0], groups[groups >= 0]
+
+        lengths = starts[groups + 1] - starts[groups]
+        row_keys = np.repeat(key_ids, lengths)
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        rows = info_rows[np.repeat(starts[groups], lengths) + offsets]
+        order = np.lexsort((rows, row_keys))
+        row_keys, rows = row_keys[order], rows[order]
+
+        frame = item_info.iloc[rows].reset_index(drop=True)
+        frame.insert(0, 'Key', np.asarray(keys, dtype=object)[row_keys])
+        frame.insert(1, 'Position', (np.arange(len(rows)) - np.searchsorted(row_keys, row_keys)).astype(np.int32))
+        return frame[RECOMMENDATION_FRAME_COLUMNS]
+
+    def _items_metadata(self, items):
+        # Metadata rows of the given items, in models order, as filtering models with isin + drop_duplicates
+        item_info, info_rows = self._item_info()
+        rows = [info_rows[item] for item in items if item in info_rows]
+        rows = np.sort(np.concatenate(rows)) if rows else np.array([], dtype=np.int64)
+        return [GameInfo(*row) for row in item_info.iloc[rows].itertuples(index=False, name=None)]
+
+    def warm_up(self):
+        '''
+        Loads every dataset and builds every index up front, e.g. before forking worker processes.
+
+        Returns:
+        - None
+        '''
+        self._genres_year_index()
+        self._games_year_index()
+        self._name_index()
+        self._item_info()
+        self._item_neighbors()
+        self._user_model()
+        if self.data.sorted_copy('models', 'Item_name') is None:
+            self.data.load_dataset('models', MODELS_REVIEW_COLUMNS)
+
+    # Playtime queries
+
+    @staticmethod
+    def _check_n(n, limit=None):
+        # limit is the k of the neighbor table the results are read from, if any; bool is an int subclass
+        if isinstance(n, bool) or not isinstance(n, (int, np.integer)) or n < 1:
+            raise InvalidQueryError('Invalid input. Please provide a positive integer for n.')
+        if limit is not None and n > limit:
+            raise InvalidQueryError(f'Invalid input. n can be at most {limit}.')
+
+    @classmethod
+    def _check_query(cls, release_year, n):
+        if not isinstance(release_year, (int, float, np.integer)):
+            raise InvalidQueryError('Invalid input. Please provide a numeric year.')
+        cls._check_n(n)
+
+    def top_genres(self, release_year, n=5) -> List[GenrePlaytime]:
+        '''
+        Returns the n genres with the highest playtime hours for a release year.
+
+        Parameters:
+        - release_year (int or float): Release year.
+        - n (int, optional): Number of genres. Defaults to 5.
+
+        Returns:
+        - list: GenrePlaytime results sorted by playtime hours in descending order.
+
+        Raises:
+        - InvalidQueryError: If the year is not a number or n is not a positive integer.
+        - NoDataError: If there is no data for the year.
+        '''
+        self._check_query(release_year, n)
+        with stage('year_lookup'):
+            genres_sorted = self._genres_year_index(release_year).get(release_year)
+        if genres_sorted is None:
+            raise NoDataError(f'There is no data available for the year {release_year}')
+        if genres_sorted.empty:
+            raise NoDataError(f'No data available for year {release_year}')
+        return [GenrePlaytime(*row) for row in genres_sorted.head(n).itertuples(index=False, name=None)]
+
+    def top_games(self, release_year, n=5) -> List[GamePlaytime]:
+        '''
+        Returns the n games with the highest playtime for a release year.
+
+        Parameters:
+        - release_year (int or float): Release year.
+        - n (int, optional): Number of games. Defaults to 5.
+
+        Returns:
+        - list: GamePlaytime results sorted by playtime in descending order.
+
+        Raises:
+        - InvalidQueryError: If the year is not a number or n is not a positive integer.
+        - NoDataError: If there is no data for the year.
+        '''
+        self._check_query(release_year, n)
+        with stage('year_lookup'):
+            games_sorted = self._games_year_index(release_year).descending.get(release_year)
+        if games_sorted is None:
+            raise NoDataError(f'There is no data available for the year {release_year}')
+        if games_sorted.empty:
+            raise NoDataError(f'No data available for year {release_year}')
+        return [GamePlaytime(*row) for row in games_sorted.head(n).itertuples(index=False, name=None)]
+
+    def bottom_games(self, release_year, n=3) -> List[GamePlaytime]:
+        '''
+        Returns the n games with the lowest playtime greater than 0 for a release year.
+
+        Parameters:
+        - release_year (int or float): Release year.
+        - n (int, optional): Number of games. Defaults to 3.
+
+        Returns:
+        - list: GamePlaytime results sorted by playtime in ascending order.
+
+        Raises:
+        - InvalidQueryError: If the year is not a number or n is not a positive integer.
+        - NoDataError: If there is no data for the year, or no game of the year has playtime greater than 0.
+        '''
+        self._check_query(release_year, n)
+        with stage('year_lookup'):
+            games_sorted = self._games_year_index(release_year).ascending.get(release_year)
+        if games_sorted is None:
+            raise NoDataError(f'There is no data available for the year {release_year}')
+        if games_sorted.empty:
+            raise NoDataError(f'No data available for year {release_year} with playtime greater than 0')
+        return [GamePlaytime(*row) for row in games_sorted.head(n).itertuples(index=False, name=None)]
+
+    # Recommenders
+
+    def resolve_item_name(self, item_name) -> Optional[str]:
+        '''
+        Finds the name of a game as written in the data, ignoring case and extra whitespace.
+
+        Parameters:
+        - item_name (str): Game name as typed by the user.
+
+        Returns:
+        - str: Canonical name, or None if the game is unknown.
+        '''
+        return lookup_name(self._name_index(), item_name)
+
+    def suggest_names(self, text, limit=10) -> List[str]:
+        '''
+        Suggests game names for a partially typed name: prefix matches first, then fuzzy matches.
+
+        Parameters:
+        - text (str): Text typed by the user.
+        - limit (int, optional): Maximum number of suggestions. Defaults to 10.
+
+        Returns:
+        - list: Game names as written in the data.
+        '''
+        if not text or not text.strip():
+            return []
+
+        name_index = self._name_index()
+        suggestions = prefix_search(name_index, text, limit=limit)
+        if len(suggestions) < limit:
+            for name in fuzzy_search(name_index, text, limit=limit):
+                if name not in suggestions and len(suggestions) < limit:
+                    suggestions.append(name)
+        return suggestions
+
+    def similar_items(self, item_name, n=5) -> SimilarItems:
+        '''
+        Returns the n games most similar to a game, with their information.
+
+        Parameters:
+        - item_name (str): Name of the game (case-insensitive).
+        - n (int, optional): Number of similar games (at most the k of the neighbor table). Defaults to 5.
+
+        Returns:
+        - SimilarItems: Canonical name of the game and the GameInfo rows of the similar games (in models order).
+
+        Raises:
+        - InvalidQueryError: If n is not a positive integer or is larger than the k of the neighbor table.
+        - NoDataError: If the game is unknown.
+        '''
+        self._check_n(n, self._item_neighbors().neighbors.shape[1])
+        with stage('resolve_name'):
+            selected_game_name = self.resolve_item_name(item_name)
+        if selected_game_name is None:
+            raise NoDataError(f"No recommendations available for the game '{item_name.lower()}'.")
+
+        with stage('item_neighbors'):
+            similar_games = top_neighbors(self._item_neighbors(), selected_game_name, n=n)
+        if similar_games is None:
+            raise NoDataError(f"No recommendations available for the game '{item_name.lower()}'.")
+
+        with stage('item_metadata'):
+            return SimilarItems(selected_game_name, self._items_metadata([game for game, score in similar_games]))
+
+    def item_reviews(self, item_name) -> List[str]:
+        '''
+        Returns the reviews of a game.
+
+        Parameters:
+        - item_name (str): Name of the game (case-insensitive).
+
+        Returns:
+        - list: Review texts, empty if the game is unknown or has no reviews.
+        '''
+        name_index = self._name_index()
+        selected_game_name = lookup_name(name_index, item_name)
+        if selected_game_name is None:
+            return []
+
+        with stage('reviews'):
+            sorted_name = self.data.sorted_copy('models', 'Item_name')
+            if sorted_name is not None:
+                # Only the row groups of the copy sorted by game (reviews.parquet) holding the game are read
+                reviews = self.data.read_dataset(sorted_name, ['Review'], filters=[('Item_name', '==', selected_game_name)])['Review']
+            else:
+                reviews = self.data.load_dataset('models', MODELS_REVIEW_COLUMNS)['Review'].iloc[name_index.rows[selected_game_name]]
+            return reviews.dropna().tolist()
+
+    def item_wordcloud(self, item_name) -> Optional[bytes]:
+        '''
+        Returns the wordcloud of the reviews of a game, from the wordcloud cache.
+        wordcloud is only imported if the image has to be rendered.
+
+        Parameters:
+        - item_name (str): Name of the game (case-insensitive).
+
+        Returns:
+        - bytes: PNG image, or None if the game is unknown or has no reviews.
+        '''
+        from wordcloud_cache import get_wordcloud_png, wordcloud_dir
+
+        selected_game_name = self.resolve_item_name(item_name)
+        if selected_game_name is None:
+            return None
+        return get_wordcloud_png(selected_game_name, self.item_reviews(selected_game_name), wordcloud_dir(self.data.data_dir))
+
+    def similar_user_items_batch(self, users, n=5, chunk_size=128):
+        '''
+        Returns the items most recommended to several users by their similar users, vectorized over chunks of users.
+
+        Parameters:
+        - users (list): User ids.
+        - n (int, optional): Number of recommended items per user. Defaults to 5.
+        - chunk_size (int, optional): Number of users processed together. Bounds memory to
+          n_items x chunk_size vote counts.
+
+        Returns:
+        - dict: user -> list of GameInfo rows (in models order). Unknown users are left out.
+
+        Raises:
+        - InvalidQueryError: If n is not a positive integer.
+        '''
+        self._check_n(n)
+        with stage('user_model'):
+            utility_matrix, user_neighbors = self._user_model()
+        user_columns = utility_matrix.user_positions
+
+        # Users missing from either artifact (e.g. after an incremental update of only one of them) are unknown
+        known_users = list(dict.fromkeys(user for user in users if user in user_columns and user in user_neighbors.positions))
+        results = {}
+        for start in range(0, len(known_users), chunk_size):
+            chunk = known_users[start:start + chunk_size]
+
+            # The most similar users of every user, read from the precomputed top-k table
+            with stage('user_neighbors'):
+                neighbor_columns = np.full((len(chunk), SIMILAR_USERS), -1, dtype=np.int64)
+                for pos, user in enumerate(chunk):
+                    sim_users = [user_columns[similar_user] for similar_user, score in top_neighbors(user_neighbors, user, n=SIMILAR_USERS)
+                                 if similar_user in user_columns]
+                    neighbor_columns[pos, :len(sim_users)] = sim_users
+
+            with stage('vote_count'):
+                top_items = _most_voted_items(neighbor_columns, utility_matrix, n=n)
+            with stage('item_metadata'):
+                for user, top_rows in zip(chunk, top_items):
+                    results[user] = self._items_metadata(utility_matrix.items[top_rows])
+
+        return results
+
+    def similar_user_items(self, user, n=5) -> List[GameInfo]:
+        '''
+        Returns the items most recommended to a user by their similar users.
+
+        Parameters:
+        - user (str): User id.
+        - n (int, optional): Number of recommended items. Defaults to 5.
+
+        Returns:
+        - list: GameInfo rows of the recommended items (in models order).
+
+        Raises:
+        - InvalidQueryError: If n is not a positive integer.
+        - NoDataError: If the user is unknown.
+        '''
+        results = self.similar_user_items_batch([user], n=n)
+        if user not in results:
+            raise NoDataError(f'No data available on user {user}')
+        return results[user]
+
+    # Recommendations of many keys at once, as flat frames (see export.py)
+
+    def item_keys(self):
+        '''
+        Returns every game that similar_items can answer.
+
+        Returns:
+        - np.ndarray: Game names, in the order of the item neighbor table.
+        '''
+        return self._item_neighbors().labels
+
+    def user_keys(self):
+        '''
+        Returns every user that similar_user_items can answer.
+
+        Returns:
+        - np.ndarray: User ids, in the order of the user neighbor table.
+        '''
+        utility_matrix, user_neighbors = self._user_model()
+        user_columns = utility_matrix.user_positions
+        return np.array([user for user in user_neighbors.labels if user in user_columns], dtype=object)
+
+    def similar_items_frame(self, items, n=5) -> pd.DataFrame:
+        '''
+        Returns the recommendations of similar_items for many games in a single frame, gathering the
+        neighbors and the metadata of all of them at once.
+
+        Parameters:
+        - items (list): Game names as written in the data (see item_keys). Unknown games are left out.
+        - n (int, optional): Number of recommended games per game. Defaults to 5.
+
+        Returns:
+        - pd.DataFrame: RECOMMENDATION_FRAME_COLUMNS, the rows of each game as in similar_items.
+
+        Raises:
+        - InvalidQueryError: If n is not a positive integer or is larger than the k of the neighbor table.
+        '''
+        item_neighbors = self._item_neighbors()
+        self._check_n(n, item_neighbors.neighbors.shape[1])
+        items = [item for item in dict.fromkeys(items) if item in item_neighbors.positions]
+        neighbors = item_neighbors.neighbors[[item_neighbors.positions[item] for item in items], :n]
+        key_ids, slots = np.nonzero(neighbors >= 0)
+        return self._metadata_frame(items, key_ids, item_neighbors.labels[neighbors[key_ids, slots]])
+
+    def similar_user_items_frame(self, users, n=5) -> pd.DataFrame:
+        '''
+        Returns the recommendations of similar_user_items for many users in a single frame. The votes of
+        all the users are counted together (see _most_voted_items).
+
+        Parameters:
+        - users (list): User ids (see user_keys). Unknown users are left out.
+        - n (int, optional): Number of recommended items per user. Defaults to 5.
+
+        Returns:
+        - pd.DataFrame: RECOMMENDATION_FRAME_COLUMNS, the rows of each user as in similar_user_items.
+
+        Raises:
+        - InvalidQueryError: If n is not a positive integer.
+        '''
+        self._check_n(n)
+        utility_matrix, user_neighbors = self._user_model()
+        user_columns = utility_matrix.user_positions
+        users = [user for user in dict.fromkeys(users) if user in user_columns and user in user_neighbors.positions]
+
+        # Columns of the similar users, -1 for missing neighbors
+        neighbors = user_neighbors.neighbors[[user_neighbors.positions[user] for user in users], :SIMILAR_USERS]
+        neighbor_columns = np.full(neighbors.shape, -1, dtype=np.int64)
+        valid = neighbors >= 0
+        neighbor_columns[valid] = [user_columns.get(user, -1) for user in user_neighbors.labels[neighbors[valid]]]
+
+        top_rows = _most_voted_items(neighbor_columns, utility_matrix, n=n)
+        key_ids = np.repeat(np.arange(len(users)), [len(rows) for rows in top_rows])
+        items = utility_matrix.items[np.concatenate(top_rows)] if top_rows else np.array([], dtype=object)
+        return self._metadata_frame(users, key_ids, items)
+
+
+_default_engine = None
+_default_engine_lock = threading.Lock()
+
+
+def get_engine():
+    '''
+    Returns the engine of the default data folder, shared by every caller of the process.
+
+    Returns:
+    - RecommendationEngine: The default engine.
+    '''
+    global _default_engine
+    if _default_engine is None:
+        with _default_engine_lock:
+            if _default_engine is None:
+                _default_engine = RecommendationEngine()
+    return _default_engine
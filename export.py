@@ -0,0 +1,255 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+import pyarrow as pa
+import pyarrow.parquet as pq
+from engine import RecommendationEngine
+
+
+# Folder of the exports. Can be overridden for deployments that keep them outside of the repository.
+EXPORT_DIR = os.environ.get('GAMES_EXPORT_DIR', 'exports')
+
+# Recommendations that can be exported: 'users' (similar_user_recs of every user of umatrix_norm) and
+# 'items' (get_recommendations_by_name of every game of the item neighbor table, without wordclouds)
+EXPORT_KINDS = ('users', 'items')
+
+# Schema of the exported rows (engine.RECOMMENDATION_FRAME_COLUMNS). The kind is the partition folder.
+EXPORT_SCHEMA = pa.schema([
+    ('Key', pa.string()),
+    ('Position', pa.int32()),
+    ('Item_name', pa.string()),
+    ('Genres', pa.string()),
+    ('Rating', pa.string()),
+    ('Ranking', pa.float64()),
+])
+
+# Keys computed per task, rows per row group and per file. Memory is bounded by the row group buffer plus
+# MAX_PENDING_PER_WORKER finished chunks per worker.
+EXPORT_CHUNK_SIZE = 2048
+EXPORT_ROW_GROUP_SIZE = 100000
+EXPORT_ROWS_PER_FILE = 2000000
+MAX_PENDING_PER_WORKER = 2
+
+# Seconds between two progress lines
+PROGRESS_INTERVAL = 5
+
+
+# Engine of the process. The parent loads it before starting the pool, so forked workers inherit it.
+_engine = None
+
+
+def _init_worker(data_dir):
+    global _engine
+    if _engine is None:
+        _engine = RecommendationEngine(data_dir)
+
+
+def _recommendation_frame(engine, kind, keys, n):
+    if kind == 'users':
+        return engine.similar_user_items_frame(keys, n=n)
+    return engine.similar_items_frame(keys, n=n)
+
+
+def _export_chunk(kind, keys, n):
+    # Recommendations of a chunk of keys as an Arrow table, computed in a worker
+    return pa.Table.from_pandas(_recommendation_frame(_engine, kind, keys, n), schema=EXPORT_SCHEMA, preserve_index=False)
+
+
+def _ordered_results(pool, tasks, max_pending):
+    # Results in task order, with at most max_pending tasks submitted and not consumed
+    if pool is None:
+        for task in tasks:
+            yield _export_chunk(*task)
+        return
+
+    pending = deque()
+    for task in tasks:
+        pending.append(pool.submit(_export_chunk, *task))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+class _PartitionWriter:
+    # Writes the tables of a partition as row groups of about row_group_size rows, starting a new
+    # part file every rows_per_file rows
+
+    def __init__(self, partition_dir, row_group_size, rows_per_file, compression='snappy'):
+        self.partition_dir = partition_dir
+        self.row_group_size = row_group_size
+        self.rows_per_file = rows_per_file
+        self.compression = compression
+        self.files = 0
+        self.rows = 0
+        self._writer = None
+        self._file_rows = 0
+        self._buffer = []
+        self._buffered = 0
+
+    @property
+    def total_rows(self):
+        return self.rows + self._buffered
+
+    def write(self, table):
+        self._buffer.append(table)
+        self._buffered += table.num_rows
+        if self._buffered >= self.row_group_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffered:
+            return
+        if self._writer is None or self._file_rows >= self.rows_per_file:
+            self._close_file()
+            os.makedirs(self.partition_dir, exist_ok=True)
+            file_path = os.path.join(self.partition_dir, f'part-{self.files:05d}.parquet')
+            self._writer = pq.ParquetWriter(file_path, EXPORT_SCHEMA, compression=self.compression)
+            self.files += 1
+        table = pa.concat_tables(self._buffer)
+        self._writer.write_table(table, row_group_size=self.row_group_size)
+        self._file_rows += table.num_rows
+        self.rows += table.num_rows
+        self._buffer, self._buffered = [], 0
+
+    def _close_file(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            self._file_rows = 0
+
+    def close(self):
+        self._flush()
+        self._close_file()
+
+
+def _progress(kind, done, total, rows, elapsed):
+    rate = done / elapsed if elapsed > 0 else 0.0
+    eta = f', ETA {(total - done) / rate:.0f} s' if rate > 0 and done < total else ''
+    percent = 100 * done / total if total else 100.0
+    print(f'{kind}: {done}/{total} keys ({percent:.1f}%), {rows} rows, {rate:.0f} keys/s{eta}', flush=True)
+
+
+def export_recommendations(output_dir=None, kinds=EXPORT_KINDS, n=5, workers=None, data_dir=None,
+                           chunk_size=EXPORT_CHUNK_SIZE, row_group_size=EXPORT_ROW_GROUP_SIZE,
+                           rows_per_file=EXPORT_ROWS_PER_FILE):
+    '''
+    Precomputes the top-n recommendations of every user and/or every game and writes them to a parquet
+    dataset partitioned by kind (output_dir/kind=users/part-00000.parquet, ...), one row per recommended
+    game with the columns of EXPORT_SCHEMA. The rows of every key are those of similar_user_recs and
+    get_recommendations_by_name. Keys are computed in chunks by a pool of processes, each chunk with a
+    few array operations (see RecommendationEngine.similar_items_frame), and streamed to the files in
+    order, so memory does not grow with the number of keys. Progress and throughput are printed.
+
+    Parameters:
+    - output_dir (str, optional): Folder of the dataset, replaced once the export is complete.
+      Defaults to EXPORT_DIR/recommendations.
+    - kinds (tuple, optional): Kinds to export, see EXPORT_KINDS. Defaults to both.
+    - n (int, optional): Number of recommended games per key. Defaults to 5.
+    - workers (int, optional): Worker processes. Defaults to the number of CPUs; 1 computes in this process.
+    - data_dir (str, optional): Folder with the artifacts. Defaults to data_loader.DATA_DIR.
+    - chunk_size (int, optional): Keys computed per task.
+    - row_group_size (int, optional): Rows per parquet row group.
+    - rows_per_file (int, optional): Rows per part file.
+
+    Returns:
+    - dict: Summary of the export (also written to output_dir/_export.json): keys, rows, files, seconds
+      and keys per second of every kind.
+    '''
+    global _engine
+    unknown = [kind for kind in kinds if kind not in EXPORT_KINDS]
+    if unknown:
+        raise ValueError(f'Unknown kinds {unknown}. Available: {EXPORT_KINDS}')
+    output_dir = output_dir or os.path.join(EXPORT_DIR, 'recommendations')
+    workers = workers or os.cpu_count() or 1
+
+    # Loaded once here: forked workers share the datasets and indexes with this process
+    _engine = RecommendationEngine(data_dir)
+    keys = {kind: _engine.user_keys() if kind == 'users' else _engine.item_keys() for kind in kinds}
+    for kind in kinds:
+        _recommendation_frame(_engine, kind, [], n)
+    print(f'Exporting {", ".join(f"{len(keys[kind])} {kind}" for kind in kinds)} from {_engine.data.data_dir} '
+          f'with {workers} worker{"s" if workers > 1 else ""}', flush=True)
+
+    temp_dir = f'{output_dir.rstrip(os.sep)}.tmp'
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+
+    pool = None
+    if workers > 1:
+        start_methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork' if 'fork' in start_methods else None)
+        pool = ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker, initargs=(data_dir,))
+
+    summary = {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'data_dir': os.path.abspath(_engine.data.data_dir),
+        'data_fingerprint': _engine.data.fingerprint(),
+        'n': n,
+        'workers': workers,
+        'chunk_size': chunk_size,
+        'kinds': {},
+    }
+    try:
+        for kind in kinds:
+            kind_keys = keys[kind]
+            tasks = ((kind, kind_keys[start:start + chunk_size].tolist(), n) for start in range(0, len(kind_keys), chunk_size))
+            writer = _PartitionWriter(os.path.join(temp_dir, f'kind={kind}'), row_group_size, rows_per_file)
+
+            start = last_report = time.perf_counter()
+            done = 0
+            for table in _ordered_results(pool, tasks, workers * MAX_PENDING_PER_WORKER):
+                writer.write(table)
+                done = min(done + chunk_size, len(kind_keys))
+                now = time.perf_counter()
+                if now - last_report >= PROGRESS_INTERVAL:
+                    _progress(kind, done, len(kind_keys), writer.total_rows, now - start)
+                    last_report = now
+            writer.close()
+
+            seconds = time.perf_counter() - start
+            _progress(kind, done, len(kind_keys), writer.rows, seconds)
+            summary['kinds'][kind] = {
+                'keys': len(kind_keys),
+                'rows': writer.rows,
+                'files': writer.files,
+                'seconds': round(seconds, 3),
+                'keys_per_second': round(len(kind_keys) / seconds, 1) if seconds > 0 else None,
+            }
+    except BaseException:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    # Files starting with '_' are skipped by the parquet dataset readers
+    with open(os.path.join(temp_dir, '_export.json'), 'w', encoding='utf-8') as f:
+        json.dump(summary, f, indent=2)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.replace(temp_dir, output_dir)
+    print(f'Recommendations exported to {output_dir}')
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the top-n recommendations of every user and every game to a partitioned parquet dataset.')
+    parser.add_argument('--kinds', nargs='+', choices=EXPORT_KINDS, default=list(EXPORT_KINDS))
+    parser.add_argument('--n', type=int, default=5, help='Recommended games per key')
+    parser.add_argument('--output', default=None, help='Defaults to exports/recommendations (or GAMES_EXPORT_DIR)')
+    parser.add_argument('--workers', type=int, default=None, help='Defaults to the number of CPUs')
+    parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE, help='Keys computed per task')
+    parser.add_argument('--data-dir', default=None, help='Defaults to Data/ (or GAMES_DATA_DIR)')
+    args = parser.parse_args()
+
+    if args.n < 1 or args.chunk_size < 1:
+        sys.exit('--n and --chunk-size must be positive')
+    export_recommendations(args.output, kinds=tuple(args.kinds), n=args.n, workers=args.workers,
+                           data_dir=args.data_dir, chunk_size=args.chunk_size)
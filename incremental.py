@@ -0,0 +1,418 @@
+import argparse
+import os
+import signal
+import threading
+import time
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from data_loader import DataRegistry
+from neighbors import (
+    USER_NEIGHBORS_FILE,
+    encode_labels,
+    decode_labels,
+    load_neighbors,
+    make_neighbor_index,
+    save_neighbors,
+    top_k_similar,
+    user_vectors,
+)
+from utility_matrix import UTILITY_DTYPES, UTILITY_MATRIX_FILE, from_sparse, save_utility_matrix
+
+
+# Columns of the ratings of notebook 32 (df_mod_user)
+RATING_COLUMNS = ['User_id', 'Item_name', 'Ranking']
+
+# File of the ratings state inside the data folder
+RATINGS_STATE_FILE = 'ratings_state.npz'
+
+# Everything an incremental update needs, kept between updates:
+# - items: sorted item names (the rows of umatrix_norm), users: user ids in order of arrival.
+# - item_codes / user_codes / rankings: distinct (item, user, ranking) rows of df_mod_user, items and users as positions.
+# - matrix: umatrix_norm as a float64 CSC item x user matrix, matrix_users: user id of every column
+#   (users without any non-zero normalized rating are left out, as in notebook 32).
+RatingsState = namedtuple('RatingsState', ['items', 'users', 'item_codes', 'user_codes', 'rankings', 'matrix', 'matrix_users'])
+
+# Result of an update: the new state and neighbor table, and the amount of work done
+RatingsUpdate = namedtuple('RatingsUpdate', ['state', 'user_neighbors', 'new_ratings', 'changed_items', 'changed_users', 'rescored_users'])
+
+# Updates of the same process are applied one after the other
+_update_lock = threading.Lock()
+
+
+def _clean_ratings(df_ratings):
+    # Same rows as df_model[['User_id', 'Item_name', 'Ranking']].drop_duplicates(), without missing values
+    return df_ratings[RATING_COLUMNS].dropna().drop_duplicates()
+
+
+def normalized_values(items, users, item_codes, user_codes, rankings, selected_items=None):
+    '''
+    Computes the normalized ratings of notebook 32: mean ranking of every (item, user) pair, scaled per item
+    to [0, 1] with the minimum and maximum of the item (MinMaxScaler), zeros left out.
+
+    Parameters:
+    - items / users (np.ndarray): Item names and user ids.
+    - item_codes / user_codes / rankings (np.ndarray): Distinct ratings, items and users as positions.
+    - selected_items (np.ndarray, optional): Positions of the items to compute. Defaults to every item.
+
+    Returns:
+    - tuple: (item_rows, user_cols, values) arrays with the non-zero normalized ratings.
+    '''
+    if selected_items is not None:
+        selected = np.isin(item_codes, selected_items)
+        item_codes, user_codes, rankings = item_codes[selected], user_codes[selected], rankings[selected]
+
+    # Mean ranking per cell, as pivot_table(aggfunc='mean')
+    n_users = len(users)
+    cells, inverse = np.unique(item_codes.astype(np.int64) * n_users + user_codes, return_inverse=True)
+    means = np.bincount(inverse, weights=rankings) / np.bincount(inverse)
+    item_rows, user_cols = cells // n_users, cells % n_users
+
+    # MinMaxScaler per item (X * scale + min), with a scale of 1 when all the ratings of the item are equal
+    minimum = np.full(len(items), np.inf)
+    maximum = np.full(len(items), -np.inf)
+    np.minimum.at(minimum, item_rows, means)
+    np.maximum.at(maximum, item_rows, means)
+    value_range = maximum - minimum
+    value_range[~(value_range > 0)] = 1.0
+    scale = 1.0 / value_range
+    values = means * scale[item_rows] + (0 - minimum * scale)[item_rows]
+
+    nonzero = values != 0
+    return item_rows[nonzero], user_cols[nonzero], values[nonzero]
+
+
+def _state(items, users, item_codes, user_codes, rankings, item_rows, user_cols, values):
+    # Columns of umatrix_norm: users with a non-zero normalized rating, in order of arrival
+    kept_users = np.unique(user_cols)
+    matrix = sparse.csc_matrix((values, (item_rows, np.searchsorted(kept_users, user_cols))),
+                               shape=(len(items), len(kept_users)))
+    matrix.sort_indices()
+    return RatingsState(items, users, item_codes, user_codes, rankings, matrix, users[kept_users])
+
+
+def build_ratings_state(df_ratings):
+    '''
+    Creates the ratings state from the full ratings table, as a full run of notebook 32 (without the user sample).
+
+    Parameters:
+    - df_ratings (pd.DataFrame): Ratings with the columns User_id, Item_name and Ranking.
+
+    Returns:
+    - RatingsState: The state, with the items and users sorted as in the pivot table of notebook 32.
+    '''
+    df_ratings = _clean_ratings(df_ratings)
+    items, item_codes = np.unique(df_ratings['Item_name'].to_numpy(dtype=object), return_inverse=True)
+    users, user_codes = np.unique(df_ratings['User_id'].to_numpy(dtype=object), return_inverse=True)
+    ratings = (items.astype(object), users.astype(object), item_codes.astype(np.int32), user_codes.astype(np.int32),
+               df_ratings['Ranking'].to_numpy(dtype=np.float64))
+    return _state(*ratings, *normalized_values(*ratings))
+
+
+def add_ratings(state, df_new):
+    '''
+    Adds a batch of ratings to the state, recomputing only the umatrix_norm rows of the items that got new ratings.
+    Ratings already in the state are ignored, new items are inserted in sorted position and new users are
+    appended after the known ones.
+
+    Parameters:
+    - state (RatingsState): Current state.
+    - df_new (pd.DataFrame): New ratings with the columns User_id, Item_name and Ranking.
+
+    Returns:
+    - tuple: (new_state, changed_items, n_new) with the positions (in the new state) of the items that got
+      new ratings and the number of ratings added.
+    '''
+    df_new = _clean_ratings(df_new)
+    new_item_names = df_new['Item_name'].to_numpy(dtype=object)
+    new_user_names = df_new['User_id'].to_numpy(dtype=object)
+
+    # Items stay sorted, so the known items may move: their codes are remapped
+    items = np.union1d(state.items, np.unique(new_item_names)).astype(object)
+    item_moves = np.searchsorted(items, state.items)
+    item_codes = item_moves[state.item_codes].astype(np.int32)
+
+    user_positions = {user: col for col, user in enumerate(state.users)}
+    added_users = [user for user in dict.fromkeys(new_user_names) if user not in user_positions]
+    users = np.concatenate([state.users, np.asarray(added_users, dtype=object)])
+    user_positions.update((user, col) for col, user in enumerate(added_users, start=len(state.users)))
+
+    new_item_codes = np.searchsorted(items, new_item_names).astype(np.int32)
+    new_user_codes = np.fromiter((user_positions[user] for user in new_user_names), dtype=np.int32, count=len(new_user_names))
+    new_rankings = df_new['Ranking'].to_numpy(dtype=np.float64)
+
+    # Ratings already in the state are dropped, as drop_duplicates does over the whole table
+    known = pd.MultiIndex.from_arrays([item_codes, state.user_codes, state.rankings])
+    fresh = ~pd.MultiIndex.from_arrays([new_item_codes, new_user_codes, new_rankings]).isin(known)
+    changed_items = np.unique(new_item_codes[fresh])
+
+    ratings = (items, users,
+               np.concatenate([item_codes, new_item_codes[fresh]]),
+               np.concatenate([state.user_codes, new_user_codes[fresh]]),
+               np.concatenate([state.rankings, new_rankings[fresh]]))
+
+    # Rows of the items without new ratings are kept as they are, the others are normalized again
+    previous = state.matrix.tocoo()
+    previous_rows = item_moves[previous.row]
+    previous_cols = np.fromiter((user_positions[user] for user in state.matrix_users), dtype=np.int64,
+                                count=len(state.matrix_users))[previous.col]
+    unchanged = ~np.isin(previous_rows, changed_items)
+    item_rows, user_cols, values = normalized_values(*ratings, selected_items=changed_items)
+
+    new_state = _state(*ratings,
+                       np.concatenate([previous_rows[unchanged], item_rows]),
+                       np.concatenate([previous_cols[unchanged], user_cols]),
+                       np.concatenate([previous.data[unchanged], values]))
+    return new_state, changed_items, int(fresh.sum())
+
+
+def _users_of_items(matrix, items):
+    # Columns with a stored value in any of the given rows
+    return np.unique(matrix.tocsr()[items].indices)
+
+
+def update_user_neighbors(user_neighbors, labels, vectors, changed, block_size=512):
+    '''
+    Updates a user-user top-k table after some user vectors changed, without scoring every pair of users.
+
+    The changed users are scored against every user. The other users keep their listed neighbors that did not
+    change, merged with their new similarity to the changed users. Users not listed ranked after the old k-th
+    neighbor, so the merge is exact unless a listed neighbor left the list and the new k-th neighbor ranks after
+    the old one: those users are scored again against every user. Merged similarities are compared at the float32
+    precision of the table, so users whose similarities only differ below it may be listed in another order than
+    in a full rebuild.
+
+    Parameters:
+    - user_neighbors (NeighborIndex): Previous table.
+    - labels (np.ndarray): User ids of the new table.
+    - vectors (scipy.sparse.csr_matrix): Normalized user vectors of the new table (see neighbors.user_vectors).
+    - changed (np.ndarray): Boolean mask of the users whose vector changed. Users that are not in the previous
+      table are always scored.
+    - block_size (int, optional): Number of users scored at once.
+
+    Returns:
+    - tuple: (NeighborIndex, n_rescored) with the new table and the number of unchanged users scored again.
+    '''
+    k = user_neighbors.neighbors.shape[1]
+    positions = {label: row for row, label in enumerate(labels)}
+    old_to_new = np.fromiter((positions.get(label, -1) for label in user_neighbors.labels), dtype=np.int64,
+                             count=len(user_neighbors.labels))
+    new_to_old = np.full(len(labels), -1, dtype=np.int64)
+    new_to_old[old_to_new[old_to_new >= 0]] = np.flatnonzero(old_to_new >= 0)
+
+    changed = np.asarray(changed, dtype=bool) | (new_to_old < 0)
+    changed_rows = np.flatnonzero(changed)
+    stable_rows = np.flatnonzero(~changed)
+
+    neighbors = np.full((len(labels), k), -1, dtype=np.int32)
+    scores = np.full((len(labels), k), np.nan, dtype=np.float32)
+    rescore = [changed_rows]
+
+    changed_vectors = vectors[changed_rows].T.tocsc()
+    for start in range(0, len(stable_rows), block_size):
+        rows = stable_rows[start:start + block_size]
+        old_rows = new_to_old[rows]
+
+        # Listed neighbors that are still valid and did not change, with their stored similarity
+        listed = user_neighbors.neighbors[old_rows].astype(np.int64)
+        mapped = np.where(listed >= 0, old_to_new[np.maximum(listed, 0)], -1)
+        kept = (mapped >= 0) & ~changed[np.maximum(mapped, 0)]
+        kept_scores = np.where(kept, user_neighbors.scores[old_rows], -np.inf)
+
+        # Candidates: kept neighbors plus every changed user, sorted by descending similarity and position
+        candidates = np.hstack([np.where(kept, mapped, -1), np.broadcast_to(changed_rows, (len(rows), len(changed_rows)))])
+        candidate_scores = np.hstack([kept_scores, (vectors[rows] @ changed_vectors).toarray()])
+        order = np.lexsort((candidates, -candidate_scores), axis=-1)[:, :k]
+        top = np.take_along_axis(candidates, order, axis=1)
+        top_scores = np.take_along_axis(candidate_scores, order, axis=1)
+        top_scores = np.pad(top_scores, ((0, 0), (0, k - top_scores.shape[1])), constant_values=-np.inf)
+        top = np.pad(top, ((0, 0), (0, k - top.shape[1])), constant_values=-1)
+
+        # A full list that lost neighbors may miss users that were not listed, unless the new k-th neighbor still
+        # ranks before the old one (users keep their relative order, so positions compare across tables)
+        full = (listed >= 0).all(axis=1)
+        old_kth_scores = user_neighbors.scores[old_rows, -1]
+        old_kth = mapped[:, -1]
+        exact = (~full | kept.all(axis=1) | (top_scores[:, -1] > old_kth_scores)
+                 | ((top_scores[:, -1] == old_kth_scores) & (old_kth >= 0) & (top[:, -1] <= old_kth)))
+        rescore.append(rows[~exact])
+
+        valid = np.isfinite(top_scores)
+        neighbors[rows] = np.where(valid, top, -1)
+        scores[rows] = np.where(valid, top_scores, np.nan)
+
+    rescore = np.concatenate(rescore)
+    neighbors[rescore], scores[rescore] = top_k_similar(vectors, rescore, k, block_size=block_size)
+    return make_neighbor_index(labels, neighbors, scores), len(rescore) - len(changed_rows)
+
+
+def apply_ratings(state, user_neighbors, df_new, block_size=512):
+    '''
+    Applies a batch of new ratings: updates the ratings state and umatrix_norm (only the rows of the rated
+    items) and the user-user top-k table (only the users whose vector changed, see update_user_neighbors).
+
+    Every user that rated one of the items changes, since the item rows are L2-normalized before the cosine.
+
+    Parameters:
+    - state (RatingsState): Current state.
+    - user_neighbors (NeighborIndex): Current user-user table, built from state.
+    - df_new (pd.DataFrame): New ratings with the columns User_id, Item_name and Ranking.
+    - block_size (int, optional): Number of users scored at once.
+
+    Returns:
+    - RatingsUpdate: New state and table, with counters of the work done.
+    '''
+    new_state, changed_items, n_new = add_ratings(state, df_new)
+
+    # Users with a stored value in a changed item row, before or after the update
+    changed_labels = set(state.matrix_users[_users_of_items(state.matrix, np.flatnonzero(np.isin(
+        np.searchsorted(new_state.items, state.items), changed_items)))])
+    changed_labels.update(new_state.matrix_users[_users_of_items(new_state.matrix, changed_items)])
+    changed = np.fromiter((user in changed_labels for user in new_state.matrix_users), dtype=bool,
+                          count=len(new_state.matrix_users))
+
+    new_neighbors, n_rescored = update_user_neighbors(user_neighbors, new_state.matrix_users,
+                                                      user_vectors(new_state.matrix), changed, block_size=block_size)
+    return RatingsUpdate(new_state, new_neighbors, n_new, len(changed_items), int(changed.sum()), n_rescored)
+
+
+def save_ratings_state(state, file_path):
+    '''
+    Saves a RatingsState as a compressed .npz file (written next to its destination and renamed).
+
+    Parameters:
+    - state (RatingsState): Ratings state.
+    - file_path (str): Destination path (.npz).
+
+    Returns:
+    - None
+    '''
+    temp_path = f'{file_path}.tmp.npz'
+    np.savez_compressed(temp_path, items=encode_labels(state.items), users=encode_labels(state.users),
+                        item_codes=state.item_codes, user_codes=state.user_codes, rankings=state.rankings,
+                        data=state.matrix.data, indices=state.matrix.indices, indptr=state.matrix.indptr,
+                        shape=np.array(state.matrix.shape), matrix_users=encode_labels(state.matrix_users))
+    os.replace(temp_path, file_path)
+
+
+def load_ratings_state(file_path):
+    '''
+    Loads a RatingsState saved with save_ratings_state.
+
+    Parameters:
+    - file_path (str): Path of the .npz file.
+
+    Returns:
+    - RatingsState: Ratings state.
+    '''
+    with np.load(file_path) as data:
+        matrix = sparse.csc_matrix((data['data'], data['indices'], data['indptr']), shape=tuple(data['shape']))
+        return RatingsState(np.asarray(decode_labels(data['items']), dtype=object),
+                            np.asarray(decode_labels(data['users']), dtype=object),
+                            data['item_codes'], data['user_codes'], data['rankings'], matrix,
+                            np.asarray(decode_labels(data['matrix_users']), dtype=object))
+
+
+def publish(registry, state, user_neighbors, dtype='float32'):
+    '''
+    Writes the runtime artifacts of a state: the compact utility matrix and the user-user table read by the
+    engine, then the state itself. Each file is replaced in a single step.
+
+    Parameters:
+    - registry (DataRegistry): Registry of the data folder.
+    - state (RatingsState): Ratings state.
+    - user_neighbors (NeighborIndex): User-user table of the state.
+    - dtype (str, optional): Stored type of the utility matrix, 'float32' (default) or 'uint8'.
+
+    Returns:
+    - UtilityMatrix: The compact utility matrix that was written.
+    '''
+    os.makedirs(registry.data_dir, exist_ok=True)
+    utility_matrix = from_sparse(state.matrix, state.items, state.matrix_users, dtype=dtype)
+    save_utility_matrix(utility_matrix, registry.artifact_path(UTILITY_MATRIX_FILE))
+    save_neighbors(user_neighbors, registry.artifact_path(USER_NEIGHBORS_FILE))
+    save_ratings_state(state, registry.artifact_path(RATINGS_STATE_FILE))
+    return utility_matrix
+
+
+def initialize(df_ratings, data_dir=None, k=20, dtype='float32', block_size=512):
+    '''
+    Builds the ratings state and the user-based artifacts from the full ratings table (a full rebuild).
+
+    Parameters:
+    - df_ratings (pd.DataFrame): Ratings with the columns User_id, Item_name and Ranking.
+    - data_dir (str, optional): Data folder. Defaults to data_loader.DATA_DIR.
+    - k (int, optional): Number of neighbors kept per user. Defaults to 20.
+    - dtype (str, optional): Stored type of the utility matrix, 'float32' (default) or 'uint8'.
+    - block_size (int, optional): Number of users scored at once.
+
+    Returns:
+    - RatingsState: The new state.
+    '''
+    state = build_ratings_state(df_ratings)
+    vectors = user_vectors(state.matrix)
+    neighbors, scores = top_k_similar(vectors, np.arange(len(state.matrix_users)), k, block_size=block_size)
+    publish(DataRegistry(data_dir), state, make_neighbor_index(state.matrix_users, neighbors, scores), dtype=dtype)
+    return state
+
+
+def update(df_new, data_dir=None, engine=None, dtype='float32', block_size=512):
+    '''
+    Applies a batch of new ratings to the state of a data folder and publishes the result: the artifacts
+    are rewritten and, if an engine is given, it switches to the new data in a single step.
+
+    Parameters:
+    - df_new (pd.DataFrame): New ratings with the columns User_id, Item_name and Ranking.
+    - data_dir (str, optional): Data folder. Defaults to the folder of the engine, or data_loader.DATA_DIR.
+    - engine (RecommendationEngine, optional): Running engine to update.
+    - dtype (str, optional): Stored type of the utility matrix, 'float32' (default) or 'uint8'.
+    - block_size (int, optional): Number of users scored at once.
+
+    Returns:
+    - RatingsUpdate: The applied update.
+    '''
+    registry = engine.data if engine is not None else DataRegistry(data_dir)
+    with _update_lock:
+        state = load_ratings_state(registry.artifact_path(RATINGS_STATE_FILE))
+        user_neighbors = load_neighbors(registry.artifact_path(USER_NEIGHBORS_FILE))
+
+        result = apply_ratings(state, user_neighbors, df_new, block_size=block_size)
+        utility_matrix = publish(registry, result.state, result.user_neighbors, dtype=dtype)
+        if engine is not None:
+            engine.publish_user_model(utility_matrix, result.user_neighbors)
+    return result
+
+
+def _read_ratings(file_path):
+    if file_path.endswith('.csv'):
+        return pd.read_csv(file_path, usecols=RATING_COLUMNS)
+    return pd.read_parquet(file_path, columns=RATING_COLUMNS)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or incrementally update the user-item matrix and the user-user neighbor table.')
+    parser.add_argument('command', choices=['init', 'update'],
+                        help='init: full build from every rating, update: apply a batch of new ratings')
+    parser.add_argument('ratings', help='Parquet or CSV file with the columns User_id, Item_name and Ranking')
+    parser.add_argument('--data-dir', default=None, help='Defaults to Data/ (or GAMES_DATA_DIR)')
+    parser.add_argument('--dtype', choices=UTILITY_DTYPES, default='float32')
+    parser.add_argument('--k', type=int, default=20, help='Neighbors per user (init only)')
+    parser.add_argument('--block-size', type=int, default=512)
+    parser.add_argument('--notify-pid', type=int, default=None,
+                        help='Process id of a running server.py, signalled to reload the published data')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command == 'init':
+        new_state = initialize(_read_ratings(args.ratings), args.data_dir, k=args.k, dtype=args.dtype, block_size=args.block_size)
+        print(f'State built with {len(new_state.rankings)} ratings of {len(new_state.matrix_users)} users '
+              f'in {time.perf_counter() - start:.1f} s')
+    else:
+        applied = update(_read_ratings(args.ratings), args.data_dir, dtype=args.dtype, block_size=args.block_size)
+        print(f'{applied.new_ratings} new ratings applied in {time.perf_counter() - start:.1f} s: '
+              f'{applied.changed_items} items and {applied.changed_users} users changed, '
+              f'{applied.rescored_users} other users scored again')
+
+    if args.notify_pid:
+        os.kill(args.notify_pid, signal.SIGHUP)
@@ -0,0 +1,150 @@
+from bisect import bisect_left
+from collections import namedtuple
+from types import MappingProxyType
+import difflib
+import unicodedata
+import pandas as pd
+
+
+# Orderings of the games of each release year:
+# - descending: every game sorted by playtime from highest to lowest.
+# - ascending: games with playtime greater than 0 sorted from lowest to highest.
+GamesYearIndex = namedtuple('GamesYearIndex', ['descending', 'ascending'])
+
+# Case-insensitive index of the game names of models.parquet:
+# - keys: sorted tuple of normalized names, for prefix search with bisect and fuzzy search.
+# - canonical: dict normalized name -> name as written in the data (first occurrence).
+# - rows: dict name as written in the data -> positions of its rows in models.parquet.
+NameIndex = namedtuple('NameIndex', ['keys', 'canonical', 'rows'])
+
+
+def build_genres_year_index(genres_playtime):
+    '''
+    Precomputes, for every release year, the playtime hours per genre sorted in descending order.
+
+    Parameters:
+    - genres_playtime (pd.DataFrame): DataFrame with columns Genres, Release and Playtime_Millon_Hours (funciones1.parquet).
+
+    Returns:
+    - MappingProxyType: Read-only mapping release year (int) -> DataFrame with columns Genres and
+      Playtime_Millon_Hours, already grouped and sorted.
+    '''
+    release = pd.to_numeric(genres_playtime['Release'], errors='coerce')
+    data = genres_playtime.assign(Release=release).dropna(subset=['Release'])
+
+    index = {}
+    for year, year_df in data.groupby('Release', sort=False):
+        grouped = year_df.groupby('Genres')['Playtime_Millon_Hours'].sum().reset_index()
+        index[int(year)] = grouped.sort_values(by='Playtime_Millon_Hours', ascending=False, kind='mergesort')
+
+    return MappingProxyType(index)
+
+
+def build_games_year_index(games_playtime):
+    '''
+    Precomputes, for every release year, the games sorted by playtime in both directions.
+
+    Parameters:
+    - games_playtime (pd.DataFrame): DataFrame with columns Item_name, Playtime and Release (funciones2.parquet).
+
+    Returns:
+    - GamesYearIndex: Two read-only mappings release year (int) -> DataFrame with columns Item_name and Playtime.
+      Every year present in the data is a key of both mappings, the ascending DataFrame is empty
+      when no game of that year has playtime greater than 0.
+    '''
+    release = pd.to_numeric(games_playtime['Release'], errors='coerce')
+    data = games_playtime.assign(Release=release).dropna(subset=['Release'])
+
+    descending = {}
+    ascending = {}
+    for year, year_df in data.groupby('Release', sort=False):
+        year_df = year_df[['Item_name', 'Playtime']]
+        descending[int(year)] = year_df.sort_values(by='Playtime', ascending=False, kind='mergesort')
+        ascending[int(year)] = year_df[year_df['Playtime'] > 0].sort_values(by='Playtime', ascending=True, kind='mergesort')
+
+    return GamesYearIndex(MappingProxyType(descending), MappingProxyType(ascending))
+
+
+def normalize_name(name):
+    '''
+    Normalizes a game name for case-insensitive lookups: unicode NFKC, case folding and collapsed whitespace.
+
+    Parameters:
+    - name (str): Game name.
+
+    Returns:
+    - str: Normalized name.
+    '''
+    return ' '.join(unicodedata.normalize('NFKC', name).casefold().split())
+
+
+def build_name_index(item_names):
+    '''
+    Builds the case-insensitive name index of the games, scanning the names only once.
+
+    Parameters:
+    - item_names (pd.Series): Item_name column of models.parquet.
+
+    Returns:
+    - NameIndex: Read-only name index. When several spellings share a normalized name, the first one
+      found in the data is the canonical name.
+    '''
+    rows = MappingProxyType(item_names.groupby(item_names, sort=False).indices)
+
+    canonical = {}
+    for name in rows:
+        canonical.setdefault(normalize_name(name), name)
+
+    return NameIndex(tuple(sorted(canonical)), MappingProxyType(canonical), rows)
+
+
+def lookup_name(index, name):
+    '''
+    Finds the canonical name of a game, ignoring case and extra whitespace.
+
+    Parameters:
+    - index (NameIndex): Name index.
+    - name (str): Game name as typed by the user.
+
+    Returns:
+    - str: Name of the game as written in the data, or None if the game is unknown.
+    '''
+    return index.canonical.get(normalize_name(name))
+
+
+def prefix_search(index, prefix, limit=10):
+    '''
+    Returns the games whose normalized name starts with the given text, in alphabetical order.
+
+    Parameters:
+    - index (NameIndex): Name index.
+    - prefix (str): Text typed by the user.
+    - limit (int, optional): Maximum number of names to return. Defaults to 10.
+
+    Returns:
+    - list: Canonical names of the matching games.
+    '''
+    prefix = normalize_name(prefix)
+    matches = []
+    position = bisect_left(index.keys, prefix)
+    while position < len(index.keys) and len(matches) < limit and index.keys[position].startswith(prefix):
+        matches.append(index.canonical[index.keys[position]])
+        position += 1
+    return matches
+
+
+def fuzzy_search(index, name, limit=5, cutoff=0.6):
+    '''
+    Returns the games whose normalized name is the most similar to the given text (difflib ratio).
+
+    Parameters:
+    - index (NameIndex): Name index.
+    - name (str): Text typed by the user.
+    - limit (int, optional): Maximum number of names to return. Defaults to 5.
+    - cutoff (float, optional): Minimum similarity, between 0 and 1. Defaults to 0.6.
+
+    Returns:
+    - list: Canonical names of the matching games, most similar first.
+    '''
+    matches = difflib.get_close_matches(normalize_name(name), index.keys, n=limit, cutoff=cutoff)
+    return [index.canonical[key] for key in matches]
@@ -0,0 +1,464 @@
+import contextvars
+import functools
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+
+
+# Upper bounds (seconds) of the latency histogram buckets of the public functions
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Number of request traces kept per process (the oldest are dropped first)
+TRACE_HISTORY = 100
+
+# Prefix of the exported metric names
+METRIC_PREFIX = 'games'
+
+# Instrumentation (timings) is on unless GAMES_INSTRUMENTATION=0
+ENABLED = os.environ.get('GAMES_INSTRUMENTATION', '1') != '0'
+
+# Allocated memory blocks are counted per 'request', per 'stage' (and request) or not at all ('off').
+# sys.getallocatedblocks walks the whole heap, so each count costs ~10 us once the datasets are loaded.
+ALLOCATION_LEVELS = ('off', 'request', 'stage')
+ALLOCATIONS = os.environ.get('GAMES_ALLOCATIONS', 'off')
+
+# Interval (milliseconds) of the sampling profiler started on import, off when empty
+PROFILER_INTERVAL_MS = os.environ.get('GAMES_PROFILER', '')
+
+# Trace of the request running in the current thread (or task), None outside of a request
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+
+
+class Metrics:
+    '''
+    Thread-safe aggregates of the instrumented requests of a process: latency histogram, errors and allocated
+    blocks per public function, time, calls and allocated blocks per stage, plus the last request traces.
+    '''
+
+    def __init__(self, buckets=LATENCY_BUCKETS, history=TRACE_HISTORY):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._functions = {}
+        self._stages = {}
+        self._traces = deque(maxlen=history)
+
+    def record_request(self, trace):
+        '''
+        Adds a finished request trace to the aggregates and to the trace history.
+
+        Parameters:
+        - trace (dict): Trace built by request_trace.
+
+        Returns:
+        - None
+        '''
+        seconds = trace['duration_ms'] / 1000
+        with self._lock:
+            function = self._functions.setdefault(trace['function'], {
+                'buckets': [0] * len(self.buckets), 'count': 0, 'sum': 0.0, 'errors': 0, 'allocated_blocks': 0})
+            function['count'] += 1
+            function['sum'] += seconds
+            function['errors'] += trace['status'] != 'ok'
+            function['allocated_blocks'] += max(trace['allocated_blocks'] or 0, 0)
+            for position, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    function['buckets'][position] += 1
+
+            for stage in trace['stages']:
+                key = (trace['function'], stage['name'])
+                totals = self._stages.setdefault(key, {'count': 0, 'sum': 0.0, 'allocated_blocks': 0})
+                totals['count'] += 1
+                totals['sum'] += stage['duration_ms'] / 1000
+                totals['allocated_blocks'] += max(stage.get('allocated_blocks') or 0, 0)
+
+            self._traces.append(trace)
+
+    def traces(self, n=None):
+        '''
+        Returns the last request traces, most recent last.
+
+        Parameters:
+        - n (int, optional): Number of traces. All the kept traces if None.
+
+        Returns:
+        - list: Trace dicts.
+        '''
+        with self._lock:
+            traces = list(self._traces)
+        return traces if n is None else traces[-n:]
+
+    def snapshot(self):
+        '''
+        Returns a copy of the aggregates.
+
+        Returns:
+        - dict: {'functions': {name: totals}, 'stages': {(function, stage): totals}}.
+        '''
+        with self._lock:
+            return {
+                'functions': {name: dict(totals, buckets=list(totals['buckets'])) for name, totals in self._functions.items()},
+                'stages': {key: dict(totals) for key, totals in self._stages.items()},
+            }
+
+    def prometheus_text(self, prefix=METRIC_PREFIX):
+        '''
+        Exports the aggregates in the Prometheus text exposition format.
+
+        Parameters:
+        - prefix (str, optional): Prefix of the metric names. Defaults to 'games'.
+
+        Returns:
+        - str: The metrics text.
+        '''
+        snapshot = self.snapshot()
+        lines = [
+            f'# HELP {prefix}_request_duration_seconds Latency of the public functions.',
+            f'# TYPE {prefix}_request_duration_seconds histogram',
+        ]
+        for name, totals in sorted(snapshot['functions'].items()):
+            label = f'function="{_escape(name)}"'
+            for bound, count in zip(self.buckets, totals['buckets']):
+                lines.append(f'{prefix}_request_duration_seconds_bucket{{{label},le="{bound}"}} {count}')
+            lines.append(f'{prefix}_request_duration_seconds_bucket{{{label},le="+Inf"}} {totals["count"]}')
+            lines.append(f'{prefix}_request_duration_seconds_sum{{{label}}} {totals["sum"]:.6f}')
+            lines.append(f'{prefix}_request_duration_seconds_count{{{label}}} {totals["count"]}')
+
+        for metric, key, help_text in (
+                ('request_errors_total', 'errors', 'Requests that raised an exception.'),
+                ('request_allocated_blocks_total', 'allocated_blocks', 'Net Python memory blocks allocated by the requests.')):
+            lines += [f'# HELP {prefix}_{metric} {help_text}', f'# TYPE {prefix}_{metric} counter']
+            for name, totals in sorted(snapshot['functions'].items()):
+                lines.append(f'{prefix}_{metric}{{function="{_escape(name)}"}} {totals[key]}')
+
+        for metric, key, help_text, kind in (
+                ('stage_duration_seconds_total', 'sum', 'Time spent in each stage of the public functions.', 'counter'),
+                ('stage_calls_total', 'count', 'Calls of each stage of the public functions.', 'counter'),
+                ('stage_allocated_blocks_total', 'allocated_blocks', 'Net Python memory blocks allocated by each stage.', 'counter')):
+            lines += [f'# HELP {prefix}_{metric} {help_text}', f'# TYPE {prefix}_{metric} {kind}']
+            for (function, stage), totals in sorted(snapshot['stages'].items()):
+                value = f'{totals[key]:.6f}' if key == 'sum' else totals[key]
+                lines.append(f'{prefix}_{metric}{{function="{_escape(function)}",stage="{_escape(stage)}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        '''
+        Drops the aggregates and the trace history.
+
+        Returns:
+        - None
+        '''
+        with self._lock:
+            self._functions.clear()
+            self._stages.clear()
+            self._traces.clear()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Aggregates of the process, used by the helpers below
+_default_metrics = Metrics()
+
+# Functions adding the metrics of other modules (e.g. cache counters) to prometheus_text
+_collectors = []
+
+
+@contextmanager
+def request_trace(function_name):
+    '''
+    Traces a request: the stages run inside the block are added to its trace, which is recorded in the
+    process metrics when the block ends. A request started inside another one is traced as a stage of it.
+
+    Parameters:
+    - function_name (str): Name of the public function (or endpoint) answering the request.
+
+    Returns:
+    - context manager yielding the trace dict (function, start, duration_ms, status, allocated_blocks, stages).
+      allocated_blocks is None when allocations are not counted (see ALLOCATIONS).
+    '''
+    if not ENABLED or _current_trace.get() is not None:
+        with stage(function_name):
+            yield _current_trace.get()
+        return
+
+    trace = {'function': function_name, 'start': time.time(), 'duration_ms': 0.0, 'status': 'ok',
+             'allocated_blocks': None, 'stages': [], '_depth': 0}
+    token = _current_trace.set(trace)
+    blocks = sys.getallocatedblocks() if ALLOCATIONS != 'off' else None
+    start = time.perf_counter()
+    try:
+        yield trace
+    except BaseException as e:
+        trace['status'] = type(e).__name__
+        raise
+    finally:
+        trace['duration_ms'] = round((time.perf_counter() - start) * 1000, 4)
+        if blocks is not None:
+            trace['allocated_blocks'] = sys.getallocatedblocks() - blocks
+        del trace['_depth']
+        _current_trace.reset(token)
+        _default_metrics.record_request(trace)
+
+
+@contextmanager
+def stage(name):
+    '''
+    Times a stage of the current request (e.g. a lookup or a render). Outside of a request, or with the
+    instrumentation disabled, it does nothing.
+
+    Parameters:
+    - name (str): Name of the stage.
+
+    Returns:
+    - context manager.
+    '''
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    entry = {'name': name, 'depth': trace['_depth'], 'duration_ms': 0.0}
+    trace['stages'].append(entry)
+    trace['_depth'] += 1
+    blocks = sys.getallocatedblocks() if ALLOCATIONS == 'stage' else None
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        entry['duration_ms'] = round((time.perf_counter() - start) * 1000, 4)
+        if blocks is not None:
+            entry['allocated_blocks'] = sys.getallocatedblocks() - blocks
+        trace['_depth'] -= 1
+
+
+def instrumented(function):
+    '''
+    Decorator that traces every call of a public function as a request (see request_trace).
+
+    Parameters:
+    - function (callable): The public function.
+
+    Returns:
+    - callable: The traced function.
+    '''
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with request_trace(function.__name__):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def set_allocations(level):
+    '''
+    Changes how allocated memory blocks are counted from the next request on.
+
+    Parameters:
+    - level (str): 'off', 'request' or 'stage'.
+
+    Returns:
+    - None
+    '''
+    global ALLOCATIONS
+    if level not in ALLOCATION_LEVELS:
+        raise ValueError(f'Invalid allocation level {level!r}. Use one of {ALLOCATION_LEVELS}.')
+    ALLOCATIONS = level
+
+
+def last_trace():
+    '''
+    Returns the trace of the last request of the process (None if there was none).
+    '''
+    traces = _default_metrics.traces(1)
+    return traces[0] if traces else None
+
+
+def traces(n=None):
+    '''
+    Returns the last request traces of the process. See Metrics.traces.
+    '''
+    return _default_metrics.traces(n)
+
+
+def register_collector(collector):
+    '''
+    Adds the metrics of another module to the exported text.
+
+    Parameters:
+    - collector (callable): Function without arguments returning Prometheus text lines (list of str).
+
+    Returns:
+    - None
+    '''
+    if collector not in _collectors:
+        _collectors.append(collector)
+
+
+def prometheus_text():
+    '''
+    Returns the metrics of the process, plus those of the registered collectors, in the Prometheus text
+    format. See Metrics.prometheus_text.
+    '''
+    lines = [line for collector in _collectors for line in collector()]
+    return _default_metrics.prometheus_text() + ''.join(line + '\n' for line in lines)
+
+
+def reset_metrics():
+    '''
+    Drops the metrics and traces of the process. See Metrics.reset.
+    '''
+    _default_metrics.reset()
+
+
+def format_trace(trace):
+    '''
+    Formats a request trace as text, one indented line per stage.
+
+    Parameters:
+    - trace (dict): Trace of request_trace.
+
+    Returns:
+    - str: The trace as text.
+    '''
+    blocks = f", {trace['allocated_blocks']} blocks" if trace['allocated_blocks'] is not None else ''
+    lines = [f"{trace['function']}: {trace['duration_ms']:.3f} ms{blocks}, {trace['status']}"]
+    for entry in trace['stages']:
+        blocks = f", {entry['allocated_blocks']} blocks" if 'allocated_blocks' in entry else ''
+        lines.append(f"{'  ' * (entry['depth'] + 1)}{entry['name']}: {entry['duration_ms']:.3f} ms{blocks}")
+    return '\n'.join(lines)
+
+
+class SamplingProfiler:
+    '''
+    Opt-in statistical profiler: a background thread records the Python stack of every other thread at a fixed
+    interval, so the hot paths show up without tracing every call. Stacks are counted in the collapsed format
+    of flame graph tools ('file:function;file:function count').
+    '''
+
+    def __init__(self, interval=0.005):
+        '''
+        Parameters:
+        - interval (float, optional): Seconds between samples. Defaults to 5 ms.
+        '''
+        self.interval = interval
+        self.samples = Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}')
+                    frame = frame.f_back
+                with self._lock:
+                    self.samples[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        '''
+        Starts sampling (no-op if already running).
+
+        Returns:
+        - SamplingProfiler: self.
+        '''
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        '''
+        Stops sampling, keeping the samples.
+
+        Returns:
+        - SamplingProfiler: self.
+        '''
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        return self
+
+    @property
+    def running(self):
+        # A profiler inherited through fork has no sampling thread in the child
+        return self._thread is not None and self._thread.is_alive()
+
+    def collapsed(self):
+        '''
+        Returns the samples in the collapsed stack format, most sampled stacks first.
+
+        Returns:
+        - str: One 'stack count' line per distinct stack.
+        '''
+        with self._lock:
+            return '\n'.join(f'{stack} {count}' for stack, count in self.samples.most_common())
+
+    def top_functions(self, n=20):
+        '''
+        Returns the functions found most often on top of the sampled stacks (self time).
+
+        Parameters:
+        - n (int, optional): Number of functions. Defaults to 20.
+
+        Returns:
+        - list: (function, samples) tuples.
+        '''
+        counts = Counter()
+        with self._lock:
+            for stack, count in self.samples.items():
+                counts[stack.rsplit(';', 1)[-1]] += count
+        return counts.most_common(n)
+
+
+_profiler = None
+_profiler_lock = threading.Lock()
+
+
+def start_profiler(interval=0.005):
+    '''
+    Starts the sampling profiler of the process (see SamplingProfiler), or returns the running one.
+
+    Parameters:
+    - interval (float, optional): Seconds between samples. Defaults to 5 ms.
+
+    Returns:
+    - SamplingProfiler: The running profiler.
+    '''
+    global _profiler
+    with _profiler_lock:
+        if _profiler is None or not _profiler.running:
+            _profiler = SamplingProfiler(interval).start()
+        return _profiler
+
+
+def stop_profiler():
+    '''
+    Stops the sampling profiler of the process.
+
+    Returns:
+    - SamplingProfiler: The stopped profiler with its samples, or None if it was never started.
+    '''
+    with _profiler_lock:
+        return _profiler.stop() if _profiler is not None else None
+
+
+def get_profiler():
+    '''
+    Returns the sampling profiler of the process (running or stopped), or None if it was never started.
+    '''
+    return _profiler
+
+
+if PROFILER_INTERVAL_MS:
+    start_profiler(float(PROFILER_INTERVAL_MS) / 1000)
@@ -0,0 +1,435 @@
+import argparse
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from data_loader import DataRegistry
+
+
+# Top-k neighbor table stored as flat arrays:
+# - labels: name of every entity (game or user), the row of an entity is its position.
+# - neighbors: (n_entities, k) int32 array with the rows of the k most similar entities, -1 when there are fewer than k.
+# - scores: (n_entities, k) float32 array with the similarity of each neighbor, sorted in descending order.
+# - positions: dict label -> row, to answer lookups in O(1).
+NeighborIndex = namedtuple('NeighborIndex', ['labels', 'neighbors', 'scores', 'positions'])
+
+# Scoring modes for the item-item index:
+# - 'cosine': cosine similarity between the genre vectors of two games.
+# - 'second_order': similarity of similarities, i.e. game_sim_df.dot(game_sim_df.loc[game]),
+#   the ranking produced by get_recommendations_by_name with the dense game_sim matrix.
+ITEM_MODES = ('cosine', 'second_order')
+
+# File of the precomputed user-user table inside the data folder
+USER_NEIGHBORS_FILE = 'user_neighbors.npz'
+
+
+def make_neighbor_index(labels, neighbors, scores):
+    '''
+    Creates a NeighborIndex from its arrays, computing the label -> row mapping.
+
+    Parameters:
+    - labels (array-like): Name of every entity.
+    - neighbors (np.ndarray): (n_entities, k) array with the rows of the neighbors.
+    - scores (np.ndarray): (n_entities, k) array with the similarity of each neighbor.
+
+    Returns:
+    - NeighborIndex: The neighbor table.
+    '''
+    labels = np.asarray(labels, dtype=object)
+    positions = {label: row for row, label in enumerate(labels)}
+    return NeighborIndex(labels, np.asarray(neighbors, dtype=np.int32), np.asarray(scores, dtype=np.float32), positions)
+
+
+def genre_matrix(df_mod_game):
+    '''
+    Builds the sparse game x genre matrix of notebook 32 (pivot of df_mod_game), with L2-normalized rows.
+
+    Parameters:
+    - df_mod_game (pd.DataFrame): DataFrame with one row per (Item_name, Genres) pair (df_mod_game.parquet).
+
+    Returns:
+    - tuple: (labels, matrix) where labels are the sorted game names and matrix is a CSR matrix
+      with one normalized row per game.
+    '''
+    labels, item_codes = np.unique(df_mod_game['Item_name'].to_numpy(dtype=object), return_inverse=True)
+    genres, genre_codes = np.unique(df_mod_game['Genres'].to_numpy(dtype=object), return_inverse=True)
+
+    matrix = sparse.csr_matrix((np.ones(len(item_codes)), (item_codes, genre_codes)), shape=(len(labels), len(genres)))
+    # Repeated (game, genre) pairs count once, as in the pivot table
+    matrix.data[:] = 1.0
+
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.0
+    matrix = sparse.diags(1.0 / norms) @ matrix
+
+    return labels, matrix.tocsr()
+
+
+def top_k_rows(scores, k, exclude=None):
+    '''
+    Selects the k highest scores of every row of a dense block, breaking ties by column position.
+
+    Parameters:
+    - scores (np.ndarray): (n_rows, n_cols) array of similarities.
+    - k (int): Number of neighbors to keep per row.
+    - exclude (np.ndarray, optional): Column to exclude for each row (the entity itself).
+
+    Returns:
+    - tuple: (neighbors, scores) arrays of shape (n_rows, k), padded with -1 and nan.
+    '''
+    scores = np.array(scores, dtype=np.float64)
+    n_rows, n_cols = scores.shape
+    if exclude is not None:
+        scores[np.arange(n_rows), exclude] = -np.inf
+
+    k_eff = min(k, n_cols)
+    top_cols = np.full((n_rows, k), -1, dtype=np.int32)
+    top_scores = np.full((n_rows, k), np.nan, dtype=np.float32)
+    if k_eff == 0:
+        return top_cols, top_scores
+
+    # k-th largest value of every row: everything above it is selected, ties on it go by position
+    kth = -np.partition(-scores, k_eff - 1, axis=1)[:, k_eff - 1]
+
+    for row in range(n_rows):
+        row_scores = scores[row]
+        above = np.flatnonzero(row_scores > kth[row])
+        tied = np.flatnonzero(row_scores == kth[row])[:k_eff - len(above)]
+        selected = np.concatenate([above, tied])
+        # Descending score, ascending position for ties
+        selected = selected[np.lexsort((selected, -row_scores[selected]))]
+        selected = selected[np.isfinite(row_scores[selected])]
+
+        top_cols[row, :len(selected)] = selected
+        top_scores[row, :len(selected)] = row_scores[selected]
+
+    return top_cols, top_scores
+
+
+# Matrices of the worker processes of top_k_blocks / similarity_blocks, set once per worker
+_worker_matrices = None
+
+
+def _init_worker(left, right):
+    global _worker_matrices
+    _worker_matrices = (left, right)
+
+
+def _top_k_block(left, right, rows, k):
+    return top_k_rows((left[rows] @ right).toarray(), k, exclude=rows)
+
+
+def _similarity_block(left, right, rows):
+    return (left[rows] @ right).toarray()
+
+
+def _call_in_worker(function, rows, *args):
+    return function(*_worker_matrices, rows, *args)
+
+
+def map_blocks(function, left, right, blocks, workers, *args):
+    '''
+    Applies function(left, right, rows, *args) to every block of rows, in order. Blocks are scored in worker
+    processes when several workers are requested, each worker receiving the matrices once.
+
+    Parameters:
+    - function (callable): Module-level function (picklable) scoring one block.
+    - left, right: Matrices passed to every call.
+    - blocks (list): Blocks of rows (or any per-call argument).
+    - workers (int): Number of processes, 1 scores the blocks in this process.
+    - *args: Extra arguments of every call.
+
+    Returns:
+    - generator: Results of the calls, in the order of blocks.
+    '''
+    if workers > 1 and len(blocks) > 1:
+        with ProcessPoolExecutor(min(workers, len(blocks)), initializer=_init_worker, initargs=(left, right)) as pool:
+            yield from pool.map(_call_in_worker, repeat(function), blocks, *(repeat(arg) for arg in args))
+    else:
+        for rows in blocks:
+            yield function(left, right, rows, *args)
+
+
+def row_blocks(rows, block_size):
+    '''
+    Splits rows into consecutive blocks of at most block_size rows.
+
+    Parameters:
+    - rows (np.ndarray): Rows to split.
+    - block_size (int): Maximum number of rows per block.
+
+    Returns:
+    - list: The blocks, as slices of rows.
+    '''
+    return [rows[start:start + block_size] for start in range(0, len(rows), block_size)]
+
+
+def top_k_blocks(left, right, rows, k, block_size=512, workers=1):
+    '''
+    Computes the k highest scores of some rows of left @ right, a block of rows at a time, so the dense
+    score matrix is never materialized. Row i of left and column i of right are the same entity, which is
+    never its own neighbor.
+
+    Parameters:
+    - left (scipy.sparse.csr_matrix): (n_entities, n_features) matrix.
+    - right (scipy.sparse.csc_matrix): (n_features, n_entities) matrix.
+    - rows (np.ndarray): Rows to score.
+    - k (int): Number of neighbors to keep per row.
+    - block_size (int, optional): Number of rows scored at once. Bounds memory to block_size x n_entities floats per worker.
+    - workers (int, optional): Number of processes scoring blocks in parallel. Defaults to 1 (no processes).
+
+    Returns:
+    - tuple: (neighbors, scores) arrays of shape (len(rows), k), padded with -1 and nan.
+    '''
+    neighbors = np.full((len(rows), k), -1, dtype=np.int32)
+    scores = np.full((len(rows), k), np.nan, dtype=np.float32)
+    start = 0
+    for block_neighbors, block_scores in map_blocks(_top_k_block, left, right, row_blocks(rows, block_size), workers, k):
+        stop = start + len(block_neighbors)
+        neighbors[start:stop], scores[start:stop] = block_neighbors, block_scores
+        start = stop
+    return neighbors, scores
+
+
+def similarity_blocks(left, right, block_size=512, workers=1):
+    '''
+    Computes the dense matrix left @ right a block of rows at a time, optionally in parallel processes.
+    Used to write the dense user_sim / game_sim matrices of notebook 32.
+
+    Parameters:
+    - left (scipy.sparse.csr_matrix): (n_rows, n_features) matrix.
+    - right (scipy.sparse.csc_matrix): (n_features, n_cols) matrix.
+    - block_size (int, optional): Number of rows computed at once.
+    - workers (int, optional): Number of processes computing blocks in parallel. Defaults to 1 (no processes).
+
+    Returns:
+    - np.ndarray: (n_rows, n_cols) float64 array.
+    '''
+    result = np.empty((left.shape[0], right.shape[1]), dtype=np.float64)
+    start = 0
+    for block in map_blocks(_similarity_block, left, right, row_blocks(np.arange(left.shape[0]), block_size), workers):
+        result[start:start + len(block)] = block
+        start += len(block)
+    return result
+
+
+def item_scoring_matrices(matrix, mode='second_order'):
+    '''
+    Returns the (left, right) matrices whose product scores every pair of games in the given mode.
+
+    Parameters:
+    - matrix (scipy.sparse.csr_matrix): Normalized game x genre matrix (see genre_matrix).
+    - mode (str, optional): 'second_order' (default) or 'cosine'. See ITEM_MODES.
+
+    Returns:
+    - tuple: (left, right) with left @ right the game x game scores.
+    '''
+    if mode not in ITEM_MODES:
+        raise ValueError(f'Unknown mode {mode!r}. Available: {ITEM_MODES}')
+
+    # S = G G^T, so S.dot(S[i]) = G (G^T G) G^T[:, i]: only the small genre x genre product is needed
+    left = matrix
+    if mode == 'second_order':
+        genre_gram = (matrix.T @ matrix).toarray()
+        left = sparse.csr_matrix(matrix @ genre_gram)
+    return left, matrix.T.tocsc()
+
+
+def build_item_neighbors(df_mod_game, k=20, mode='second_order', block_size=1024, workers=1, backend=None):
+    '''
+    Precomputes the k most similar games of every game from the genre matrix, without building
+    the dense N x N similarity matrix: similarities are computed in blocks of rows.
+
+    Parameters:
+    - df_mod_game (pd.DataFrame): DataFrame with one row per (Item_name, Genres) pair (df_mod_game.parquet).
+    - k (int, optional): Number of neighbors to keep per game. Defaults to 20.
+    - mode (str, optional): 'second_order' (default) reproduces the ranking of the dense game_sim_df.dot
+      of get_recommendations_by_name, 'cosine' ranks by the plain cosine similarity. See ITEM_MODES.
+    - block_size (int, optional): Number of games scored at once. Bounds memory to block_size x N floats.
+    - workers (int, optional): Number of processes scoring blocks in parallel. Defaults to 1.
+    - backend (optional): Similarity backend of ann.py (e.g. ann.make_backend('lsh')). Defaults to the
+      exact scores of top_k_blocks.
+
+    Returns:
+    - NeighborIndex: Top-k neighbor table of the games. The game itself is never its own neighbor.
+    '''
+    labels, matrix = genre_matrix(df_mod_game)
+    left, right = item_scoring_matrices(matrix, mode)
+    top_k = backend.top_k if backend is not None else top_k_blocks
+    neighbors, scores = top_k(left, right, np.arange(len(labels)), k, block_size=block_size, workers=workers)
+    return make_neighbor_index(labels, neighbors, scores)
+
+
+def user_vectors(item_user_matrix):
+    '''
+    Builds the L2-normalized user vectors used by notebook 32 for the user-user cosine similarity:
+    the item rows are normalized first (sklearn normalize), then every user column.
+
+    Parameters:
+    - item_user_matrix (scipy.sparse matrix): Item x user rating matrix.
+
+    Returns:
+    - scipy.sparse.csr_matrix: User x item matrix with one normalized row per user.
+    '''
+    matrix = sparse.csr_matrix(item_user_matrix, dtype=np.float64)
+
+    # Row (item) normalization, as normalize(um_sparse) in the notebook
+    item_norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    item_norms[item_norms == 0] = 1.0
+    matrix = (sparse.diags(1.0 / item_norms) @ matrix).T.tocsr()
+
+    # Column (user) normalization, done by cosine_similarity in the notebook
+    user_norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    user_norms[user_norms == 0] = 1.0
+    matrix = sparse.diags(1.0 / user_norms) @ matrix
+
+    return matrix.tocsr()
+
+
+def user_matrix(umatrix_norm):
+    '''
+    Builds the sparse, L2-normalized user vectors of umatrix_norm. See user_vectors.
+
+    Parameters:
+    - umatrix_norm (pd.DataFrame): Normalized item x user rating matrix (umatrix_norm.parquet).
+
+    Returns:
+    - tuple: (labels, matrix) where labels are the user ids and matrix is a CSR user x item matrix
+      with one normalized row per user.
+    '''
+    matrix = user_vectors(sparse.csr_matrix(umatrix_norm.to_numpy(dtype=np.float64)))
+    return np.asarray(umatrix_norm.columns, dtype=object), matrix
+
+
+def top_k_similar(matrix, rows, k, block_size=512, workers=1, backend=None):
+    '''
+    Computes the k most similar users of some users by blocked sparse cosine similarity against every user.
+
+    Parameters:
+    - matrix (scipy.sparse.csr_matrix): Normalized user vectors (see user_vectors).
+    - rows (np.ndarray): Rows of the users to score.
+    - k (int): Number of neighbors to keep per user.
+    - block_size (int, optional): Number of users scored at once. Bounds memory to block_size x n_users floats.
+    - workers (int, optional): Number of processes scoring blocks in parallel. Defaults to 1.
+    - backend (optional): Similarity backend of ann.py. Defaults to the exact scores of top_k_blocks.
+
+    Returns:
+    - tuple: (neighbors, scores) arrays of shape (len(rows), k), padded with -1 and nan. A user is never its own neighbor.
+    '''
+    top_k = backend.top_k if backend is not None else top_k_blocks
+    return top_k(matrix, matrix.T.tocsc(), rows, k, block_size=block_size, workers=workers)
+
+
+def build_user_neighbors(umatrix_norm, k=20, block_size=512, workers=1, backend=None):
+    '''
+    Precomputes the k most similar users of every user with a blocked sparse cosine similarity,
+    so the dense users x users matrix (user_sim.parquet) is never materialized.
+
+    Parameters:
+    - umatrix_norm (pd.DataFrame): Normalized item x user rating matrix (umatrix_norm.parquet).
+    - k (int, optional): Number of neighbors to keep per user. Defaults to 20.
+    - block_size (int, optional): Number of users scored at once. Bounds memory to block_size x n_users floats.
+    - workers (int, optional): Number of processes scoring blocks in parallel. Defaults to 1.
+    - backend (optional): Similarity backend of ann.py. Defaults to the exact scores of top_k_blocks.
+
+    Returns:
+    - NeighborIndex: Top-k neighbor table of the users. The user itself is never its own neighbor.
+    '''
+    labels, matrix = user_matrix(umatrix_norm)
+    neighbors, scores = top_k_similar(matrix, np.arange(len(labels)), k, block_size=block_size, workers=workers, backend=backend)
+    return make_neighbor_index(labels, neighbors, scores)
+
+
+def top_neighbors(index, label, n=5):
+    '''
+    Returns the n most similar entities of a given entity, in O(n).
+
+    Parameters:
+    - index (NeighborIndex): Neighbor table.
+    - label (str): Name of the entity.
+    - n (int, optional): Number of neighbors to return (at most the k of the index). Defaults to 5.
+
+    Returns:
+    - list: List of (label, score) tuples sorted by descending similarity, or None if the label is unknown.
+    '''
+    row = index.positions.get(label)
+    if row is None:
+        return None
+
+    cols = index.neighbors[row, :n]
+    valid = cols >= 0
+    return list(zip(index.labels[cols[valid]], index.scores[row, :n][valid].tolist()))
+
+
+def encode_labels(labels):
+    # Labels are stored as a single utf-8 blob separated by NUL characters, to avoid pickled object arrays
+    return np.frombuffer('\0'.join(labels).encode('utf-8'), dtype=np.uint8)
+
+
+def decode_labels(blob):
+    return blob.tobytes().decode('utf-8').split('\0')
+
+
+def save_neighbors(index, file_path):
+    '''
+    Saves a NeighborIndex as a compressed .npz file. The file is written next to its destination and
+    renamed, so readers never see a partial file.
+
+    Parameters:
+    - index (NeighborIndex): Neighbor table.
+    - file_path (str): Destination path (.npz).
+
+    Returns:
+    - None
+    '''
+    temp_path = f'{file_path}.tmp.npz'
+    np.savez_compressed(temp_path, labels=encode_labels(index.labels), neighbors=index.neighbors, scores=index.scores)
+    os.replace(temp_path, file_path)
+    print(f'Neighbor index saved as {file_path}')
+
+
+def load_neighbors(file_path):
+    '''
+    Loads a NeighborIndex saved with save_neighbors.
+
+    Parameters:
+    - file_path (str): Path of the .npz file.
+
+    Returns:
+    - NeighborIndex: Neighbor table.
+    '''
+    with np.load(file_path) as data:
+        return make_neighbor_index(decode_labels(data['labels']), data['neighbors'], data['scores'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute the top-k neighbor tables used by functions.py.')
+    parser.add_argument('kind', choices=['items', 'users'], help='items: from df_mod_game.parquet, users: from umatrix_norm.parquet')
+    parser.add_argument('--data-dir', default=None, help='Defaults to Data/ (or GAMES_DATA_DIR)')
+    parser.add_argument('--input', default=None, help='Defaults to df_mod_game.parquet or umatrix_norm.parquet in the data folder')
+    parser.add_argument('--output', default=None,
+                        help=f'Defaults to item_neighbors_<mode>.npz or {USER_NEIGHBORS_FILE} in the data folder')
+    parser.add_argument('--k', type=int, default=20)
+    parser.add_argument('--mode', choices=ITEM_MODES, default='second_order', help='Scoring mode of the item-item table')
+    parser.add_argument('--block-size', type=int, default=512)
+    parser.add_argument('--workers', type=int, default=1, help='Processes scoring blocks in parallel')
+    parser.add_argument('--backend', choices=['exact', 'lsh'], default='exact', help='lsh: approximate tables, see ann.py')
+    parser.add_argument('--tables', type=int, default=None, help='Hash tables of the lsh backend')
+    parser.add_argument('--bucket-size', type=int, default=None, help='Target bucket size of the lsh backend')
+    args = parser.parse_args()
+
+    from ann import make_backend
+    backend = make_backend(args.backend, n_tables=args.tables, bucket_size=args.bucket_size)
+    registry = DataRegistry(args.data_dir)
+    if args.kind == 'items':
+        df_mod_game = pd.read_parquet(args.input or registry.dataset_path('df_mod_game'), columns=['Item_name', 'Genres'])
+        item_index = build_item_neighbors(df_mod_game, k=args.k, mode=args.mode, block_size=args.block_size,
+                                          workers=args.workers, backend=backend)
+        save_neighbors(item_index, args.output or registry.artifact_path(f'item_neighbors_{args.mode}.npz'))
+    else:
+        umatrix_norm = pd.read_parquet(args.input or registry.dataset_path('umatrix_norm'))
+        user_index = build_user_neighbors(umatrix_norm, k=args.k, block_size=args.block_size, workers=args.workers, backend=backend)
+        save_neighbors(user_index, args.output or registry.artifact_path(USER_NEIGHBORS_FILE))
@@ -0,0 +1,339 @@
+import argparse
+import functools
+import hashlib
+import inspect
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from instrumentation import register_collector, stage
+
+
+# In-memory tier: number of results kept per process (least recently used are dropped first). 0 disables the cache.
+RESULT_CACHE_SIZE = int(os.environ.get('GAMES_RESULT_CACHE_SIZE', 1024))
+
+# Seconds a result is reused, in both tiers. The key also holds the dataset fingerprint, so results are
+# not reused across data versions; the TTL bounds how long results of other processes are trusted.
+RESULT_CACHE_TTL = float(os.environ.get('GAMES_RESULT_CACHE_TTL', 3600))
+
+# Optional on-disk tier shared by every process of the host, off when empty. Entries are pickles, so the
+# folder must only be writable by the processes of the application.
+RESULT_CACHE_DIR = os.environ.get('GAMES_RESULT_CACHE_DIR', '')
+
+# Counters kept per function
+COUNTERS = ('memory_hits', 'disk_hits', 'misses', 'evictions', 'expirations')
+
+
+def _normalize(value):
+    # Hashable, type-tagged form of an argument: 5 and 5.0 (or True and 1) are different keys,
+    # numpy scalars are the same key as their Python values, lists and tuples are the same key
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, (list, tuple)):
+        return ('seq', tuple(_normalize(item) for item in value))
+    if isinstance(value, dict):
+        return ('map', tuple(sorted((str(key), _normalize(item)) for key, item in value.items())))
+    return (type(value).__name__, value)
+
+
+def _copy_result(value):
+    # DataFrames are mutable: callers get copies, so changing a result does not change the cached one
+    if isinstance(value, pd.DataFrame):
+        return value.copy()
+    if isinstance(value, tuple):
+        return tuple(_copy_result(item) for item in value)
+    if isinstance(value, list):
+        return [_copy_result(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _copy_result(item) for key, item in value.items()}
+    return value
+
+
+class ResultCache:
+    '''
+    Thread-safe two-tier cache of query results: a bounded LRU in memory and optionally a folder of pickles
+    shared between processes. Entries expire after a TTL. Keys are built by the callers (see cached) from
+    the function name, the normalized arguments and the dataset fingerprint.
+    '''
+
+    def __init__(self, max_size=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL, cache_dir=RESULT_CACHE_DIR):
+        '''
+        Parameters:
+        - max_size (int, optional): Results kept in memory. 0 disables the cache.
+        - ttl (float, optional): Seconds a result is reused.
+        - cache_dir (str, optional): Folder of the on-disk tier, None or '' to keep results in memory only.
+        '''
+        self.max_size = max_size
+        self.ttl = ttl
+        self.cache_dir = cache_dir or None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {}
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def _count(self, function_name, counter):
+        with self._lock:
+            counters = self._counters.setdefault(function_name, dict.fromkeys(COUNTERS, 0))
+            counters[counter] += 1
+
+    def _file_path(self, key):
+        digest = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()[:32]
+        return os.path.join(self.cache_dir, f'{key[0]}_{digest}.pkl')
+
+    def _memory_get(self, key, now):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                del self._entries[key]
+                return 'expired'
+            self._entries.move_to_end(key)
+            return entry
+
+    def _memory_put(self, key, expires_at, value):
+        evicted = 0
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                evicted += 1
+        for _ in range(evicted):
+            self._count(key[0], 'evictions')
+
+    def _disk_get(self, key, now):
+        file_path = self._file_path(key)
+        try:
+            with open(file_path, 'rb') as f:
+                stored_key, expires_at, value = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError, TypeError) as e:
+            print(f'Could not read cached result {file_path}: {e}')
+            return None
+        # Different keys with the same digest are not mixed up
+        if stored_key != key:
+            return None
+        if expires_at <= now:
+            return 'expired'
+        return expires_at, value
+
+    def _disk_put(self, key, expires_at, value):
+        file_path = self._file_path(key)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Write to a temporary file first, so other processes never read a partial entry
+            temp_path = f'{file_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(temp_path, 'wb') as f:
+                pickle.dump((key, expires_at, value), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, file_path)
+        except (OSError, pickle.PicklingError) as e:
+            print(f'Could not save cached result at {file_path}: {e}')
+
+    def get_or_compute(self, key, compute):
+        '''
+        Returns the cached result of a key, looking first in memory, then on disk, and calling compute
+        only when neither tier has an unexpired result. Exceptions of compute are not cached.
+
+        Parameters:
+        - key (tuple): (function name, normalized arguments, dataset fingerprint).
+        - compute (callable): Function without arguments returning the result.
+
+        Returns:
+        - A copy of the result (DataFrames are copied, other values are returned as they are).
+        '''
+        if not self.enabled:
+            return compute()
+
+        function_name = key[0]
+        now = time.time()
+        entry = self._memory_get(key, now)
+        if entry is not None and entry != 'expired':
+            self._count(function_name, 'memory_hits')
+            with stage('cache_hit'):
+                return _copy_result(entry[1])
+        if entry == 'expired':
+            self._count(function_name, 'expirations')
+
+        if self.cache_dir is not None:
+            with stage('cache_disk_read'):
+                entry = self._disk_get(key, now)
+            if entry == 'expired':
+                self._count(function_name, 'expirations')
+            elif entry is not None:
+                self._count(function_name, 'disk_hits')
+                self._memory_put(key, *entry)
+                return _copy_result(entry[1])
+
+        self._count(function_name, 'misses')
+        value = compute()
+        expires_at = time.time() + self.ttl
+        self._memory_put(key, expires_at, value)
+        if self.cache_dir is not None:
+            with stage('cache_disk_write'):
+                self._disk_put(key, expires_at, value)
+        return _copy_result(value)
+
+    def stats(self):
+        '''
+        Returns the counters of the cache.
+
+        Returns:
+        - dict: function name -> {memory_hits, disk_hits, misses, evictions, expirations}, plus 'size'
+          (results in memory).
+        '''
+        with self._lock:
+            stats = {name: dict(counters) for name, counters in self._counters.items()}
+            stats['size'] = len(self._entries)
+        return stats
+
+    def prometheus_lines(self, prefix='games'):
+        '''
+        Exports the counters in the Prometheus text format (see instrumentation.register_collector).
+
+        Parameters:
+        - prefix (str, optional): Prefix of the metric names. Defaults to 'games'.
+
+        Returns:
+        - list: Text lines.
+        '''
+        stats = self.stats()
+        size = stats.pop('size')
+        lines = []
+        for counter in COUNTERS:
+            metric = f'{prefix}_result_cache_{counter}_total'
+            lines += [f'# HELP {metric} Result cache {counter.replace("_", " ")}.', f'# TYPE {metric} counter']
+            for name, counters in sorted(stats.items()):
+                lines.append(f'{metric}{{function="{name}"}} {counters[counter]}')
+        lines += [f'# HELP {prefix}_result_cache_size Results kept in memory.', f'# TYPE {prefix}_result_cache_size gauge',
+                  f'{prefix}_result_cache_size {size}']
+        return lines
+
+    def clear(self, disk=False):
+        '''
+        Drops the results kept in memory (and the counters).
+
+        Parameters:
+        - disk (bool, optional): Also delete the files of the on-disk tier. Defaults to False.
+
+        Returns:
+        - int: Number of files deleted.
+        '''
+        with self._lock:
+            self._entries.clear()
+            self._counters.clear()
+        return self.prune_disk(expired_only=False) if disk else 0
+
+    def prune_disk(self, expired_only=True):
+        '''
+        Deletes the files of the on-disk tier, by default only the expired ones.
+
+        Parameters:
+        - expired_only (bool, optional): Keep the entries that have not expired. Defaults to True.
+
+        Returns:
+        - int: Number of files deleted.
+        '''
+        if self.cache_dir is None or not os.path.isdir(self.cache_dir):
+            return 0
+
+        now = time.time()
+        deleted = 0
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith('.pkl'):
+                continue
+            if expired_only:
+                try:
+                    with open(entry.path, 'rb') as f:
+                        expires_at = pickle.load(f)[1]
+                except (OSError, pickle.UnpicklingError, EOFError, ValueError, TypeError, IndexError):
+                    expires_at = 0
+                if expires_at > now:
+                    continue
+            try:
+                os.remove(entry.path)
+                deleted += 1
+            except FileNotFoundError:
+                pass
+        return deleted
+
+
+# Cache of the process, used by the decorator and helpers below
+_default_cache = ResultCache()
+register_collector(_default_cache.prometheus_lines)
+
+
+def cached(version, normalizers=None, cache=None):
+    '''
+    Decorator that caches the results of a pure query function. The key is the function name, its
+    arguments (bound to the signature, defaults included, type-tagged) and the data version.
+
+    Parameters:
+    - version (callable): Function without arguments returning the fingerprint of the data the results
+      are computed from (e.g. DataRegistry.fingerprint).
+    - normalizers (dict, optional): Argument name -> function applied to the value before it is used in
+      the key, for arguments with equivalent spellings (e.g. str.lower for case-insensitive names).
+    - cache (ResultCache, optional): Cache to use. Defaults to the cache of the process.
+
+    Returns:
+    - callable: The decorator.
+    '''
+    normalizers = normalizers or {}
+
+    def decorator(function):
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            result_cache = cache or _default_cache
+            if not result_cache.enabled:
+                return function(*args, **kwargs)
+            try:
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                arguments = tuple(
+                    (name, _normalize(normalizers[name](value) if name in normalizers and isinstance(value, str) else value))
+                    for name, value in bound.arguments.items())
+                key = (function.__name__, arguments, version())
+                hash(key)
+            except TypeError:
+                # Wrong or unhashable arguments: the function reports them as usual
+                return function(*args, **kwargs)
+            return result_cache.get_or_compute(key, lambda: function(*args, **kwargs))
+
+        return wrapper
+
+    return decorator
+
+
+def cache_stats():
+    '''
+    Returns the counters of the cache of the process. See ResultCache.stats.
+    '''
+    return _default_cache.stats()
+
+
+def clear_result_cache(disk=False):
+    '''
+    Drops the results cached by the process. See ResultCache.clear.
+    '''
+    return _default_cache.clear(disk=disk)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Maintain the on-disk tier of the result cache.')
+    parser.add_argument('--cache-dir', default=RESULT_CACHE_DIR or None, help='Defaults to GAMES_RESULT_CACHE_DIR')
+    parser.add_argument('--all', action='store_true', help='Delete every entry, not only the expired ones')
+    args = parser.parse_args()
+
+    if not args.cache_dir:
+        parser.error('No cache folder: pass --cache-dir or set GAMES_RESULT_CACHE_DIR')
+    deleted = ResultCache(cache_dir=args.cache_dir).prune_disk(expired_only=not args.all)
+    print(f'{deleted} cached results deleted from {args.cache_dir}')
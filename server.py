@@ -0,0 +1,327 @@
+import argparse
+import gc
+import json
+import os
+import signal
+import socket
+import sys
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+from engine import RecommendationEngine, InvalidQueryError, NoDataError
+import instrumentation
+
+
+# Largest request body accepted by the POST endpoints (batches of users or queries)
+MAX_BODY_BYTES = 10 * 1024 * 1024
+
+# Engine shared by every handler of the process. It is created and warmed up in the parent process,
+# so the forked workers share its datasets and indexes read-only (copy-on-write pages).
+ENGINE = None
+
+# Seconds between the samples of the profiler started in every worker, None to leave it off
+PROFILE_INTERVAL = None
+
+# Content type of the Prometheus text exposition format
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _to_json(value):
+    # NamedTuple results become objects, lists and dicts are converted recursively
+    if hasattr(value, '_asdict'):
+        return {key: _to_json(item) for key, item in value._asdict().items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _to_json(item) for key, item in value.items()}
+    return value
+
+
+def _number(value):
+    # Query string values are text: years and n are converted to numbers when possible
+    if isinstance(value, str):
+        for cast in (int, float):
+            try:
+                return cast(value)
+            except ValueError:
+                pass
+    return value
+
+
+def _required(params, name):
+    # A missing parameter is a bad request, not a lookup of None
+    if params.get(name) is None:
+        raise InvalidQueryError(f"Invalid input. Please provide the '{name}' parameter.")
+    return params[name]
+
+
+def _query(endpoint, params):
+    '''
+    Runs one query against the engine.
+
+    Parameters:
+    - endpoint (str): Name of the query (see ENDPOINTS).
+    - params (dict): Arguments of the query.
+
+    Returns:
+    - The typed result of the engine.
+    '''
+    if endpoint not in ENDPOINTS:
+        raise NoDataError(f'Unknown endpoint {endpoint!r}. Available: {sorted(ENDPOINTS)}')
+    return ENDPOINTS[endpoint](params)
+
+
+def _trace_name(endpoint):
+    # Unknown endpoints share one name, so arbitrary paths do not add metric labels
+    return endpoint if endpoint in ENDPOINTS or endpoint == 'batch' else 'unknown'
+
+
+def _similar_user_items(params):
+    # A list of users is answered with the vectorized batch recommender
+    if 'users' in params:
+        users = params['users']
+        if not isinstance(users, list):
+            raise InvalidQueryError('Invalid input. Please provide a list of users.')
+        return ENGINE.similar_user_items_batch(users, n=_number(params.get('n', 5)))
+    return ENGINE.similar_user_items(_required(params, 'user'), n=_number(params.get('n', 5)))
+
+
+ENDPOINTS = {
+    'top_genres': lambda params: ENGINE.top_genres(_number(_required(params, 'year')), n=_number(params.get('n', 5))),
+    'top_games': lambda params: ENGINE.top_games(_number(_required(params, 'year')), n=_number(params.get('n', 5))),
+    'bottom_games': lambda params: ENGINE.bottom_games(_number(_required(params, 'year')), n=_number(params.get('n', 3))),
+    'similar_items': lambda params: ENGINE.similar_items(str(params.get('item_name', '')), n=_number(params.get('n', 5))),
+    'similar_user_items': _similar_user_items,
+}
+
+
+def _run_batch(requests):
+    # Every query of a batch gets its own status, so one bad query does not fail the others
+    results = []
+    for request in requests:
+        try:
+            if not isinstance(request, dict):
+                raise InvalidQueryError('Every request of a batch must be a JSON object')
+            with instrumentation.stage(_trace_name(request.get('endpoint'))):
+                result = _query(request.get('endpoint'), request.get('params', {}))
+            results.append({'status': 200, 'result': _to_json(result)})
+        except (InvalidQueryError, TypeError) as e:
+            results.append({'status': 400, 'error': str(e)})
+        except NoDataError as e:
+            results.append({'status': 404, 'error': str(e)})
+        except Exception as e:
+            results.append({'status': 500, 'error': f'{type(e).__name__}: {e}'})
+    return results
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    '''
+    JSON API over the RecommendationEngine:
+    - GET /health
+    - GET /metrics: Prometheus text metrics of the worker process that answers
+    - GET /profile: collapsed stacks of the sampling profiler of that worker (see --profile)
+    - GET /<endpoint>?param=value, e.g. /top_genres?year=2015&n=5 or /similar_items?item_name=portal
+    - POST /<endpoint> with the parameters as a JSON object, e.g. {"users": ["Jacler", ...], "n": 5}
+    - POST /batch with {"requests": [{"endpoint": "top_games", "params": {"year": 2015}}, ...]}
+    Queries with trace=1 (or "trace": true) also return the per-stage trace of the request.
+    Invalid or missing arguments get a 400 on every endpoint (e.g. no user or year, an n that is not a positive
+    integer, or above the k of the neighbor table for similar_items), unknown years, games and users a 404.
+    '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        # Access logs are disabled: printing every request costs more than serving it
+        pass
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_text(self, status, text, content_type='text/plain; charset=utf-8'):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _answer(self, endpoint, params):
+        try:
+            if endpoint == 'health':
+                self._send(200, {'status': 'ok', 'pid': os.getpid()})
+            elif endpoint == 'metrics':
+                self._send_text(200, instrumentation.prometheus_text(), METRICS_CONTENT_TYPE)
+            elif endpoint == 'profile':
+                profiler = instrumentation.get_profiler()
+                if profiler is None:
+                    raise NoDataError('The profiler is off. Start the server with --profile.')
+                self._send_text(200, profiler.collapsed() + '\n')
+            else:
+                with instrumentation.request_trace(_trace_name(endpoint)) as trace:
+                    if endpoint == 'batch':
+                        payload = {'results': _run_batch(params.get('requests', []))}
+                    else:
+                        payload = {'result': _to_json(_query(endpoint, params))}
+                if params.get('trace') in (True, 1, '1', 'true'):
+                    payload['trace'] = trace
+                self._send(200, payload)
+        except (InvalidQueryError, TypeError) as e:
+            self._send(400, {'error': str(e)})
+        except NoDataError as e:
+            self._send(404, {'error': str(e)})
+        except Exception as e:
+            self._send(500, {'error': f'{type(e).__name__}: {e}'})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        self._answer(url.path.strip('/'), params)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        if length > MAX_BODY_BYTES:
+            self._send(413, {'error': f'Request body larger than {MAX_BODY_BYTES} bytes'})
+            return
+        try:
+            params = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError as e:
+            self._send(400, {'error': f'Invalid JSON: {e}'})
+            return
+        if not isinstance(params, dict):
+            self._send(400, {'error': 'The request body must be a JSON object'})
+            return
+        self._answer(url.path.strip('/'), params)
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    # Each worker process answers its connections on threads, the process pool gives CPU parallelism
+    daemon_threads = True
+
+
+def _serve(listening_socket, address):
+    server = ThreadingServer(address, RequestHandler, bind_and_activate=False)
+    server.socket = listening_socket
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def _reload(signum, frame):
+    # SIGHUP: switch to the user-based data published by incremental.py
+    try:
+        ENGINE.reload_user_model()
+        print(f'Process {os.getpid()} reloaded the user data.')
+    except OSError as e:
+        print(f'Process {os.getpid()} could not reload the user data: {e}')
+
+
+def _spawn_worker(listening_socket, address):
+    pid = os.fork()
+    if pid == 0:
+        # Child: default signal handling, serve until killed. Threads are not forked, so the
+        # profiler is started in the child.
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, _reload)
+        if PROFILE_INTERVAL:
+            instrumentation.start_profiler(PROFILE_INTERVAL)
+        _serve(listening_socket, address)
+        os._exit(0)
+    return pid
+
+
+def run_server(host='0.0.0.0', port=8000, workers=None, data_dir=None, backlog=1024, profile_interval=None):
+    '''
+    Loads the datasets once, then serves the JSON API from a pre-forked pool of worker processes that
+    share the listening socket and the loaded data. Workers that die are replaced. On SIGHUP every worker
+    reloads the user-based data published by incremental.py.
+
+    Parameters:
+    - host (str, optional): Interface to listen on. Defaults to all interfaces.
+    - port (int, optional): Port to listen on. Defaults to 8000.
+    - workers (int, optional): Number of worker processes. Defaults to the number of CPUs. Without
+      os.fork (Windows) the server runs in a single process.
+    - data_dir (str, optional): Folder with the parquet artifacts. Defaults to data_loader.DATA_DIR.
+    - backlog (int, optional): Size of the queue of pending connections.
+    - profile_interval (float, optional): Seconds between the samples of the sampling profiler run in
+      every worker (see GET /profile). Off by default.
+
+    Returns:
+    - None
+    '''
+    global ENGINE, PROFILE_INTERVAL
+    PROFILE_INTERVAL = profile_interval
+    ENGINE = RecommendationEngine(data_dir)
+    ENGINE.warm_up()
+    print(f'Datasets loaded from {ENGINE.data.data_dir}')
+
+    address = (host, port)
+    listening_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listening_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listening_socket.bind(address)
+    listening_socket.listen(backlog)
+
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or not hasattr(os, 'fork'):
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, _reload)
+        if PROFILE_INTERVAL:
+            instrumentation.start_profiler(PROFILE_INTERVAL)
+        print(f'Serving on http://{host}:{port} (single process)')
+        _serve(listening_socket, address)
+        return
+
+    # Objects created so far are never collected, so the garbage collector does not touch
+    # (and copy) the shared pages of the workers
+    gc.freeze()
+
+    children = {_spawn_worker(listening_socket, address) for _ in range(workers)}
+    print(f'Serving on http://{host}:{port} with {workers} worker processes')
+
+    def stop(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        sys.exit(0)
+
+    def reload(signum, frame):
+        # Every worker reloads its own copy of the data
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGHUP)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, reload)
+
+    while True:
+        pid, status = os.wait()
+        if pid in children:
+            children.discard(pid)
+            print(f'Worker {pid} exited with status {status}, starting a new one.')
+            children.add(_spawn_worker(listening_socket, address))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve the playtime queries and recommenders as a JSON API.')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=None, help='Worker processes, defaults to the number of CPUs')
+    parser.add_argument('--data-dir', default=None, help='Defaults to Data/ (or GAMES_DATA_DIR)')
+    parser.add_argument('--profile', type=float, default=None, metavar='MS',
+                        help='Run the sampling profiler in every worker, one sample every MS milliseconds')
+    args = parser.parse_args()
+
+    run_server(args.host, args.port, args.workers, args.data_dir,
+               profile_interval=args.profile / 1000 if args.profile else None)
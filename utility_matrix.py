@@ -0,0 +1,229 @@
+import argparse
+import os
+from collections import namedtuple
+import numpy as np
+from scipy import sparse
+from data_loader import DataRegistry
+from neighbors import encode_labels, decode_labels
+
+
+# Compact item x user utility matrix (umatrix_norm without its zeros):
+# - matrix: CSC matrix (one contiguous segment per user column) with float32 values, or uint8 values
+#   quantized to 1..255 (a stored rating is never rounded to 0).
+# - items / users: labels of the rows and columns, items and users are referenced by their integer position.
+# - user_positions: dict user -> column.
+# - scale: factor that converts the stored values back to ratings (1.0 for float32, 1/255 for uint8).
+UtilityMatrix = namedtuple('UtilityMatrix', ['matrix', 'items', 'users', 'user_positions', 'scale'])
+
+UTILITY_DTYPES = ('float32', 'uint8')
+
+# File of the compact matrix inside the data folder
+UTILITY_MATRIX_FILE = 'umatrix_norm.csc.npz'
+
+
+def make_utility_matrix(matrix, items, users, scale=1.0):
+    '''
+    Creates a UtilityMatrix from its parts, computing the user -> column mapping.
+
+    Parameters:
+    - matrix (scipy.sparse matrix): Item x user values.
+    - items (array-like): Label of every row.
+    - users (array-like): Label of every column.
+    - scale (float, optional): Factor that converts the stored values back to ratings. Defaults to 1.0.
+
+    Returns:
+    - UtilityMatrix: The compact matrix.
+    '''
+    matrix = sparse.csc_matrix(matrix)
+    matrix.sort_indices()
+    users = np.asarray(users, dtype=object)
+    user_positions = {user: col for col, user in enumerate(users)}
+    return UtilityMatrix(matrix, np.asarray(items, dtype=object), users, user_positions, float(scale))
+
+
+def from_sparse(matrix, items, users, dtype='float32'):
+    '''
+    Converts a sparse item x user matrix of ratings to a UtilityMatrix.
+
+    Parameters:
+    - matrix (scipy.sparse matrix): Non-negative ratings, missing ratings not stored (or stored as 0).
+    - items (array-like): Label of every row.
+    - users (array-like): Label of every column.
+    - dtype (str, optional): Stored type, 'float32' (default) or 'uint8' (ratings in [0, 1] quantized to 1/255 steps).
+      uint8 is lossy for ranking: ratings closer than 1/255 can round to the same step, which turns them into
+      ties, so the column maxima (and the votes of the user recommender) may differ from float32.
+
+    Returns:
+    - UtilityMatrix: The compact matrix.
+    '''
+    if dtype not in UTILITY_DTYPES:
+        raise ValueError(f'Unknown dtype {dtype!r}. Available: {UTILITY_DTYPES}')
+
+    matrix = sparse.csc_matrix(matrix, dtype=np.float64)
+    matrix.eliminate_zeros()
+    if (matrix.data < 0).any():
+        raise ValueError('The utility matrix must not have negative ratings')
+    if dtype == 'uint8':
+        if (matrix.data > 1).any():
+            raise ValueError('uint8 quantization needs ratings in [0, 1]')
+        # Stored ratings keep at least one step, so quantization never turns a rating into a missing value
+        matrix.data = np.maximum(np.rint(matrix.data * 255), 1)
+
+    scale = 1 / 255 if dtype == 'uint8' else 1.0
+    return make_utility_matrix(matrix.astype(dtype), items, users, scale)
+
+
+def from_dense(values, items, users, dtype='float32', block_size=256):
+    '''
+    Converts a dense item x user matrix (e.g. the memory-mapped umatrix_norm) to a UtilityMatrix,
+    a block of user columns at a time so the dense values are never copied whole.
+
+    Parameters:
+    - values (np.ndarray): (n_items, n_users) array of non-negative ratings, 0 where the user did not rate the item.
+    - items (array-like): Label of every row.
+    - users (array-like): Label of every column.
+    - dtype (str, optional): Stored type, 'float32' (default) or 'uint8'. See from_sparse.
+    - block_size (int, optional): Number of columns converted at once.
+
+    Returns:
+    - UtilityMatrix: The compact matrix.
+    '''
+    blocks = [sparse.csc_matrix(np.asarray(values[:, start:start + block_size], dtype=np.float64))
+              for start in range(0, values.shape[1], block_size)]
+    return from_sparse(sparse.hstack(blocks, format='csc'), items, users, dtype=dtype)
+
+
+def from_dataframe(umatrix_norm, dtype='float32'):
+    '''
+    Converts umatrix_norm (items as index, users as columns) to a UtilityMatrix. See from_dense.
+
+    Parameters:
+    - umatrix_norm (pd.DataFrame): Normalized item x user rating matrix (umatrix_norm.parquet).
+    - dtype (str, optional): Stored type, 'float32' (default) or 'uint8'.
+
+    Returns:
+    - UtilityMatrix: The compact matrix.
+    '''
+    return from_dense(umatrix_norm.to_numpy(), umatrix_norm.index, umatrix_norm.columns, dtype=dtype)
+
+
+def to_float(utility_matrix):
+    '''
+    Returns the ratings of a UtilityMatrix as a float64 CSC matrix (undoing the uint8 quantization).
+
+    Parameters:
+    - utility_matrix (UtilityMatrix): The compact matrix.
+
+    Returns:
+    - scipy.sparse.csc_matrix: Item x user ratings.
+    '''
+    return utility_matrix.matrix.astype(np.float64) * utility_matrix.scale
+
+
+def nbytes(utility_matrix):
+    '''
+    Returns the memory used by the values and the index arrays of a UtilityMatrix.
+
+    Parameters:
+    - utility_matrix (UtilityMatrix): The compact matrix.
+
+    Returns:
+    - int: Size in bytes (labels not included).
+    '''
+    matrix = utility_matrix.matrix
+    return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+
+
+def column_max_hits(utility_matrix, columns):
+    '''
+    Finds, for every given user column, the items rated with the maximum rating of that column,
+    reading only the stored ratings of the columns.
+
+    A column without ratings has maximum 0, so all its items are hits, as with the dense matrix.
+
+    Parameters:
+    - utility_matrix (UtilityMatrix): The compact matrix.
+    - columns (np.ndarray): Columns to scan (they may repeat).
+
+    Returns:
+    - tuple: (positions, item_rows) arrays with one entry per hit, positions being the index in columns of the hit.
+    '''
+    matrix = utility_matrix.matrix
+    columns = np.asarray(columns, dtype=np.int64)
+    starts = matrix.indptr[columns].astype(np.int64)
+    lengths = matrix.indptr[columns + 1].astype(np.int64) - starts
+
+    # Gather the stored segment of every column one after the other
+    positions = np.repeat(np.arange(len(columns)), lengths)
+    segment_starts = np.cumsum(lengths) - lengths
+    offsets = np.arange(lengths.sum()) - np.repeat(segment_starts - starts, lengths)
+    data = matrix.data[offsets]
+
+    # Maximum of every non-empty segment, then the stored ratings equal to it
+    filled = lengths > 0
+    maxima = np.zeros(len(columns), dtype=data.dtype)
+    if len(data):
+        maxima[filled] = np.maximum.reduceat(data, segment_starts[filled])
+    hits = data == maxima[positions]
+    hit_positions, hit_rows = positions[hits], matrix.indices[offsets[hits]].astype(np.int64)
+
+    empty = np.flatnonzero(~filled)
+    if len(empty):
+        n_items = matrix.shape[0]
+        hit_positions = np.concatenate([hit_positions, np.repeat(empty, n_items)])
+        hit_rows = np.concatenate([hit_rows, np.tile(np.arange(n_items), len(empty))])
+
+    return hit_positions, hit_rows
+
+
+def save_utility_matrix(utility_matrix, file_path):
+    '''
+    Saves a UtilityMatrix as a compressed .npz file. The file is written next to its destination and
+    renamed, so readers never see a partial file.
+
+    Parameters:
+    - utility_matrix (UtilityMatrix): The compact matrix.
+    - file_path (str): Destination path (.npz).
+
+    Returns:
+    - None
+    '''
+    matrix = utility_matrix.matrix
+    temp_path = f'{file_path}.tmp.npz'
+    np.savez_compressed(temp_path, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+                        shape=np.array(matrix.shape), scale=np.array(utility_matrix.scale),
+                        items=encode_labels(utility_matrix.items), users=encode_labels(utility_matrix.users))
+    os.replace(temp_path, file_path)
+
+
+def load_utility_matrix(file_path):
+    '''
+    Loads a UtilityMatrix saved with save_utility_matrix.
+
+    Parameters:
+    - file_path (str): Path of the .npz file.
+
+    Returns:
+    - UtilityMatrix: The compact matrix.
+    '''
+    with np.load(file_path) as data:
+        matrix = sparse.csc_matrix((data['data'], data['indices'], data['indptr']), shape=tuple(data['shape']))
+        return make_utility_matrix(matrix, decode_labels(data['items']), decode_labels(data['users']), data['scale'][()])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert umatrix_norm to the compact sparse matrix read by the engine.')
+    parser.add_argument('--dtype', choices=UTILITY_DTYPES, default='float32',
+                        help='uint8 quantizes ratings to 1/255 steps, close ratings may tie and change the recommendations')
+    parser.add_argument('--data-dir', default=None, help='Defaults to Data/ (or GAMES_DATA_DIR)')
+    parser.add_argument('--output', default=None, help=f'Defaults to {UTILITY_MATRIX_FILE} in the data folder')
+    args = parser.parse_args()
+
+    registry = DataRegistry(args.data_dir)
+    umatrix = registry.load_matrix('umatrix_norm')
+    compact = from_dense(umatrix.values, umatrix.index, umatrix.columns, dtype=args.dtype)
+
+    output = args.output or registry.artifact_path(UTILITY_MATRIX_FILE)
+    save_utility_matrix(compact, output)
+    print(f'Utility matrix {compact.matrix.shape} with {compact.matrix.nnz} ratings '
+          f'({nbytes(compact) / 1e6:.1f} MB instead of {umatrix.values.nbytes / 1e6:.1f} MB) saved as {output}')
@@ -0,0 +1,177 @@
+import argparse
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+from data_loader import DataRegistry
+from instrumentation import stage
+
+
+# On-disk tier: one PNG per (game, reviews) pair, shared by every process of the host. By default every data
+# folder keeps its own images in a 'wordclouds' sub-folder (see wordcloud_dir); set to share a single folder.
+WORDCLOUD_DIR = os.environ.get('GAMES_WORDCLOUD_DIR', '')
+
+# In-memory tier: number of PNG images kept per process (least recently used are dropped first)
+WORDCLOUD_CACHE_SIZE = 64
+
+WORDCLOUD_OPTIONS = {'width': 800, 'height': 400, 'background_color': 'white'}
+
+_memory_cache = OrderedDict()
+_memory_lock = threading.Lock()
+
+
+def reviews_fingerprint(reviews):
+    '''
+    Computes a content hash of the reviews of a game, so a cached image is not reused after the reviews change.
+
+    Parameters:
+    - reviews (list): Review texts of the game.
+
+    Returns:
+    - str: Hexadecimal sha256 digest.
+    '''
+    digest = hashlib.sha256()
+    for review in reviews:
+        digest.update(review.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def wordcloud_dir(data_dir):
+    '''
+    Returns the folder of the on-disk tier of a data folder.
+
+    Parameters:
+    - data_dir (str): Data folder of the reviews (e.g. RecommendationEngine.data.data_dir).
+
+    Returns:
+    - str: WORDCLOUD_DIR if set, otherwise the 'wordclouds' folder inside data_dir.
+    '''
+    return WORDCLOUD_DIR or os.path.join(data_dir, 'wordclouds')
+
+
+def _file_path(cache_dir, game, fingerprint):
+    # Game names are hashed too, they can contain characters that are not valid in file names
+    game_hash = hashlib.sha256(game.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir, f'{game_hash}_{fingerprint[:16]}.png')
+
+
+def _memory_get(key):
+    with _memory_lock:
+        image = _memory_cache.get(key)
+        if image is not None:
+            _memory_cache.move_to_end(key)
+        return image
+
+
+def _memory_put(key, image):
+    with _memory_lock:
+        _memory_cache[key] = image
+        _memory_cache.move_to_end(key)
+        while len(_memory_cache) > WORDCLOUD_CACHE_SIZE:
+            _memory_cache.popitem(last=False)
+
+
+def render_wordcloud_png(review_text):
+    '''
+    Renders a wordcloud of a text as PNG bytes. wordcloud is imported here, so it is only loaded when a render is needed.
+
+    Parameters:
+    - review_text (str): Text to render.
+
+    Returns:
+    - bytes: PNG image.
+    '''
+    from wordcloud import WordCloud
+
+    wordcloud = WordCloud(**WORDCLOUD_OPTIONS).generate(review_text)
+    buffer = io.BytesIO()
+    wordcloud.to_image().save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def get_wordcloud_png(game, reviews, cache_dir):
+    '''
+    Returns the wordcloud of the reviews of a game, looking first in memory, then on disk, and rendering it
+    only when neither tier has an image for the current reviews.
+
+    Parameters:
+    - game (str): Name of the game.
+    - reviews (list): Review texts of the game.
+    - cache_dir (str): Folder of the on-disk tier (see wordcloud_dir).
+
+    Returns:
+    - bytes: PNG image, or None if the game has no reviews.
+    '''
+    if not reviews:
+        return None
+
+    with stage('wordcloud_fingerprint'):
+        fingerprint = reviews_fingerprint(reviews)
+    # The folder is part of the key, so an image cached for one data folder is also written to another
+    key = (cache_dir, game, fingerprint)
+
+    image = _memory_get(key)
+    if image is not None:
+        return image
+
+    file_path = _file_path(cache_dir, game, fingerprint)
+    if os.path.exists(file_path):
+        with stage('wordcloud_disk_read'), open(file_path, 'rb') as f:
+            image = f.read()
+    else:
+        with stage('wordcloud_render'):
+            image = render_wordcloud_png(' '.join(reviews))
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write to a temporary file first, so other processes never read a partial image
+            temp_path = f'{file_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(image)
+            os.replace(temp_path, file_path)
+        except OSError as e:
+            print(f'Could not save wordcloud of {game} at {file_path}: {e}')
+
+    _memory_put(key, image)
+    return image
+
+
+def prerender_top_games(n=100, data=None):
+    '''
+    Renders to the on-disk tier the wordclouds of the n games with the most reviews, so requests for
+    popular games never render. Games whose image is already on disk are skipped.
+
+    Parameters:
+    - n (int, optional): Number of games. Defaults to 100.
+    - data (DataRegistry, optional): Registry of the data folder whose reviews are rendered (e.g. the data
+      of an engine). Defaults to a registry of data_loader.DATA_DIR.
+
+    Returns:
+    - list: Names of the games that were rendered.
+    '''
+    data = data or DataRegistry()
+    cache_dir = wordcloud_dir(data.data_dir)
+    df_reviews = data.load_dataset('models', ['Item_name', 'Review']).dropna(subset=['Review'])
+    top_games = df_reviews['Item_name'].value_counts().head(n).index
+    reviews_by_game = df_reviews[df_reviews['Item_name'].isin(top_games)].groupby('Item_name', sort=False)['Review']
+
+    rendered = []
+    for game in top_games:
+        reviews = reviews_by_game.get_group(game).tolist()
+        if not os.path.exists(_file_path(cache_dir, game, reviews_fingerprint(reviews))):
+            get_wordcloud_png(game, reviews, cache_dir)
+            rendered.append(game)
+            print(f'Wordcloud for {game} rendered ({len(rendered)}).')
+
+    print(f'{len(rendered)} wordclouds rendered, {len(top_games) - len(rendered)} already cached at {cache_dir}')
+    return rendered
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pre-render the wordclouds of the most reviewed games.')
+    parser.add_argument('--top', type=int, default=100, help='Number of games to render')
+    parser.add_argument('--data-dir', default=None, help='Defaults to Data/ (or GAMES_DATA_DIR)')
+    args = parser.parse_args()
+
+    prerender_top_games(args.top, DataRegistry(args.data_dir))